@@ -0,0 +1,997 @@
+"""
+Signaling backplane shared by every worker and node
+"""
+import asyncio
+import base64
+import json
+import os
+import socket
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from typing import IO, Any, Callable, Dict, List, Optional, Tuple
+
+from matchmaking import (
+    ANYONE,
+    AVOID_SIZE,
+    REMATCH_AFTER,
+    WIDEN_AFTER,
+    Matchmaker,
+    Preferences,
+    bucket_keys
+)
+from protocol import Frame
+from registry import MAX_WORKER_ID
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - redis is optional
+    aioredis = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not on Windows
+    fcntl = None
+
+
+# Delivers a frame to a connection attached to this process.
+# Returns False if the connection is not attached here.
+Deliver = Callable[[str, Frame], bool]
+
+# Told (client_id, paired) when another node pairs or unpairs a client
+# attached to this process
+OnPairing = Callable[[str, bool], None]
+
+# Told (client_id, partner_id) when the partner of a client attached to
+# this process was suspended, to come back on another worker
+OnSuspended = Callable[[str, str], None]
+
+# Told the new worker id when the lease of the previous one was lost
+OnWorkerId = Callable[[int], None]
+
+# Seconds a Redis worker id lease lasts without being renewed
+WORKER_LEASE_TTL = 30
+
+# Seconds after which a node that stopped publishing its presence counts
+# is left out of the cluster totals
+PRESENCE_STALE_AFTER = 10.0
+
+# Most waiting clients one `RedisBackplane.widen` call looks at
+WIDEN_BATCH = 200
+
+# Seconds to wait before retrying after Redis failed, doubled on every
+# failure in a row up to the maximum
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5.0
+
+
+def default_node_id() -> str:
+    """
+    Return an id that is unique for this worker process.
+    """
+    return os.environ.get("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def lease_local_worker_id(directory: str) -> Tuple[int, IO]:
+    """
+    Take the lowest worker id no other process of this host holds.
+
+    Each id is an exclusive lock on a file of `directory`, held as long as
+    the returned file stays open and released by the OS when the process
+    dies.
+
+    Returns:
+        Tuple[int, IO]: The worker id and the open lock file.
+    """
+    if fcntl is None:
+        raise RuntimeError("Worker ids cannot be leased here, set WORKER_ID")
+    for worker_id in range(MAX_WORKER_ID + 1):
+        handle = open(
+            os.path.join(directory, f"omegle-worker-{worker_id}.lock"), "a"
+        )
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        return worker_id, handle
+    raise RuntimeError("Every worker id of this host is taken")
+
+
+class Backplane(ABC):
+    """
+    Holds the global waiting queue and routes frames between processes.
+
+    `partner_of` and `forward` are called for every signaling frame, so they
+    must answer from local state without any network round trip.
+    """
+
+    def __init__(self, node_id: Optional[str] = None) -> None:
+        self.node_id: str = node_id or default_node_id()
+        self._deliver: Optional[Deliver] = None
+        self.on_pairing: Optional[OnPairing] = None
+        self.on_suspended: Optional[OnSuspended] = None
+        self.on_worker_id: Optional[OnWorkerId] = None
+        self._lease: Optional[IO] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        """
+        Start receiving frames addressed to connections on this node.
+
+        Args:
+            deliver (Deliver): Called with (client_id, frame) for every
+              frame another node routes to us.
+        Returns:
+            None
+        """
+        self._deliver = deliver
+
+    async def close(self) -> None:
+        self._deliver = None
+        if self._lease is not None:
+            self._lease.close()
+            self._lease = None
+
+    async def allocate_worker_id(self) -> int:
+        """
+        Return a worker id for client id generation.
+
+        Ids have to be unique among processes sharing a database. `WORKER_ID`
+        sets the id; otherwise each process of this host leases its own
+        with a lock file in `WORKER_LOCK_DIR` (the temporary directory by
+        default). Processes on several hosts need a `WORKER_ID` each, or a
+        backplane that leases ids cluster-wide.
+        """
+        if os.environ.get("WORKER_ID"):
+            return int(os.environ["WORKER_ID"])
+        worker_id, self._lease = lease_local_worker_id(
+            os.environ.get("WORKER_LOCK_DIR", tempfile.gettempdir())
+        )
+        return worker_id
+
+    @abstractmethod
+    async def register(
+        self,
+        client_id: str,
+        preferences: Preferences = ANYONE
+    ) -> None:
+        """
+        Record that the client is attached to this node, and who it would
+        like to be matched with.
+        """
+
+    @abstractmethod
+    async def unregister(self, client_id: str) -> None:
+        """
+        Forget the client. Call `leave` first to break its pair.
+        """
+
+    @abstractmethod
+    async def join(self, client_id: str) -> Optional[str]:
+        """
+        Match the client with a waiting stranger, or queue it.
+
+        Returns:
+            Optional[str]: The partner id, or None if the client is waiting
+              (or no longer registered).
+        """
+
+    async def widen(self) -> List[Tuple[str, str]]:
+        """
+        Pair waiting clients whose waits allow a wider search.
+
+        Called periodically. Backplanes without preferences match everyone
+        on `join` and have nothing to do.
+
+        Returns:
+            List[Tuple[str, str]]: The new pairs.
+        """
+        return []
+
+    @abstractmethod
+    async def leave(self, client_id: str) -> Optional[str]:
+        """
+        Remove the client from the queue and break its pair.
+
+        Returns:
+            Optional[str]: The former partner id, if any.
+        """
+
+    @abstractmethod
+    async def skip(self, client_id: str) -> Optional[str]:
+        """
+        Break the client's pair so both sides can be requeued with `join`,
+        and keep the two from being matched again for a while.
+
+        Returns:
+            Optional[str]: The skipped partner id, if the client was paired.
+        """
+
+    @abstractmethod
+    async def suspend(self, client_id: str) -> Optional[str]:
+        """
+        Take a client that will reconnect elsewhere out of the queue,
+        keeping its pair. Call `unregister` afterwards.
+
+        The node of the partner is told through `on_suspended`; the
+        partner stays paired until the client resumes or it `leave`s.
+
+        Returns:
+            Optional[str]: The partner id, if the client is paired.
+        """
+
+    @abstractmethod
+    async def resume(self, client_id: str, partner_id: str) -> bool:
+        """
+        Reattach a reconnected client to its former partner.
+
+        The pair is kept if it survived the reconnection, or made again if
+        the partner is registered and neither side is waiting or paired
+        with someone else.
+
+        Returns:
+            bool: True if the two are paired.
+        """
+
+    @abstractmethod
+    def partner_of(self, client_id: str) -> Optional[str]:
+        """
+        Return the partner of a client attached to this node.
+        """
+
+    @abstractmethod
+    async def queue_depth(self) -> int:
+        """
+        Return how many clients are waiting for a partner, on all nodes.
+        """
+
+    @abstractmethod
+    def forward(self, client_id: str, frame: Frame) -> bool:
+        """
+        Queue a frame for a client attached to another node.
+
+        Returns:
+            bool: False if the frame could not be queued.
+        """
+
+    async def publish_presence(self, counts: Dict[str, int]) -> None:
+        """
+        Share this node's presence counts with the other nodes.
+        """
+
+    async def cluster_presence(self) -> Optional[Dict[str, int]]:
+        """
+        Return the presence counts summed over all live nodes, or None if
+        this process is the only node.
+        """
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {}
+
+
+class InMemoryBackplane(Backplane):
+    """
+    Single-process backplane backed by a `Matchmaker`.
+    """
+
+    def __init__(
+        self,
+        node_id: Optional[str] = None,
+        matchmaker: Optional[Matchmaker] = None
+    ) -> None:
+        super().__init__(node_id)
+        self.matchmaker: Matchmaker = matchmaker or Matchmaker()
+        self._clients: Dict[str, Preferences] = {}
+
+    async def register(
+        self,
+        client_id: str,
+        preferences: Preferences = ANYONE
+    ) -> None:
+        self._clients[client_id] = preferences
+
+    async def unregister(self, client_id: str) -> None:
+        self._clients.pop(client_id, None)
+
+    async def join(self, client_id: str) -> Optional[str]:
+        preferences = self._clients.get(client_id)
+        if preferences is None:
+            return None
+        return self.matchmaker.join(client_id, preferences)
+
+    async def widen(self) -> List[Tuple[str, str]]:
+        return self.matchmaker.widen()
+
+    async def leave(self, client_id: str) -> Optional[str]:
+        return self.matchmaker.leave(client_id)
+
+    async def skip(self, client_id: str) -> Optional[str]:
+        return self.matchmaker.skip(client_id)
+
+    async def suspend(self, client_id: str) -> Optional[str]:
+        partner_id = self.matchmaker.withdraw(client_id)
+        if partner_id is not None and self.on_suspended is not None:
+            self.on_suspended(partner_id, client_id)
+        return partner_id
+
+    async def resume(self, client_id: str, partner_id: str) -> bool:
+        if partner_id not in self._clients:
+            return False
+        return self.matchmaker.restore(client_id, partner_id)
+
+    def partner_of(self, client_id: str) -> Optional[str]:
+        return self.matchmaker.partner_of(client_id)
+
+    async def queue_depth(self) -> int:
+        return self.matchmaker.waiting_count
+
+    def forward(self, client_id: str, frame: Frame) -> bool:
+        # Every client lives in this process, nothing to forward
+        return False
+
+
+# Shared by the scripts below, all called with the keys
+# KEYS: waiting, pairs, nodes, buckets
+#
+# Waiting clients sit in the global queue and in the queues of their
+# buckets, all sorted sets scored by when they joined. `buckets` maps a
+# client to the JSON list of its bucket queues, region-wide one last.
+QUEUE_LUA = """
+local function dequeue(client)
+  redis.call('ZREM', KEYS[1], client)
+  local buckets = redis.call('HGET', KEYS[4], client)
+  if buckets then
+    for _, bucket in ipairs(cjson.decode(buckets)) do
+      redis.call('ZREM', bucket, client)
+    end
+  end
+end
+
+local function enqueue(client, now)
+  redis.call('ZADD', KEYS[1], now, client)
+  local buckets = redis.call('HGET', KEYS[4], client)
+  if buckets then
+    for _, bucket in ipairs(cjson.decode(buckets)) do
+      redis.call('ZADD', bucket, now, client)
+    end
+  end
+end
+
+-- The longest waiting client of a queue that `client` may be matched
+-- with, and when it joined. Waiters no longer registered are dropped on
+-- the way and strangers in the avoid set stepped over: at most its size.
+local function oldest(queue, client, now, avoid)
+  local start = 0
+  while true do
+    local entries = redis.call(
+      'ZRANGE', queue, start, start + 15, 'WITHSCORES')
+    if #entries == 0 then return nil end
+    local kept = #entries / 2
+    for i = 1, #entries, 2 do
+      local waiter = entries[i]
+      if redis.call('HEXISTS', KEYS[3], waiter) == 0 then
+        dequeue(waiter)
+        redis.call('ZREM', queue, waiter)
+        kept = kept - 1
+      elseif waiter ~= client then
+        local until_ = redis.call('ZSCORE', avoid, waiter)
+        if not until_ or tonumber(until_) <= now then
+          return waiter, tonumber(entries[i + 1])
+        end
+      end
+    end
+    start = start + kept
+  end
+end
+
+local function pair(client, partner)
+  dequeue(client)
+  dequeue(partner)
+  redis.call('HSET', KEYS[2], client, partner, partner, client)
+  return {
+    client, redis.call('HGET', KEYS[3], client),
+    partner, redis.call('HGET', KEYS[3], partner)
+  }
+end
+"""
+
+# ARGV: client_id, score, avoid key prefix, widen_after
+#
+# The same search as `Matchmaker._find`.
+JOIN_SCRIPT = QUEUE_LUA + """
+local me, now, widen = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[4])
+local my_node = redis.call('HGET', KEYS[3], me)
+if not my_node then return {-1} end
+local partner = redis.call('HGET', KEYS[2], me)
+if partner then
+  return {1, partner, redis.call('HGET', KEYS[3], partner) or '', my_node}
+end
+if redis.call('ZSCORE', KEYS[1], me) then return {0} end
+local avoid = ARGV[3] .. me
+local buckets = cjson.decode(redis.call('HGET', KEYS[4], me) or '[]')
+local best, best_at
+-- Someone sharing a tag (or also untagged), in the same region
+for i = 1, #buckets - 1 do
+  local waiter, at = oldest(buckets[i], me, now, avoid)
+  if waiter and (not best or at < best_at) then
+    best, best_at = waiter, at
+  end
+end
+-- Someone who has waited long enough to take anyone from the region
+if not best and #buckets > 0 then
+  local waiter, at = oldest(buckets[#buckets], me, now, avoid)
+  if waiter and now - at >= widen then best = waiter end
+end
+-- Someone who has waited long enough to take anyone at all
+if not best then
+  local waiter, at = oldest(KEYS[1], me, now, avoid)
+  if waiter and now - at >= 2 * widen then best = waiter end
+end
+if best then
+  local made = pair(me, best)
+  return {1, best, made[4], my_node}
+end
+enqueue(me, now)
+return {0}
+"""
+
+# ARGV: now, avoid key prefix, widen_after, most clients to look at
+#
+# The same pass as `Matchmaker.widen`, over the clients that waited at
+# least `widen_after`. Returns the new pairs as a flat list of
+# (client, node, partner, partner node).
+WIDEN_SCRIPT = QUEUE_LUA + """
+local now, widen = tonumber(ARGV[1]), tonumber(ARGV[3])
+local stale = redis.call(
+  'ZRANGEBYSCORE', KEYS[1], '-inf', now - widen,
+  'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[4]))
+local made = {}
+for i = 1, #stale, 2 do
+  local client, at = stale[i], tonumber(stale[i + 1])
+  -- Skip clients taken as a partner earlier in this pass
+  if redis.call('ZSCORE', KEYS[1], client)
+    and redis.call('HEXISTS', KEYS[3], client) == 1 then
+    local avoid = ARGV[2] .. client
+    local buckets = cjson.decode(
+      redis.call('HGET', KEYS[4], client) or '[]')
+    local partner
+    if #buckets > 0 then
+      partner = oldest(buckets[#buckets], client, now, avoid)
+    end
+    if not partner and now - at >= 2 * widen then
+      partner = oldest(KEYS[1], client, now, avoid)
+    end
+    if partner then
+      for _, value in ipairs(pair(client, partner)) do
+        table.insert(made, value)
+      end
+    end
+  end
+end
+return made
+"""
+
+# ARGV: client_id
+LEAVE_SCRIPT = QUEUE_LUA + """
+dequeue(ARGV[1])
+local partner = redis.call('HGET', KEYS[2], ARGV[1])
+if not partner then return false end
+redis.call('HDEL', KEYS[2], ARGV[1], partner)
+return {partner, redis.call('HGET', KEYS[3], partner) or ''}
+"""
+
+# ARGV: client_id
+WITHDRAW_SCRIPT = QUEUE_LUA + """
+dequeue(ARGV[1])
+"""
+
+# ARGV: client_id, avoid key prefix
+UNREGISTER_SCRIPT = QUEUE_LUA + """
+dequeue(ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('DEL', ARGV[2] .. ARGV[1])
+"""
+
+# ARGV: client_id, now, rematch_after, avoid_size, avoid key prefix
+#
+# Breaks the pair like LEAVE_SCRIPT and has each side remember the other
+# in its avoid set: a sorted set scored by when the two may meet again,
+# holding the latest `avoid_size` and expiring with its newest entry.
+SKIP_SCRIPT = """
+local me = ARGV[1]
+local partner = redis.call('HGET', KEYS[2], me)
+if not partner then return false end
+redis.call('HDEL', KEYS[2], me, partner)
+local until_ = tonumber(ARGV[2]) + tonumber(ARGV[3])
+local ttl = math.ceil(tonumber(ARGV[3]))
+for _, pair in ipairs({{me, partner}, {partner, me}}) do
+  local avoid = ARGV[5] .. pair[1]
+  redis.call('ZADD', avoid, until_, pair[2])
+  redis.call('ZREMRANGEBYRANK', avoid, 0, -tonumber(ARGV[4]) - 1)
+  redis.call('EXPIRE', avoid, ttl)
+end
+return {partner, redis.call('HGET', KEYS[3], partner) or ''}
+"""
+
+# ARGV: key prefix, node id, ttl, highest worker id
+#
+# Leases the lowest worker id not leased by a live node.
+LEASE_SCRIPT = """
+for worker = 0, tonumber(ARGV[4]) do
+  if redis.call('SET', ARGV[1] .. worker, ARGV[2], 'NX', 'EX', ARGV[3]) then
+    return worker
+  end
+end
+return -1
+"""
+
+# KEYS: lease   ARGV: node id, ttl (0 to release)
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+if tonumber(ARGV[2]) > 0 then
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+else
+  redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+# ARGV: client_id, partner_id
+RESTORE_SCRIPT = """
+local me, partner = ARGV[1], ARGV[2]
+local my_node = redis.call('HGET', KEYS[3], me)
+local partner_node = redis.call('HGET', KEYS[3], partner)
+-- Like InMemoryBackplane, only resume with a partner that is attached
+if not my_node or not partner_node or me == partner then return {0} end
+if redis.call('HGET', KEYS[2], me) == partner then
+  return {1, partner_node, my_node}
+end
+if redis.call('HEXISTS', KEYS[2], me) == 1
+  or redis.call('HEXISTS', KEYS[2], partner) == 1
+  or redis.call('ZSCORE', KEYS[1], me)
+  or redis.call('ZSCORE', KEYS[1], partner) then
+  return {0}
+end
+redis.call('HSET', KEYS[2], me, partner, partner, me)
+return {1, partner_node, my_node}
+"""
+
+
+class RedisBackplane(Backplane):
+    """
+    Multi-process backplane built on Redis.
+
+    Waiting clients are queued like in `Matchmaker`, by arrival in a
+    global queue and in one queue per (region, tag) bucket, all sorted
+    sets; pairs live in a hash. Lua scripts change them, so matching is
+    atomic across nodes, and searches widen the same way: `widen` pairs
+    clients that waited `widen_after` seconds and more. Each node
+    subscribes to its own channel and receives frames, pair and unpair
+    events for the clients attached to it. Outgoing envelopes go through a
+    bounded queue drained by one publisher task, so signaling never waits
+    on Redis.
+
+    Both tasks outlive Redis failures: the publisher drops the envelope it
+    could not send and the listener subscribes again, each backing off
+    while Redis stays unreachable. Events published in the meantime are
+    lost.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        node_id: Optional[str] = None,
+        prefix: str = "omegle",
+        outbox_size: int = 10_000,
+        rematch_after: float = REMATCH_AFTER,
+        avoid_size: int = AVOID_SIZE,
+        widen_after: float = WIDEN_AFTER
+    ) -> None:
+        if aioredis is None:
+            raise RuntimeError(
+                "The redis package is required for RedisBackplane."
+            )
+        super().__init__(node_id)
+        self.url: str = url
+        self.prefix: str = prefix
+        self._keys: Tuple[str, str, str, str] = (
+            f"{prefix}:waiting",
+            f"{prefix}:pairs",
+            f"{prefix}:nodes",
+            f"{prefix}:buckets",
+        )
+        self._presence_key: str = f"{prefix}:presence"
+        # Followed by a client id: who it skipped or was skipped by
+        self._avoid_prefix: str = f"{prefix}:avoid:"
+        self.rematch_after: float = rematch_after
+        self.avoid_size: int = avoid_size
+        self.widen_after: float = widen_after
+        self._redis: Any = None
+        self._pubsub: Any = None
+        self._join: Any = None
+        self._leave: Any = None
+        self._skip: Any = None
+        self._widen: Any = None
+        self._withdraw: Any = None
+        self._unregister: Any = None
+        self._lease_script: Any = None
+        self._renew: Any = None
+        self._restore: Any = None
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=outbox_size)
+        self._tasks: Tuple[asyncio.Task, ...] = ()
+        # Followed by a worker id: the node leasing it
+        self._worker_prefix: str = f"{prefix}:worker:"
+        self.worker_id: Optional[int] = None
+        self._renewal: Optional[asyncio.Task] = None
+        # Partners and partner locations of the clients attached here
+        self._partners: Dict[str, str] = {}
+        self._locations: Dict[str, str] = {}
+        self.dropped: int = 0
+        self.failed: int = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"dropped": self.dropped, "failed": self.failed}
+
+    def _channel(self, node_id: str) -> str:
+        return f"{self.prefix}:node:{node_id}"
+
+    async def start(self, deliver: Deliver) -> None:
+        await super().start(deliver)
+        self._redis = aioredis.from_url(self.url, decode_responses=True)
+        self._join = self._redis.register_script(JOIN_SCRIPT)
+        self._leave = self._redis.register_script(LEAVE_SCRIPT)
+        self._skip = self._redis.register_script(SKIP_SCRIPT)
+        self._widen = self._redis.register_script(WIDEN_SCRIPT)
+        self._withdraw = self._redis.register_script(WITHDRAW_SCRIPT)
+        self._lease_script = self._redis.register_script(LEASE_SCRIPT)
+        self._renew = self._redis.register_script(RENEW_SCRIPT)
+        self._unregister = self._redis.register_script(UNREGISTER_SCRIPT)
+        self._restore = self._redis.register_script(RESTORE_SCRIPT)
+        await self._subscribe()
+        self._tasks = (
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._publish()),
+        )
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = ()
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+            await self._renew(
+                keys=[self._worker_prefix + str(self.worker_id)],
+                args=[self.node_id, 0]
+            )
+        if self._redis is not None:
+            await self._redis.hdel(self._presence_key, self.node_id)
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+        await super().close()
+
+    async def allocate_worker_id(self) -> int:
+        """
+        Return `WORKER_ID` if set, or lease a worker id no other live node
+        holds.
+
+        The lease lasts `WORKER_LEASE_TTL` seconds and is renewed in the
+        background until `close`. Should it be lost anyway, e.g. while
+        Redis was unreachable, a new id is leased and handed to
+        `on_worker_id`.
+        """
+        if os.environ.get("WORKER_ID"):
+            return await super().allocate_worker_id()
+        worker_id = await self._lease_worker_id()
+        if self._renewal is None:
+            self._renewal = asyncio.create_task(self._renew_worker_id())
+        return worker_id
+
+    async def _lease_worker_id(self) -> int:
+        worker_id = int(await self._lease_script(args=[
+            self._worker_prefix,
+            self.node_id,
+            WORKER_LEASE_TTL,
+            MAX_WORKER_ID,
+        ]))
+        if worker_id < 0:
+            raise RuntimeError("Every worker id is leased")
+        self.worker_id = worker_id
+        return worker_id
+
+    async def _renew_worker_id(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_LEASE_TTL / 3)
+            try:
+                renewed = await self._renew(
+                    keys=[self._worker_prefix + str(self.worker_id)],
+                    args=[self.node_id, WORKER_LEASE_TTL]
+                )
+                if renewed:
+                    continue
+                print(f"Worker id {self.worker_id} lease lost")
+                worker_id = await self._lease_worker_id()
+            except Exception as ex:
+                self.failed += 1
+                print(f"Worker id lease renewal failed: {ex}")
+                continue
+            if self.on_worker_id is not None:
+                self.on_worker_id(worker_id)
+
+    async def register(
+        self,
+        client_id: str,
+        preferences: Preferences = ANYONE
+    ) -> None:
+        buckets = [
+            self._bucket(region, tag)
+            for region, tag in bucket_keys(preferences)
+        ]
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._keys[2], client_id, self.node_id)
+            pipe.hset(self._keys[3], client_id, json.dumps(buckets))
+            await pipe.execute()
+
+    async def unregister(self, client_id: str) -> None:
+        await self._unregister(
+            keys=self._keys, args=[client_id, self._avoid_prefix]
+        )
+        self._partners.pop(client_id, None)
+
+    async def join(self, client_id: str) -> Optional[str]:
+        result = await self._join(
+            keys=self._keys,
+            args=[
+                client_id, time.time(), self._avoid_prefix, self.widen_after
+            ]
+        )
+        if int(result[0]) != 1:
+            return None
+        partner_id, partner_node, my_node = result[1], result[2], result[3]
+        self._paired(client_id, my_node, partner_id, partner_node)
+        self._paired(partner_id, partner_node, client_id, my_node)
+        return partner_id
+
+    async def widen(self) -> List[Tuple[str, str]]:
+        result = await self._widen(keys=self._keys, args=[
+            time.time(), self._avoid_prefix, self.widen_after, WIDEN_BATCH
+        ])
+        pairs: List[Tuple[str, str]] = []
+        for start in range(0, len(result), 4):
+            client_id, node, partner_id, partner_node = (
+                result[start:start + 4]
+            )
+            self._paired(client_id, node, partner_id, partner_node)
+            self._paired(partner_id, partner_node, client_id, node)
+            pairs.append((client_id, partner_id))
+        return pairs
+
+    async def leave(self, client_id: str) -> Optional[str]:
+        self._partners.pop(client_id, None)
+        result = await self._leave(keys=self._keys, args=[client_id])
+        if not result:
+            return None
+        partner_id, partner_node = result
+        self._unpaired(partner_id, partner_node)
+        return partner_id
+
+    async def skip(self, client_id: str) -> Optional[str]:
+        self._partners.pop(client_id, None)
+        result = await self._skip(keys=self._keys, args=[
+            client_id,
+            time.time(),
+            self.rematch_after,
+            self.avoid_size,
+            self._avoid_prefix,
+        ])
+        if not result:
+            return None
+        partner_id, partner_node = result
+        self._unpaired(partner_id, partner_node)
+        return partner_id
+
+    async def suspend(self, client_id: str) -> Optional[str]:
+        # The pair stays in Redis for whichever node the client resumes on
+        await self._withdraw(keys=self._keys, args=[client_id])
+        partner_id = self._partners.pop(client_id, None)
+        if partner_id is None:
+            return None
+        partner_node = self._locations.pop(partner_id, None)
+        if partner_node == self.node_id:
+            if self.on_suspended is not None:
+                self.on_suspended(partner_id, client_id)
+        else:
+            self._enqueue(partner_node, {
+                "op": "suspended", "to": partner_id, "peer": client_id
+            })
+        return partner_id
+
+    async def resume(self, client_id: str, partner_id: str) -> bool:
+        result = await self._restore(
+            keys=self._keys, args=[client_id, partner_id]
+        )
+        if int(result[0]) != 1:
+            return False
+        partner_node, my_node = result[1], result[2]
+        self._paired(client_id, my_node, partner_id, partner_node)
+        # Also tells the partner's node where the client is now
+        self._paired(partner_id, partner_node, client_id, my_node)
+        return True
+
+    def partner_of(self, client_id: str) -> Optional[str]:
+        return self._partners.get(client_id)
+
+    async def queue_depth(self) -> int:
+        return await self._redis.zcard(self._keys[0])
+
+    def forward(self, client_id: str, frame: Frame) -> bool:
+        # Partners have a cached location, anyone else is looked up by
+        # the publisher task
+        envelope = {"op": "frame", "to": client_id, "frame": frame}
+        if isinstance(frame, bytes):
+            envelope["frame"] = base64.b64encode(frame).decode("ascii")
+            envelope["binary"] = True
+        return self._enqueue(self._locations.get(client_id), envelope)
+
+    async def publish_presence(self, counts: Dict[str, int]) -> None:
+        await self._redis.hset(
+            self._presence_key,
+            self.node_id,
+            json.dumps({**counts, "at": time.time()})
+        )
+
+    async def cluster_presence(self) -> Optional[Dict[str, int]]:
+        entries = await self._redis.hgetall(self._presence_key)
+        oldest = time.time() - PRESENCE_STALE_AFTER
+        totals: Dict[str, int] = {}
+        stale: List[str] = []
+        for node_id, entry in entries.items():
+            counts = json.loads(entry)
+            if counts.pop("at", 0) < oldest:
+                stale.append(node_id)
+                continue
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+        if stale:
+            # Nodes that died without cleaning up after themselves
+            await self._redis.hdel(self._presence_key, *stale)
+        return totals
+
+    def _paired(
+        self,
+        client_id: str,
+        node_id: str,
+        partner_id: str,
+        partner_node: str
+    ) -> None:
+        if node_id == self.node_id:
+            self._partners[client_id] = partner_id
+            self._locations[partner_id] = partner_node
+        elif node_id:
+            self._enqueue(node_id, {
+                "op": "pair",
+                "to": client_id,
+                "peer": partner_id,
+                "node": partner_node,
+            })
+
+    def _bucket(self, region: Optional[str], tag: Optional[str]) -> str:
+        # JSON keeps regions and tags of any content apart
+        return f"{self.prefix}:bucket:{json.dumps([region, tag])}"
+
+    def _unpaired(self, partner_id: str, partner_node: str) -> None:
+        self._locations.pop(partner_id, None)
+        if partner_node == self.node_id:
+            self._partners.pop(partner_id, None)
+        elif partner_node:
+            self._enqueue(partner_node, {"op": "unpair", "to": partner_id})
+
+    def _enqueue(
+        self,
+        node_id: Optional[str],
+        envelope: Dict[str, Any]
+    ) -> bool:
+        try:
+            self._outbox.put_nowait((node_id, envelope))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def _subscribe(self) -> None:
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self._channel(self.node_id))
+
+    async def _publish(self) -> None:
+        delay = RETRY_DELAY
+        while True:
+            node_id, envelope = await self._outbox.get()
+            try:
+                if node_id is None:
+                    node_id = await self._redis.hget(
+                        self._keys[2], envelope["to"]
+                    )
+                    if not node_id or node_id == self.node_id:
+                        # Gone, or not attached where the registry says
+                        continue
+                await self._redis.publish(
+                    self._channel(node_id), json.dumps(envelope)
+                )
+            except Exception as ex:
+                self.failed += 1
+                print(f"Backplane publish failed: {ex}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+            else:
+                delay = RETRY_DELAY
+
+    async def _listen(self) -> None:
+        delay = RETRY_DELAY
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                async for message in self._pubsub.listen():
+                    delay = RETRY_DELAY
+                    self._receive(message["data"])
+            except Exception as ex:
+                self.failed += 1
+                print(f"Backplane subscription failed: {ex}")
+            pubsub, self._pubsub = self._pubsub, None
+            if pubsub is not None:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def _receive(self, data: str) -> None:
+        try:
+            envelope = json.loads(data)
+            client_id = envelope["to"]
+            op = envelope["op"]
+        except (ValueError, TypeError, KeyError) as ex:
+            print(f"Backplane dropped a malformed envelope: {ex}")
+            return
+        if op == "frame":
+            if self._deliver is not None:
+                frame = envelope["frame"]
+                if envelope.get("binary"):
+                    frame = base64.b64decode(frame)
+                self._deliver(client_id, frame)
+        elif op == "pair":
+            self._partners[client_id] = envelope["peer"]
+            self._locations[envelope["peer"]] = envelope["node"]
+            if self.on_pairing is not None:
+                self.on_pairing(client_id, True)
+        elif op == "unpair":
+            partner_id = self._partners.pop(client_id, None)
+            if partner_id is not None:
+                self._locations.pop(partner_id, None)
+            if self.on_pairing is not None:
+                self.on_pairing(client_id, False)
+        elif op == "suspended":
+            if self.on_suspended is not None:
+                self.on_suspended(client_id, envelope["peer"])
+
+
+def create_backplane(url: Optional[str] = None) -> Backplane:
+    """
+    Build the backplane configured by `BACKPLANE_URL`.
+
+    A `redis://` or `rediss://` URL selects `RedisBackplane`; anything else
+    keeps everything in this process. `MATCH_WIDEN_AFTER` sets how long
+    matching holds out for a shared interest.
+    """
+    url = url if url is not None else os.environ.get("BACKPLANE_URL", "")
+    widen_after = float(os.environ.get("MATCH_WIDEN_AFTER", WIDEN_AFTER))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackplane(url, widen_after=widen_after)
+    return InMemoryBackplane(
+        matchmaker=Matchmaker(widen_after=widen_after)
+    )
@@ -0,0 +1,52 @@
+"""
+Per-call overhead of resolving the collection on every call (validate, then
+`database[collection]`) against the handle bound at connect time.
+
+`find` builds its cursor without any I/O and the client is created with
+`connect=False`, so no server is needed:
+
+    python -m benchmarks.bench_collection_handles
+"""
+import time
+from typing import Any, Callable
+
+from db_connection import Database
+
+
+CALLS = 200_000
+
+
+def timed(label: str, func: Callable[[], Any]) -> float:
+    start_time = time.perf_counter()
+    for _ in range(CALLS):
+        func()
+    per_call = (time.perf_counter() - start_time) / CALLS
+    print(f"{label:<36} {per_call * 1e9:>8.0f} ns/call")
+    return per_call
+
+
+def main() -> None:
+    db = Database('mongodb://localhost:27017')
+    db.connect('benchmarks', 'connections', connect=False)
+    query = {'status': True}
+
+    def resolve_per_call() -> Any:
+        db._validate_connection()
+        return db.database[db.collection]
+
+    def bound() -> Any:
+        return db._collection
+
+    def find_per_call() -> Any:
+        return resolve_per_call().find(query)
+
+    before = timed("resolve per call", resolve_per_call)
+    after = timed("bound handle", bound)
+    print(f"{'saved per call':<36} {(before - after) * 1e9:>8.0f} ns")
+    timed("find() resolving per call", find_per_call)
+    timed("find() on bound handle", lambda: db.find(query))
+    db.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Throughput of the sync `Database` behind Starlette's threadpool against
+`AsyncDatabase` awaited on the event loop.
+
+Sync route handlers run in anyio's default thread limiter (40 threads), so
+that is what the sync path goes through here. Run from the backend
+directory, against a reachable mongod:
+
+    MONGODB_URI=mongodb://localhost:27017 python -m benchmarks.bench_database
+
+or against in-memory stand-ins, which leaves only the cost of the
+threadpool hop against the event loop:
+
+    python -m benchmarks.bench_database --mongo mock
+
+`--mongo mock` needs the mongomock and mongomock-motor packages.
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable
+
+from anyio import to_thread
+
+import db_connection
+from db_connection import AsyncDatabase, Database
+
+
+URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017')
+DATABASE_NAME = 'benchmarks'
+COLLECTION = 'connections'
+REQUESTS = 5_000
+CONCURRENCY = (1, 10, 100, 500)
+
+
+async def run(
+    concurrency: int,
+    request: Callable[[], Awaitable[object]]
+) -> float:
+    """
+    Issue `REQUESTS` requests with at most `concurrency` in flight and
+    return the requests per second.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one() -> None:
+        async with semaphore:
+            await request()
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(REQUESTS)))
+    return REQUESTS / (time.perf_counter() - start_time)
+
+
+def use_mock() -> None:
+    """
+    Point both clients of `db_connection` at in-memory stand-ins.
+    """
+    import mongomock
+    from mongomock_motor import AsyncMongoMockClient
+
+    db_connection.MongoClient = mongomock.MongoClient
+    db_connection.AsyncIOMotorClient = (
+        lambda uri, **options: AsyncMongoMockClient()
+    )
+
+
+async def main() -> None:
+    sync_db = Database(URI)
+    sync_db.connect(DATABASE_NAME, COLLECTION)
+    async_db = AsyncDatabase(URI)
+    async_db.connect(DATABASE_NAME, COLLECTION)
+
+    # The stand-ins do not share a store, so each path reads its own
+    sync_query = {
+        '_id': sync_db.insert_one({'status': False}).inserted_id
+    }
+    async_query = {
+        '_id': (await async_db.insert_one({'status': False})).inserted_id
+    }
+
+    async def sync_find_one() -> object:
+        return await to_thread.run_sync(sync_db.find_one, sync_query)
+
+    async def async_find_one() -> object:
+        return await async_db.find_one(async_query)
+
+    async def sync_insert_one() -> object:
+        return await to_thread.run_sync(sync_db.insert_one, {'status': False})
+
+    async def async_insert_one() -> object:
+        return await async_db.insert_one({'status': False})
+
+    print(f"{'operation':<12} {'in flight':>9} {'sync req/s':>11} "
+          f"{'async req/s':>12}")
+    for name, sync_request, async_request in (
+        ('find_one', sync_find_one, async_find_one),
+        ('insert_one', sync_insert_one, async_insert_one),
+    ):
+        for concurrency in CONCURRENCY:
+            sync_rate = await run(concurrency, sync_request)
+            async_rate = await run(concurrency, async_request)
+            print(f"{name:<12} {concurrency:>9} {sync_rate:>11.0f} "
+                  f"{async_rate:>12.0f}")
+
+    sync_db.database.drop_collection(COLLECTION)
+    sync_db.disconnect()
+    async_db.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mongo", choices=("mock", "uri"), default="uri")
+    if parser.parse_args().mongo == "mock":
+        use_mock()
+    asyncio.run(main())
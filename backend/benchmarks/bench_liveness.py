@@ -0,0 +1,68 @@
+"""
+Cost of heartbeat bookkeeping at 100k connections: touching a connection
+on every received frame, and a heap pass that pings every connection.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_liveness
+"""
+import asyncio
+import time
+from typing import List
+
+from liveness import LivenessMonitor
+from registry import ConnectionRecord, ConnectionRegistry
+from signaling import SignalingRouter
+
+
+CONNECTIONS = 100_000
+
+
+class NullWebSocket:
+    """
+    Accepts frames and throws them away.
+    """
+
+    async def send_text(self, data: str) -> None:
+        return None
+
+    async def close(self, code: int = 1000) -> None:
+        return None
+
+
+async def forget(client_id: str) -> None:
+    return None
+
+
+async def main() -> None:
+    router = SignalingRouter(ConnectionRegistry(), outbox_size=4)
+    monitor = LivenessMonitor(
+        router, forget, ping_interval=15.0, idle_timeout=45.0
+    )
+    records: List[ConnectionRecord] = [
+        router.attach(NullWebSocket()) for _ in range(CONNECTIONS)
+    ]
+    for record in records:
+        monitor.watch(record)
+
+    start_time = time.perf_counter()
+    for record in records:
+        monitor.touch(record)
+    elapsed = time.perf_counter() - start_time
+    print(f"{'touch':<28} {elapsed * 1e9 / CONNECTIONS:>10.0f} ns/op")
+
+    # Every connection has been silent for a ping interval
+    start_time = time.perf_counter()
+    monitor.check_due(time.monotonic() + 20.0)
+    elapsed = time.perf_counter() - start_time
+    print(f"{'ping pass':<28} {elapsed * 1e9 / CONNECTIONS:>10.0f} ns/op")
+    print(f"{'pings sent':<28} {monitor.pings:>10}")
+    print(f"{'heap entries':<28} {len(monitor):>10}")
+
+    for record in records:
+        router.detach(record.client_id)
+    await monitor.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+"""
+Cost of a match attempt as the number of waiting clients grows, with
+region and interest buckets.
+
+Every round queues `waiting` clients spread over regions and tags that
+rarely overlap, then times joins that find a partner and joins that have
+to wait, and a `widen` pass once everybody's search has widened.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_matchmaking
+"""
+import random
+import time
+from typing import List
+
+from matchmaking import Matchmaker, Preferences
+
+
+WAITING_COUNTS = (1_000, 10_000, 100_000)
+JOINS = 10_000
+REGIONS = ("eu", "us", "in", "br", "jp", "au")
+TAGS = tuple(f"tag{i}" for i in range(2_000))
+
+
+def preferences(rng: random.Random) -> Preferences:
+    return Preferences(
+        rng.choice(REGIONS),
+        frozenset(rng.sample(TAGS, rng.randint(0, 3)))
+    )
+
+
+def main() -> None:
+    print(
+        f"{'waiting':>8} {'join us':>9} {'widen us/pair':>14} "
+        f"{'buckets':>8}"
+    )
+    for waiting in WAITING_COUNTS:
+        rng = random.Random(waiting)
+        now = [0.0]
+        matchmaker = Matchmaker(widen_after=5.0, clock=lambda: now[0])
+        for i in range(waiting):
+            matchmaker.join(f"w{i}", preferences(rng))
+        buckets = matchmaker.bucket_count
+
+        joiners: List[Preferences] = [preferences(rng) for _ in range(JOINS)]
+        start_time = time.perf_counter()
+        for i, joiner in enumerate(joiners):
+            matchmaker.join(f"j{i}", joiner)
+        join_time = (time.perf_counter() - start_time) / JOINS
+
+        now[0] = 20.0
+        start_time = time.perf_counter()
+        pairs = matchmaker.widen()
+        widen_time = (time.perf_counter() - start_time) / max(1, len(pairs))
+
+        print(
+            f"{waiting:>8} {join_time * 1e6:>9.2f} "
+            f"{widen_time * 1e6:>14.2f} {buckets:>8}"
+        )
+
+
+if __name__ == '__main__':
+    main()
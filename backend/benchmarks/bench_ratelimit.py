@@ -0,0 +1,55 @@
+"""
+Per-frame cost and per-connection memory of the signaling rate limiter.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_ratelimit
+"""
+import time
+import tracemalloc
+from typing import List
+
+from ratelimit import RateLimiter
+from registry import ConnectionRecord
+
+
+CONNECTIONS = 50_000
+FRAMES = 200_000
+KINDS = ("candidate", "candidate", "candidate", "offer", "answer", "chat")
+
+
+def main() -> None:
+    limiter = RateLimiter()
+    records: List[ConnectionRecord] = [
+        ConnectionRecord(str(i), None) for i in range(CONNECTIONS)
+    ]
+
+    start_time = time.perf_counter()
+    for i in range(FRAMES):
+        limiter.allow(records[i % CONNECTIONS], KINDS[i % len(KINDS)])
+    elapsed = time.perf_counter() - start_time
+    print(f"{'allow':<28} {elapsed * 1e9 / FRAMES:>10.0f} ns/op")
+
+    # A flooding connection: everything past the burst is throttled
+    flooder = ConnectionRecord("flooder", None)
+    start_time = time.perf_counter()
+    for _ in range(FRAMES):
+        limiter.allow(flooder, "candidate")
+    elapsed = time.perf_counter() - start_time
+    print(f"{'allow, throttled':<28} {elapsed * 1e9 / FRAMES:>10.0f} ns/op")
+    print(f"{'throttled':<28} {sum(limiter.throttled.values()):>10}")
+
+    fresh: List[ConnectionRecord] = [
+        ConnectionRecord(str(i), None) for i in range(CONNECTIONS)
+    ]
+    tracemalloc.start()
+    for record in fresh:
+        for kind in KINDS:
+            limiter.allow(record, kind)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{'bucket bytes/connection':<28} {size / CONNECTIONS:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Register, lookup and unregister cost of the connection registry at 100k
+connections, against the old `generate_unique_id` + dict approach.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_registry
+"""
+import random
+import string
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from registry import ConnectionRegistry
+
+
+CONNECTIONS = 100_000
+
+
+def generate_unique_id(length=3):
+    chars = string.ascii_letters + string.digits
+    return ''.join(random.choice(chars) for _ in range(length))
+
+
+def timed(label: str, count: int, func: Callable[[], None]) -> None:
+    start_time = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start_time
+    print(f"{label:<28} {elapsed * 1e9 / count:>10.0f} ns/op")
+
+
+def baseline() -> None:
+    clients: Dict[str, object] = {}
+    ids: List[str] = []
+
+    def register() -> None:
+        for _ in range(CONNECTIONS):
+            client_id = generate_unique_id()
+            clients[client_id] = object()
+            ids.append(client_id)
+
+    def lookup() -> None:
+        for client_id in ids:
+            clients.get(client_id)
+
+    def unregister() -> None:
+        for client_id in ids:
+            clients.pop(client_id, None)
+
+    timed("baseline register", CONNECTIONS, register)
+    print(f"{'baseline collisions':<28} {CONNECTIONS - len(clients):>10}")
+    timed("baseline lookup", CONNECTIONS, lookup)
+    timed("baseline unregister", CONNECTIONS, unregister)
+
+
+def registry() -> None:
+    connections = ConnectionRegistry()
+    ids: List[str] = []
+
+    def register() -> None:
+        for _ in range(CONNECTIONS):
+            ids.append(connections.register(object()).client_id)
+
+    def lookup() -> None:
+        for client_id in ids:
+            connections.get(client_id)
+
+    def unregister() -> None:
+        for client_id in ids:
+            connections.unregister(client_id)
+
+    timed("registry register", CONNECTIONS, register)
+    timed("registry lookup", CONNECTIONS, lookup)
+    timed("registry unregister", CONNECTIONS, unregister)
+
+    # Memory is measured on a separate run, tracing slows allocation down
+    tracemalloc.start()
+    for _ in range(CONNECTIONS):
+        connections.register(object())
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{'registry bytes/connection':<28} {size / CONNECTIONS:>10.0f}")
+
+
+if __name__ == '__main__':
+    baseline()
+    registry()
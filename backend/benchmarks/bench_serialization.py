@@ -0,0 +1,90 @@
+"""
+Serialization cost of the list/show endpoints and of signaling frames.
+
+Compares FastAPI's default path (validate into the response model,
+`jsonable_encoder`, `json.dumps`) with the cached TypeAdapters that dump
+raw BSON documents straight to bytes, and the standard library against
+orjson and the compact binary protocol for websocket frames. No server is
+needed:
+
+    python -m benchmarks.bench_serialization
+"""
+import json
+import time
+from typing import Any, Callable, Dict, List
+
+from bson.objectid import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from models import ConnectionCollection, ConnectionModel, get_current_date
+from protocol import TYPE_CODES, encode_frame, readdress
+from serialization import dump_collection, dump_connection, frame_codec
+
+
+PAGE_SIZE = 100
+ROUNDS = 2_000
+
+OFFER = {
+    "type": "offer",
+    "offer": {"type": "offer", "sdp": "v=0\r\n" + "a=candidate:x\r\n" * 40},
+}
+
+
+def rate(label: str, unit: str, count: int, func: Callable[[], Any]) -> None:
+    start_time = time.perf_counter()
+    for _ in range(count):
+        func()
+    per_second = count / (time.perf_counter() - start_time)
+    print(f"{label:<34} {per_second:>12.0f} {unit}/s")
+
+
+def documents(count: int) -> List[Dict[str, Any]]:
+    now = get_current_date()
+    return [
+        {"_id": ObjectId(), "status": False, "created_at": now,
+         "updated_at": now}
+        for _ in range(count)
+    ]
+
+
+def main() -> None:
+    page = documents(PAGE_SIZE)
+    document = page[0]
+
+    def default_show() -> bytes:
+        model = ConnectionModel.model_validate(document)
+        return json.dumps(jsonable_encoder(model)).encode()
+
+    def default_list() -> bytes:
+        model = ConnectionCollection(connections=page)
+        return json.dumps(jsonable_encoder(model)).encode()
+
+    rate("show, default encoder", "responses", ROUNDS * 10, default_show)
+    rate("show, TypeAdapter", "responses", ROUNDS * 10,
+         lambda: dump_connection(document))
+    rate("list of 100, default encoder", "responses", ROUNDS, default_list)
+    rate("list of 100, TypeAdapter", "responses", ROUNDS,
+         lambda: dump_collection(page))
+    rate("get_current_date", "calls", ROUNDS * 50, get_current_date)
+
+    for name in ("json", "orjson"):
+        loads, dumps = frame_codec(name)
+        data = dumps(OFFER)
+
+        def relay() -> str:
+            message = loads(data)
+            message["peer_id"] = "rlD1VafwE8"
+            return dumps(message)
+
+        rate(f"frames, {name}", "frames", ROUNDS * 50, relay)
+
+    # The payload is opaque to the server, its encoding does not matter
+    frame = encode_frame(
+        TYPE_CODES["offer"], "", json.dumps(OFFER["offer"]).encode()
+    )
+    rate("frames, compact", "frames", ROUNDS * 50,
+         lambda: readdress(frame, "rlD1VafwE8"))
+
+
+if __name__ == '__main__':
+    main()
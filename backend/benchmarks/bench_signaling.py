@@ -0,0 +1,88 @@
+"""
+Per-message cost of relaying signaling frames as the number of connected
+clients grows.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_signaling
+"""
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+from registry import ConnectionRegistry
+from signaling import SignalingRouter
+
+
+MESSAGES = 20_000
+CLIENT_COUNTS = (10, 100, 1_000, 10_000)
+
+CANDIDATE = {
+    "type": "candidate",
+    "candidate": {
+        "candidate": "candidate:1 1 udp 2122260223 192.168.1.2 54321 typ host",
+        "sdpMid": "0",
+        "sdpMLineIndex": 0,
+    },
+}
+
+
+class NullWebSocket:
+    """
+    Accepts frames and throws them away.
+    """
+
+    async def send_text(self, data: str) -> None:
+        return None
+
+
+async def broadcast_baseline(clients: Dict[str, NullWebSocket]) -> float:
+    """
+    The original fan-out: serialize and await a send for every other client.
+    """
+    sender_id = next(iter(clients))
+    messages = max(1, MESSAGES // len(clients))
+    start_time = time.perf_counter()
+    for _ in range(messages):
+        data_json = dict(CANDIDATE)
+        data_json["peer_id"] = sender_id
+        for other_id, other_websocket in clients.items():
+            if other_id != sender_id:
+                await other_websocket.send_text(json.dumps(data_json))
+    return (time.perf_counter() - start_time) / messages
+
+
+async def routed(client_count: int) -> float:
+    """
+    Relay to the partner only through the router's outbound queues.
+    """
+    router = SignalingRouter(ConnectionRegistry(), outbox_size=MESSAGES)
+    ids: List[str] = [
+        router.attach(NullWebSocket()).client_id for _ in range(client_count)
+    ]
+    start_time = time.perf_counter()
+    for _ in range(MESSAGES):
+        router.relay(ids[0], ids[1], dict(CANDIDATE))
+    # Let the writer task flush the partner's queue
+    await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start_time
+    for client_id in ids:
+        router.detach(client_id)
+    return elapsed / MESSAGES
+
+
+async def main() -> None:
+    print(f"{'clients':>8} {'broadcast us/msg':>18} {'routed us/msg':>15}")
+    for client_count in CLIENT_COUNTS:
+        clients = {str(i): NullWebSocket() for i in range(client_count)}
+        baseline = await broadcast_baseline(clients)
+        per_message = await routed(client_count)
+        print(
+            f"{client_count:>8} {baseline * 1e6:>18.2f} "
+            f"{per_message * 1e6:>15.2f}"
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+"""
+Skip-to-new-partner latency of the matchmaker with thousands of users
+paired and a pool waiting.
+
+Each skip breaks a pair, remembers it, and requeues both sides, which
+pick up the next waiting strangers. The end-to-end number over /ws is
+reported by the load test.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_skip
+"""
+import random
+import statistics
+import time
+from typing import List
+
+from matchmaking import Matchmaker
+
+
+USER_COUNTS = (1_000, 10_000, 100_000)
+SKIPS = 20_000
+
+
+def run(users: int) -> List[float]:
+    matchmaker = Matchmaker()
+    ids = [f"u{i}" for i in range(users)]
+    for client_id in ids:
+        matchmaker.join(client_id)
+    rng = random.Random(users)
+    latencies: List[float] = []
+    for _ in range(SKIPS):
+        client_id = rng.choice(ids)
+        start_time = time.perf_counter()
+        partner_id = matchmaker.skip(client_id)
+        if partner_id is None:
+            # Waiting, not paired; nothing to skip
+            continue
+        matchmaker.join(client_id)
+        matchmaker.join(partner_id)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def main() -> None:
+    print(f"{'users':>8} {'skips':>7} {'p50 us':>8} {'p99 us':>8}")
+    for users in USER_COUNTS:
+        latencies = run(users)
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"{users:>8} {len(latencies):>7} {quantiles[49] * 1e6:>8.2f} "
+            f"{quantiles[98] * 1e6:>8.2f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
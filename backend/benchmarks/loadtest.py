@@ -0,0 +1,466 @@
+"""
+Load test of /ws and the /connections routes with simulated clients.
+
+Starts the app under uvicorn in a child process (or targets `--url`) and
+drives `--clients` concurrent asyncio websocket clients through
+join -> match -> offer/answer -> ICE candidates -> skip or leave cycles,
+then runs create/get/update/list/delete traffic against /connections.
+The results (match, answer and skip latency percentiles, frames/s, server
+CPU and RSS per 1k connections, REST throughput) are printed and, with
+`--output`, written as JSON; `--compare` prints the change against an
+earlier JSON report.
+
+Run from the backend directory:
+
+    python -m benchmarks.loadtest --clients 2000 --output run.json
+    python -m benchmarks.loadtest --clients 2000 --compare run.json
+
+The REST phase needs httpx, and the default `--mongo mock` stand-in needs
+mongomock-motor. The stand-in scans its documents on every query, so REST
+numbers are only comparable between runs with the same `--rest-requests`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - httpx is optional
+    httpx = None
+
+
+SDP = "v=0\r\n" + (
+    "a=candidate:1 1 udp 2122260223 10.0.0.1 5000 typ host\r\n" * 40
+)
+CANDIDATE = {
+    "candidate": "candidate:1 1 udp 2122260223 192.168.1.2 54321 typ host",
+    "sdpMid": "0",
+    "sdpMLineIndex": 0,
+}
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Return p50/p90/p99/max of latencies in seconds, in milliseconds.
+    """
+    if not samples:
+        return {"count": 0, "p50": None, "p90": None, "p99": None,
+                "max": None}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        index = min(len(ordered) - 1, int(fraction * len(ordered)))
+        return round(ordered[index] * 1000, 3)
+
+    return {"count": len(ordered), "p50": at(0.50), "p90": at(0.90),
+            "p99": at(0.99), "max": round(ordered[-1] * 1000, 3)}
+
+
+class ProcessStats:
+    """
+    CPU time and resident memory of a process, read from /proc.
+    """
+
+    def __init__(self, pid: Optional[int]) -> None:
+        self.pid: Optional[int] = pid
+        self.ticks: int = os.sysconf("SC_CLK_TCK") if pid else 100
+
+    def cpu_seconds(self) -> Optional[float]:
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime, fields 14 and 15 of the whole line
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def rss_bytes(self) -> Optional[int]:
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+        return None
+
+
+class Results:
+    """
+    Counters and latency samples shared by every simulated client.
+    """
+
+    def __init__(self) -> None:
+        self.match_latency: List[float] = []
+        self.answer_latency: List[float] = []
+        self.skip_latency: List[float] = []
+        self.frames_sent: int = 0
+        self.frames_received: int = 0
+        self.calls: int = 0
+        self.connect_errors: int = 0
+        self.disconnects: int = 0
+
+
+class SimulatedClient:
+    """
+    One browser tab: waits for a stranger, negotiates a call and trickles
+    candidates, then skips to the next stranger or leaves.
+
+    The side that was waiting when the match was made sends the offer, the
+    side that joined answers.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        results: Results,
+        cycles: int,
+        candidates: int
+    ) -> None:
+        self.url: str = url
+        self.results: Results = results
+        self.cycles: int = cycles
+        self.candidates: int = candidates
+        self.websocket: Any = None
+        self._reset(time.perf_counter())
+
+    def _reset(self, now: float) -> None:
+        self.peer_id: Optional[str] = None
+        self.offerer: bool = False
+        self.looking_since: float = now
+        self.skipped_at: Optional[float] = None
+        self.offered_at: Optional[float] = None
+        self.sent_candidates: int = 0
+        self.received_candidates: int = 0
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        await self.websocket.send(json.dumps(message))
+        self.results.frames_sent += 1
+
+    async def trickle(self) -> None:
+        for _ in range(self.candidates):
+            await self.send({"type": "candidate", "candidate": CANDIDATE})
+        self.sent_candidates = self.candidates
+
+    async def run(self, connected: asyncio.Event) -> None:
+        try:
+            self.websocket = await websockets.connect(
+                self.url, open_timeout=30, max_queue=None
+            )
+        except Exception:
+            self.results.connect_errors += 1
+            return
+        finally:
+            connected.set()
+        self._reset(time.perf_counter())
+        try:
+            async for data in self.websocket:
+                self.results.frames_received += 1
+                if await self.handle(json.loads(data)):
+                    break
+        except websockets.ConnectionClosed:
+            self.results.disconnects += 1
+        finally:
+            await self.websocket.close()
+
+    async def handle(self, message: Dict[str, Any]) -> bool:
+        """
+        React to a server message. Returns True once the client is done.
+        """
+        kind = message.get("type")
+        now = time.perf_counter()
+        if kind == "waiting":
+            self.offerer = True
+        elif kind == "matched":
+            self.results.match_latency.append(now - self.looking_since)
+            if self.skipped_at is not None:
+                self.results.skip_latency.append(now - self.skipped_at)
+            offerer = self.offerer
+            self._reset(now)
+            self.peer_id = message["peer_id"]
+            self.offerer = offerer
+            if offerer:
+                self.offered_at = now
+                await self.send({"type": "offer",
+                                 "offer": {"type": "offer", "sdp": SDP}})
+                await self.trickle()
+        elif kind == "offer":
+            await self.send({"type": "answer",
+                             "answer": {"type": "answer", "sdp": SDP}})
+            await self.trickle()
+        elif kind == "answer":
+            if self.offered_at is not None:
+                self.results.answer_latency.append(now - self.offered_at)
+        elif kind == "candidate":
+            self.received_candidates += 1
+        elif kind == "candidates":
+            self.received_candidates += len(message["candidates"])
+        elif kind == "partner_left":
+            self._reset(now)
+        elif kind == "ping":
+            await self.send({"type": "pong"})
+
+        if (
+            self.peer_id is not None
+            and self.sent_candidates == self.candidates
+            and self.received_candidates >= self.candidates
+        ):
+            # Call set up on both sides
+            self.results.calls += 1
+            self.cycles -= 1
+            if self.cycles <= 0:
+                return True
+            if self.offerer:
+                self._reset(now)
+                self.skipped_at = now
+                await self.send({"type": "skip"})
+            else:
+                # Wait for the offerer to skip or leave
+                self.peer_id = None
+        return False
+
+
+async def run_websockets(
+    url: str,
+    args: argparse.Namespace,
+    server: ProcessStats
+) -> Dict[str, Any]:
+    results = Results()
+    clients = [
+        SimulatedClient(url, results, args.cycles, args.candidates)
+        for _ in range(args.clients)
+    ]
+    cpu_before = server.cpu_seconds()
+    rss_before = server.rss_bytes()
+    start_time = time.perf_counter()
+
+    # Ramp up in batches so the accept queue is not flooded
+    tasks: List[asyncio.Task] = []
+    for start in range(0, len(clients), args.ramp):
+        events = []
+        for client in clients[start:start + args.ramp]:
+            connected = asyncio.Event()
+            events.append(connected)
+            tasks.append(asyncio.create_task(client.run(connected)))
+        await asyncio.gather(*(event.wait() for event in events))
+    rss_peak = server.rss_bytes()
+
+    done, pending = await asyncio.wait(tasks, timeout=args.duration)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    elapsed = time.perf_counter() - start_time
+    cpu_after = server.cpu_seconds()
+
+    per_thousand = max(args.clients, 1) / 1000
+    report: Dict[str, Any] = {
+        "clients": args.clients,
+        "completed_clients": len(done),
+        "unfinished_clients": len(pending),
+        "connect_errors": results.connect_errors,
+        "disconnects": results.disconnects,
+        "calls": results.calls,
+        "elapsed_s": round(elapsed, 3),
+        "frames_sent": results.frames_sent,
+        "frames_received": results.frames_received,
+        "frames_per_s": round(
+            (results.frames_sent + results.frames_received) / elapsed, 1
+        ),
+        "match_latency_ms": percentiles(results.match_latency),
+        "answer_latency_ms": percentiles(results.answer_latency),
+        "skip_latency_ms": percentiles(results.skip_latency),
+    }
+    if cpu_before is not None and cpu_after is not None:
+        report["server_cpu_s_per_1k"] = round(
+            (cpu_after - cpu_before) / per_thousand, 3
+        )
+    if rss_before is not None and rss_peak is not None:
+        report["server_rss_mb"] = round(rss_peak / 2**20, 1)
+        report["server_rss_mb_per_1k"] = round(
+            (rss_peak - rss_before) / 2**20 / per_thousand, 2
+        )
+    return report
+
+
+async def run_rest(base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    if httpx is None:
+        return {"skipped": "httpx is not installed"}
+    limits = httpx.Limits(max_connections=args.rest_concurrency)
+    report: Dict[str, Any] = {}
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=30) as client:
+
+        async def phase(name: str, requests: List[Any]) -> List[Any]:
+            queue: asyncio.Queue = asyncio.Queue()
+            for request in requests:
+                queue.put_nowait(request)
+            responses: List[Any] = []
+            errors = 0
+
+            async def worker() -> None:
+                nonlocal errors
+                while not queue.empty():
+                    method, path, body = queue.get_nowait()
+                    try:
+                        response = await client.request(
+                            method, path, json=body
+                        )
+                    except httpx.HTTPError:
+                        errors += 1
+                        continue
+                    if response.status_code >= 400:
+                        errors += 1
+                    responses.append(response)
+
+            start_time = time.perf_counter()
+            await asyncio.gather(
+                *(worker() for _ in range(args.rest_concurrency))
+            )
+            elapsed = time.perf_counter() - start_time
+            report[name] = {
+                "requests": len(requests),
+                "errors": errors,
+                "requests_per_s": round(len(requests) / elapsed, 1),
+            }
+            return responses
+
+        created = await phase("create", [
+            ("POST", "/connections/", {"status": False})
+            for _ in range(args.rest_requests)
+        ])
+        ids = [
+            response.json()["id"] for response in created
+            if response.status_code == 201
+        ]
+        await phase("get", [("GET", f"/connections/{id}", None) for id in ids])
+        await phase("update", [
+            ("PUT", f"/connections/{id}", {"status": True}) for id in ids
+        ])
+        await phase("list", [
+            ("GET", "/connections/?limit=100", None)
+            for _ in range(max(1, args.rest_requests // 10))
+        ])
+        await phase("delete", [
+            ("DELETE", f"/connections/{id}", None) for id in ids
+        ])
+    return report
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_ready(base_url: str, timeout: float = 30.0) -> None:
+    host, port = base_url.split("//")[1].split(":")
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, int(port))
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """
+    Print the relative change of the headline numbers against a baseline.
+    """
+    keys = [
+        ("websocket", "frames_per_s"),
+        ("websocket", "server_cpu_s_per_1k"),
+        ("websocket", "server_rss_mb_per_1k"),
+        ("websocket", "match_latency_ms", "p99"),
+        ("websocket", "skip_latency_ms", "p99"),
+        ("rest", "create", "requests_per_s"),
+        ("rest", "get", "requests_per_s"),
+        ("rest", "list", "requests_per_s"),
+    ]
+    for path in keys:
+        new, old = report, baseline
+        for key in path:
+            new = new.get(key, {}) if isinstance(new, dict) else None
+            old = old.get(key, {}) if isinstance(old, dict) else None
+        if not isinstance(new, (int, float)) or not old:
+            continue
+        change = (new - old) / old * 100
+        print(f"{'.'.join(path):<40} {old:>12} -> {new:>12} {change:>+7.1f}%")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="Base URL of a running server")
+    parser.add_argument("--mongo", choices=("mock", "uri"), default="mock")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--cycles", type=int, default=3,
+                        help="Calls per client, skipping between them")
+    parser.add_argument("--candidates", type=int, default=10,
+                        help="ICE candidates each side trickles per call")
+    parser.add_argument("--batch", action="store_true",
+                        help="Take candidates in batched frames")
+    parser.add_argument("--ramp", type=int, default=200,
+                        help="Connections opened at once")
+    parser.add_argument("--duration", type=float, default=120.0,
+                        help="Give up on clients still running after this")
+    parser.add_argument("--rest-requests", type=int, default=1000)
+    parser.add_argument("--rest-concurrency", type=int, default=50)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="JSON report to compare against")
+    args = parser.parse_args()
+
+    process = None
+    base_url = args.url
+    if base_url is None:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        process = subprocess.Popen([
+            sys.executable, "-m", "benchmarks.serve",
+            "--port", str(port), "--mongo", args.mongo,
+        ])
+    server = ProcessStats(process.pid if process is not None else None)
+    try:
+        await wait_until_ready(base_url)
+        ws_url = base_url.replace("http", "ws", 1) + "/ws"
+        if args.batch:
+            ws_url += "?batch=1"
+        report = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "config": {
+                key: value for key, value in vars(args).items()
+                if key not in ("output", "compare")
+            },
+            "websocket": await run_websockets(ws_url, args, server),
+            "rest": await run_rest(base_url, args),
+        }
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(report, json.load(baseline))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+"""
+Run the app under uvicorn for load tests, optionally against an
+in-memory MongoDB stand-in.
+
+Run from the backend directory:
+
+    python -m benchmarks.serve --port 8000 --mongo mock
+
+`--mongo mock` needs the mongomock-motor package; `--mongo uri` uses
+`MONGODB_URI` like a normal deployment.
+"""
+import argparse
+import os
+
+import uvicorn
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--mongo", choices=("mock", "uri"), default="mock")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_NAME", "loadtest")
+    if args.mongo == "mock":
+        from mongomock_motor import AsyncMongoMockClient
+
+        import db_connection
+
+        os.environ.setdefault("MONGODB_URI", "mongodb://stand-in")
+        db_connection.AsyncIOMotorClient = (
+            lambda uri, **options: AsyncMongoMockClient()
+        )
+    # The app mounts ./static, which is not part of the repository
+    os.makedirs("static", exist_ok=True)
+
+    from main import app
+
+    uvicorn.run(
+        app, host=args.host, port=args.port, log_level="warning",
+        # The load test opens connections faster than the default backlog
+        backlog=4096
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+Read-through cache for connection records
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import bson
+from bson.objectid import ObjectId
+from pymongo import results
+
+from db_connection import AsyncDatabase
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - redis is optional
+    aioredis = None
+
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 2.0) -> None:
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Any) -> Any:
+        """
+        Return the cached value, or `MISSING`.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Any, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Any) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class RedisCache:
+    """
+    Cache shared by all workers, storing BSON encoded documents in Redis.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        ttl: float = 30.0,
+        prefix: str = "omegle:cache"
+    ) -> None:
+        if aioredis is None:
+            raise RuntimeError("The redis package is required for RedisCache.")
+        self.ttl: float = ttl
+        self.prefix: str = prefix
+        self._redis = aioredis.from_url(url)
+
+    def _key(self, key: Any) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def get(self, key: Any) -> Any:
+        data = await self._redis.get(self._key(key))
+        return MISSING if data is None else bson.decode(data)
+
+    async def set(self, key: Any, value: Dict[str, Any]) -> None:
+        await self._redis.set(
+            self._key(key), bson.encode(value), px=int(self.ttl * 1000)
+        )
+
+    async def invalidate(self, *keys: Any) -> None:
+        if keys:
+            await self._redis.delete(*(self._key(key) for key in keys))
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+class ReadThroughCache:
+    """
+    Caches `find_one` by `_id` in front of an `AsyncDatabase`.
+
+    Reads check the local LRU, then the optional shared cache, then MongoDB.
+    Concurrent misses for the same id share one database read. Writes made
+    through this class invalidate the entry; writes made elsewhere must call
+    `invalidate`. Other workers' local entries are only bounded by the TTL,
+    so keep it short.
+    """
+
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        local: Optional[TTLCache] = None,
+        shared: Optional[RedisCache] = None
+    ) -> None:
+        self.db: AsyncDatabase = db
+        self.local: TTLCache = local or TTLCache()
+        self.shared: Optional[RedisCache] = shared
+        self._loading: Dict[ObjectId, asyncio.Future] = {}
+        # Bumped on every invalidation so that a read started before it
+        # does not store a stale document
+        self._generation: int = 0
+        self.shared_hits: int = 0
+
+    async def find_one(
+        self,
+        document_id: ObjectId
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Return the document with the given `_id`, or None.
+        """
+        document = self.local.get(document_id)
+        if document is not MISSING:
+            return document
+        loading = self._loading.get(document_id)
+        if loading is not None:
+            try:
+                return await asyncio.shield(loading)
+            except asyncio.CancelledError:
+                if not loading.cancelled():
+                    raise
+                # The leading read was cancelled, not this one: load again
+                return await self.find_one(document_id)
+
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[document_id] = loading
+        try:
+            document = await self._load(document_id)
+        except Exception as ex:
+            loading.set_exception(ex)
+            # Consumed here if nobody else was waiting
+            loading.exception()
+            raise
+        else:
+            loading.set_result(document)
+            return document
+        finally:
+            # Cancelled while loading: release the followers
+            if not loading.done():
+                loading.cancel()
+            del self._loading[document_id]
+
+    async def _load(self, document_id: ObjectId) -> Optional[Dict[str, Any]]:
+        generation = self._generation
+        if self.shared is not None:
+            document = await self.shared.get(document_id)
+            if document is not MISSING:
+                self.shared_hits += 1
+                if generation == self._generation:
+                    self.local.set(document_id, document)
+                return document
+        document = await self.db.find_one({"_id": document_id})
+        if document is not None and generation == self._generation:
+            self.local.set(document_id, document)
+            if self.shared is not None:
+                await self.shared.set(document_id, document)
+        return document
+
+    async def invalidate(self, *document_ids: ObjectId) -> None:
+        """
+        Drop documents from the local and the shared cache.
+        """
+        self._generation += 1
+        for document_id in document_ids:
+            self.local.invalidate(document_id)
+        if self.shared is not None:
+            await self.shared.invalidate(*document_ids)
+
+    async def find_one_and_update(
+        self,
+        document_id: ObjectId,
+        data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Update a document by `_id` and return it after the update.
+        """
+        try:
+            return await self.db.find_one_and_update(
+                {"_id": document_id}, data
+            )
+        finally:
+            await self.invalidate(document_id)
+
+    async def update_one(
+        self,
+        document_id: ObjectId,
+        data: Dict[str, Any]
+    ) -> results.UpdateResult:
+        """
+        Update a document by `_id`.
+        """
+        try:
+            return await self.db.update_one({"_id": document_id}, data)
+        finally:
+            await self.invalidate(document_id)
+
+    async def delete_one(self, document_id: ObjectId) -> results.DeleteResult:
+        """
+        Delete a document by `_id`.
+        """
+        try:
+            return await self.db.delete_one({"_id": document_id})
+        finally:
+            await self.invalidate(document_id)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the hit, miss and eviction counters.
+        """
+        return {
+            "size": len(self.local),
+            "hits": self.local.hits,
+            "misses": self.local.misses,
+            "shared_hits": self.shared_hits,
+            "evictions": self.local.evictions,
+            "expirations": self.local.expirations,
+        }
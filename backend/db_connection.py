@@ -1,21 +1,109 @@
 """
 MongoDB connection setup
 """
-from typing import Any, Dict, List, Optional, Union
-
-from pymongo import MongoClient, results
+import asyncio
+import copy
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import bson
+from bson.codec_options import DEFAULT_CODEC_OPTIONS, CodecOptions
+from pymongo import IndexModel, MongoClient, ReturnDocument, results
+from pymongo.errors import OperationFailure
+from pymongo.operations import InsertOne, UpdateOne
+from pymongo.collection import Collection
 from pymongo.database import Database as MongoDBDatabase
 from pymongo.cursor import Cursor
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorCursor,
+    AsyncIOMotorDatabase
+)
 # from bson.json_util import dumps
 # from bson.objectid import ObjectId
 
 import os
 from dotenv import load_dotenv
 
+from metrics import MONGODB_LATENCY
 from utils import calculate_running_time
 
 load_dotenv()  # take environment variables from .env.
 
+# Server error codes for an index that exists with different options
+INDEX_CONFLICT_CODES = (85, 86)
+
+
+def pool_options_from_env() -> Dict[str, Any]:
+    """
+    Read the client pool sizing and timeouts from the environment.
+
+    `maxConnecting` caps how many connections are being opened at once,
+    which keeps restarting workers from flooding the server.
+    """
+    return {
+        "maxPoolSize": int(os.environ.get("MONGODB_MAX_POOL_SIZE", 100)),
+        "minPoolSize": int(os.environ.get("MONGODB_MIN_POOL_SIZE", 10)),
+        "maxConnecting": int(os.environ.get("MONGODB_MAX_CONNECTING", 2)),
+        "maxIdleTimeMS": int(
+            os.environ.get("MONGODB_MAX_IDLE_TIME_MS", 300_000)
+        ),
+        "connectTimeoutMS": int(
+            os.environ.get("MONGODB_CONNECT_TIMEOUT_MS", 5_000)
+        ),
+        "serverSelectionTimeoutMS": int(
+            os.environ.get("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5_000)
+        ),
+        "waitQueueTimeoutMS": int(
+            os.environ.get("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 2_000)
+        ),
+    }
+
+
+def ttl_update_command(
+    collection: str,
+    index: IndexModel
+) -> Optional[Dict[str, Any]]:
+    """
+    Return the `collMod` command that sets the TTL of an existing index,
+    or None if the index has no TTL.
+    """
+    document = index.document
+    if "expireAfterSeconds" not in document:
+        return None
+    return {
+        "collMod": collection,
+        "index": {
+            "keyPattern": dict(document["key"]),
+            "expireAfterSeconds": document["expireAfterSeconds"],
+        },
+    }
+
+
+def as_stored(document: Dict[str, Any], codec_options: Any) -> Dict[str, Any]:
+    """
+    Return a document as a read would: datetimes in UTC truncated to
+    milliseconds, decoded with the collection's codec options.
+    """
+    if not isinstance(codec_options, CodecOptions):
+        # mongomock has a CodecOptions of its own
+        codec_options = DEFAULT_CODEC_OPTIONS
+    return bson.decode(bson.encode(document), codec_options=codec_options)
+
+
+class _NotConnected:
+    """
+    Stands in for the collection handle until `connect` is called.
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        raise RuntimeError("Database connection not established.")
+
+
+NOT_CONNECTED: Any = _NotConnected()
+
+# Records the duration of a coroutine method, labelled with its name
+timed = calculate_running_time(histogram=MONGODB_LATENCY)
+
 
 class Database:
     def __init__(self, uri: str) -> None:
@@ -29,24 +117,63 @@ class Database:
         self.client: Optional[MongoClient] = None
         self.database: Optional[MongoDBDatabase] = None
         self.collection: Optional[str] = None
+        # The resolved collection, looked up once instead of on every call
+        self._collection: Collection = NOT_CONNECTED
+        # Bound handles by collection name, shared by all of them
+        self.handles: Dict[str, "Database"] = {}
 
-    def connect(self, database: str, collection: str) -> None:
+    def connect(
+        self,
+        database: str,
+        collection: str,
+        **client_options: Any
+    ) -> None:
         """
         Connect to the specified database and collection.
 
         Args:
             database (str): The name of the database to connect to.
             collection (str): The name of the collection to connect to.
+            **client_options: Passed on to the client, e.g. pool sizes.
         Returns:
             None
         """
-        self.client = MongoClient(self.URI)
+        self.client = MongoClient(self.URI, **client_options)
         self.database = self.client.get_database(database)
         self.collection = collection
+        self._validate_connection()
+        self._collection = self.database.get_collection(collection)
+        self.handles = {collection: self}
+
+    def bind(self, collection: str, **options: Any) -> "Database":
+        """
+        Return a handle to another collection of the same database.
+
+        The handle shares the client and has the same methods. The
+        collection is resolved once, with its own options, and the handle
+        is kept in `handles`.
+
+        Args:
+            collection (str): The name of the collection.
+            **options: `codec_options`, `read_preference`, `write_concern`
+              or `read_concern` for this collection.
+        Returns:
+            Database: The bound handle.
+        """
+        self._validate_connection()
+        handle = copy.copy(self)
+        handle.collection = collection
+        handle._collection = self.database.get_collection(
+            collection, **options
+        )
+        self.handles[collection] = handle
+        return handle
 
     def disconnect(self) -> None:
         if self.client:
             self.client.close()
+        for handle in self.handles.values():
+            handle._collection = NOT_CONNECTED
 
     def _validate_connection(self) -> None:
         if self.client is None:
@@ -71,12 +198,51 @@ class Database:
         Returns:
             None
         """
-        self._validate_connection()
-        self.database[self.collection].create_index(
+        self._collection.create_index(
             index,
             expireAfterSeconds=expire_after_seconds
         )
 
+    def create_indexes(self, indexes: List[IndexModel]) -> List[str]:
+        """
+        Create several indexes at once. Existing identical indexes are
+        left untouched.
+
+        Args:
+            indexes (List[IndexModel]): The indexes to create.
+        Returns:
+            List[str]: The names of the indexes.
+        """
+        return self._collection.create_indexes(indexes)
+
+    def ensure_indexes(self, indexes: List[IndexModel]) -> None:
+        """
+        Create indexes, idempotently.
+
+        An index that already exists with a different TTL has its
+        `expireAfterSeconds` updated in place instead of failing.
+
+        Args:
+            indexes (List[IndexModel]): The indexes to create.
+        Returns:
+            None
+        """
+        for index in indexes:
+            try:
+                self._collection.create_indexes([index])
+            except OperationFailure as ex:
+                command = ttl_update_command(self.collection, index)
+                if ex.code not in INDEX_CONFLICT_CODES or command is None:
+                    raise
+                self.database.command(command)
+
+    def ping(self) -> None:
+        """
+        Round trip to the server, opening a pooled connection if needed.
+        """
+        self._validate_connection()
+        self.database.command("ping")
+
     def list_indexes(self) -> dict:
         """
         List all indexes in the specified collection.
@@ -84,8 +250,7 @@ class Database:
         Returns:
             dict: A dictionary containing index information.
         """
-        self._validate_connection()
-        return self.database[self.collection].index_information()
+        return self._collection.index_information()
 
     def drop_index(self, index: str) -> None:
         """
@@ -97,8 +262,7 @@ class Database:
         Returns:
             None
         """
-        self._validate_connection()
-        self.database[self.collection].drop_index(index)
+        self._collection.drop_index(index)
 
     def list_collection_names(self) -> List[str]:
         """
@@ -116,22 +280,64 @@ class Database:
         :return: The result of the insertion operation.
         :rtype: results.InsertOneResult
         """
-        self._validate_connection()
-        return self.database[self.collection].insert_one(data)
+        return self._collection.insert_one(data)
 
-    def find(self, query: Dict[str, Any] = {}) -> Union[Cursor, Any]:
+    def insert_one_and_return(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Insert one document and return it, including its new `_id`.
+
+        The returned document is the one that was sent, decoded the way
+        reads decode it, so no extra read is needed to build a response.
+
+        Args:
+            data (Dict[str, Any]): The document to insert.
+
+        Returns:
+            Dict[str, Any]: The inserted document.
+        """
+        document = dict(data)
+        self.insert_one(document)
+        return as_stored(document, self._collection.codec_options)
+
+    def find(
+        self,
+        query: Dict[str, Any] = {},
+        projection: Optional[Dict[str, Any]] = None,
+        sort: Optional[List[Tuple[str, int]]] = None,
+        limit: int = 0
+    ) -> Union[Cursor, Any]:
         """
         Find documents in the collection that match the specified query.
 
         :param query: A dictionary representing the query to match documents.
         :type query: dict, optional
+        :param projection: The fields to include or exclude.
+        :param sort: A list of (key, direction) pairs to sort by.
+        :param limit: The maximum number of documents, 0 for no limit.
         :return: A list of dictionaries representing the matched documents.
         :rtype: list[dict]
         """
-        self._validate_connection()
-        cursor = self.database[self.collection].find(query)
+        cursor = self._collection.find(
+            query, projection, sort=sort, limit=limit
+        )
         return cursor
 
+    def aggregate(
+        self,
+        pipeline: List[Dict[str, Any]],
+        **options: Any
+    ) -> List[Dict[str, Any]]:
+        """
+        Run an aggregation pipeline on the server and return its results.
+
+        Args:
+            pipeline (List[Dict[str, Any]]): The stages to run.
+            **options: Passed on to `aggregate`, e.g. `allowDiskUse`.
+        Returns:
+            List[Dict[str, Any]]: The documents the pipeline produced.
+        """
+        return list(self._collection.aggregate(pipeline, **options))
+
     def find_one(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
         Find a single document in collection that matches the specified query.
@@ -143,8 +349,7 @@ class Database:
             Optional[Dict[str, Any]]: The matching document, or None
               if no match is found.
         """
-        self._validate_connection()
-        return self.database[self.collection].find_one(query)
+        return self._collection.find_one(query)
 
     def update_one(
         self,
@@ -161,8 +366,54 @@ class Database:
         :return: An instance of results.UpdateResult representing the result
           of the update operation.
         """
-        self._validate_connection()
-        return self.database[self.collection].update_one(query, {"$set": data})
+        return self._collection.update_one(query, {"$set": data})
+
+    def find_one_and_update(
+        self,
+        query: Dict[str, Any],
+        data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Update a single document and return it as it is after the update,
+        in one round trip.
+
+        Args:
+            query (Dict[str, Any]): The query to match the document.
+            data (Dict[str, Any]): The fields and values to set.
+
+        Returns:
+            Optional[Dict[str, Any]]: The updated document, or None
+              if no match is found.
+        """
+        return self._collection.find_one_and_update(
+            query,
+            {"$set": data},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def bulk_write(
+        self,
+        requests: List[Union[InsertOne, UpdateOne]],
+        ordered: bool = False
+    ) -> results.BulkWriteResult:
+        """
+        Send many write operations to the collection in one batch.
+
+        Args:
+            requests (List[Union[InsertOne, UpdateOne]]): The operations.
+            ordered (bool): Stop at the first error and apply operations
+              in order (default False, which lets the server parallelize).
+
+        Returns:
+            results.BulkWriteResult: The combined result.
+
+        Raises:
+            BulkWriteError: If any operation failed; `details` lists the
+              failed operations by index.
+        """
+        return self._collection.bulk_write(
+            requests, ordered=ordered
+        )
 
     def delete_many(self, query: Dict[str, Any]) -> results.DeleteResult:
         """
@@ -174,8 +425,7 @@ class Database:
         :return: The result of the delete operation.
         :rtype: results.DeleteResult
         """
-        self._validate_connection()
-        return self.database[self.collection].delete_many(query)
+        return self._collection.delete_many(query)
 
     def delete_one(self, query: Dict[str, Any]) -> results.DeleteResult:
         """
@@ -188,8 +438,254 @@ class Database:
         Returns:
             results.DeleteResult: The result of the delete operation.
         """
+        return self._collection.delete_one(query)
+
+
+class AsyncDatabase(Database):
+    """
+    asyncio variant of `Database` built on Motor.
+
+    It exposes the same methods, as coroutines, so route handlers can await
+    MongoDB instead of holding a threadpool thread for every request.
+    Calls that reach the server are timed into
+    `omegle_mongodb_latency_seconds`.
+    """
+
+    def __init__(self, uri: str) -> None:
+        super().__init__(uri)
+        self.client: Optional[AsyncIOMotorClient] = None
+        self.database: Optional[AsyncIOMotorDatabase] = None
+
+    def connect(
+        self,
+        database: str,
+        collection: str,
+        **client_options: Any
+    ) -> None:
+        """
+        Connect to the specified database and collection.
+
+        The client connects lazily, on the first operation.
+
+        Args:
+            database (str): The name of the database to connect to.
+            collection (str): The name of the collection to connect to.
+            **client_options: Passed on to the client, e.g. pool sizes.
+        Returns:
+            None
+        """
+        self.client = AsyncIOMotorClient(self.URI, **client_options)
+        self.database = self.client.get_database(database)
+        self.collection = collection
         self._validate_connection()
-        return self.database[self.collection].delete_one(query)
+        self._collection = self.database.get_collection(collection)
+        self.handles = {collection: self}
+
+    @timed
+    async def create_index(
+        self,
+        index: str,
+        expire_after_seconds: int = 3600
+    ) -> None:
+        """
+        Create an index with the given parameters.
+
+        Args:
+            index (str): The name of the index.
+            expire_after_seconds (int): The number of seconds
+              the index expires (default 3600).
+        Returns:
+            None
+        """
+        await self._collection.create_index(
+            index,
+            expireAfterSeconds=expire_after_seconds
+        )
+
+    @timed
+    async def create_indexes(self, indexes: List[IndexModel]) -> List[str]:
+        """
+        Create several indexes at once. Existing identical indexes are
+        left untouched.
+        """
+        return await self._collection.create_indexes(indexes)
+
+    async def ensure_indexes(self, indexes: List[IndexModel]) -> None:
+        """
+        Create indexes, idempotently, updating the TTL of existing ones.
+        """
+        for index in indexes:
+            try:
+                await self._collection.create_indexes([index])
+            except OperationFailure as ex:
+                command = ttl_update_command(self.collection, index)
+                if ex.code not in INDEX_CONFLICT_CODES or command is None:
+                    raise
+                await self.database.command(command)
+
+    @timed
+    async def ping(self) -> None:
+        """
+        Round trip to the server, opening a pooled connection if needed.
+        """
+        self._validate_connection()
+        await self.database.command("ping")
+
+    async def warm_up(self, connections: int) -> None:
+        """
+        Open up to `connections` pooled connections before serving traffic.
+
+        Concurrent pings each check out their own connection, so the pool
+        is filled now rather than by the first requests.
+        """
+        await asyncio.gather(*(self.ping() for _ in range(connections)))
+
+    @timed
+    async def list_indexes(self) -> dict:
+        """
+        List all indexes in the specified collection.
+        """
+        return await self._collection.index_information()
+
+    @timed
+    async def drop_index(self, index: str) -> None:
+        """
+        Drops the specified index from the collection.
+        """
+        await self._collection.drop_index(index)
+
+    @timed
+    async def list_collection_names(self) -> List[str]:
+        """
+        Return a list of collection names in the database.
+        """
+        self._validate_connection()
+        return await self.database.list_collection_names()
+
+    @timed
+    async def insert_one(
+        self,
+        data: Dict[str, Any]
+    ) -> results.InsertOneResult:
+        """
+        Insert one document into the collection.
+        """
+        return await self._collection.insert_one(data)
+
+    async def insert_one_and_return(
+        self,
+        data: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Insert one document and return it, including its new `_id`.
+        """
+        document = dict(data)
+        await self.insert_one(document)
+        return as_stored(document, self._collection.codec_options)
+
+    def find(
+        self,
+        query: Dict[str, Any] = {},
+        projection: Optional[Dict[str, Any]] = None,
+        sort: Optional[List[Tuple[str, int]]] = None,
+        limit: int = 0
+    ) -> AsyncIOMotorCursor:
+        """
+        Find documents in the collection that match the specified query.
+
+        The cursor is returned without any I/O; iterate it with `async for`
+        or collect it with `to_list`.
+        """
+        return self._collection.find(
+            query, projection, sort=sort, limit=limit
+        )
+
+    @timed
+    async def aggregate(
+        self,
+        pipeline: List[Dict[str, Any]],
+        **options: Any
+    ) -> List[Dict[str, Any]]:
+        """
+        Run an aggregation pipeline on the server and return its results.
+
+        Meant for pipelines that reduce to a few documents, which are
+        collected in one call.
+        """
+        cursor = self._collection.aggregate(pipeline, **options)
+        return await cursor.to_list(None)
+
+    @timed
+    async def find_one(
+        self,
+        query: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Find a single document in collection that matches the query.
+        """
+        return await self._collection.find_one(query)
+
+    @timed
+    async def update_one(
+        self,
+        query: Dict[str, Any],
+        data: Dict[str, Any]
+    ) -> results.UpdateResult:
+        """
+        Update a single document in the collection that matches the query.
+        """
+        return await self._collection.update_one(
+            query, {"$set": data}
+        )
+
+    @timed
+    async def find_one_and_update(
+        self,
+        query: Dict[str, Any],
+        data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Update a single document and return it as it is after the update,
+        in one round trip.
+        """
+        return await self._collection.find_one_and_update(
+            query,
+            {"$set": data},
+            return_document=ReturnDocument.AFTER
+        )
+
+    @timed
+    async def bulk_write(
+        self,
+        requests: List[Union[InsertOne, UpdateOne]],
+        ordered: bool = False
+    ) -> results.BulkWriteResult:
+        """
+        Send many write operations to the collection in one batch.
+        """
+        return await self._collection.bulk_write(
+            requests, ordered=ordered
+        )
+
+    @timed
+    async def delete_many(
+        self,
+        query: Dict[str, Any]
+    ) -> results.DeleteResult:
+        """
+        Delete multiple documents that match the specified query.
+        """
+        return await self._collection.delete_many(query)
+
+    @timed
+    async def delete_one(
+        self,
+        query: Dict[str, Any]
+    ) -> results.DeleteResult:
+        """
+        Delete a single document matching the specified query.
+        """
+        return await self._collection.delete_one(query)
 
 
 @calculate_running_time
@@ -0,0 +1,198 @@
+"""
+Graceful drain of a worker and resume tokens for its clients
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import random
+import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from signaling import SignalingRouter
+
+
+# Close codes: the server is restarting, or is not taking new clients
+SERVICE_RESTART = 1012
+TRY_AGAIN_LATER = 1013
+
+# Seconds a rejected client waits before trying again, before jitter
+RETRY_AFTER = 1.0
+
+# Returns the partner of a client, if any
+PartnerOf = Callable[[str], Optional[str]]
+
+
+class ResumeTokens:
+    """
+    Issues and checks signed, expiring resume tokens.
+
+    A token names a client id and its partner at the time, if any, and is
+    signed with HMAC-SHA256 so a client can only resume as itself. Every
+    worker that may receive the reconnection must share `secret`.
+    """
+
+    def __init__(self, secret: bytes, ttl: float = 120.0) -> None:
+        self.secret: bytes = secret
+        self.ttl: float = ttl
+
+    def _sign(self, payload: str) -> str:
+        digest = hmac.new(
+            self.secret, payload.encode(), hashlib.sha256
+        ).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode("ascii")
+
+    def issue(
+        self,
+        client_id: str,
+        partner_id: Optional[str] = None,
+        now: Optional[float] = None
+    ) -> str:
+        expires = int((time.time() if now is None else now) + self.ttl)
+        payload = f"{client_id}.{partner_id or ''}.{expires}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(
+        self,
+        token: str,
+        now: Optional[float] = None
+    ) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Return the (client id, partner id) of a valid token, None if it is
+        malformed, forged or expired.
+        """
+        parts = token.split(".")
+        if len(parts) != 4:
+            return None
+        client_id, partner_id, expires, signature = parts
+        payload = f"{client_id}.{partner_id}.{expires}"
+        # As bytes: `compare_digest` rejects non-ascii str with TypeError
+        if not hmac.compare_digest(
+            signature.encode(), self._sign(payload).encode()
+        ):
+            return None
+        if not expires.isdigit() or int(expires) < (
+            time.time() if now is None else now
+        ):
+            return None
+        return client_id, partner_id or None
+
+
+def resume_tokens_from_env() -> ResumeTokens:
+    """
+    Build the `ResumeTokens` configured by `RESUME_SECRET` and
+    `RESUME_TTL`.
+
+    Without a secret the tokens are only good for this process, which
+    does not survive a restart: set one in production.
+    """
+    secret = os.environ.get("RESUME_SECRET")
+    return ResumeTokens(
+        secret.encode() if secret else os.urandom(32),
+        ttl=float(os.environ.get("RESUME_TTL", 120))
+    )
+
+
+class Drainer:
+    """
+    Moves the clients of a worker elsewhere without a reconnect storm.
+
+    Once draining, the worker rejects new websockets, and tells each
+    attached client to reconnect after its own random delay, spread
+    evenly over `window` seconds, with a resume token that carries its id
+    and partner. Clients still attached `grace` seconds after the window
+    are closed. `main` keeps the pairs of clients that leave while
+    draining, so they can be put back together wherever both reconnect.
+    """
+
+    def __init__(
+        self,
+        router: SignalingRouter,
+        tokens: ResumeTokens,
+        window: float = 30.0,
+        grace: float = 10.0
+    ) -> None:
+        self.router: SignalingRouter = router
+        self.tokens: ResumeTokens = tokens
+        self.window: float = window
+        self.grace: float = grace
+        self.draining: bool = False
+        self._task: Optional[asyncio.Task] = None
+        self._closing: Set[asyncio.Task] = set()
+        self.notified: int = 0
+        self.rejected: int = 0
+        self.closed: int = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "notified": self.notified,
+            "rejected": self.rejected,
+            "closed": self.closed,
+        }
+
+    def reconnect_message(
+        self,
+        delay: float,
+        client_id: Optional[str] = None,
+        partner_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Build the message asking a client to reconnect after `delay`
+        seconds, with a resume token if it has an id to resume.
+        """
+        message: Dict[str, Any] = {
+            "type": "reconnect", "after_ms": int(delay * 1000)
+        }
+        if client_id is not None:
+            message["resume"] = self.tokens.issue(client_id, partner_id)
+        return message
+
+    def retry_message(self) -> Dict[str, Any]:
+        """
+        Build the message for a client rejected while draining.
+        """
+        self.rejected += 1
+        return self.reconnect_message(RETRY_AFTER * random.uniform(1, 2))
+
+    def start(self, partner_of: PartnerOf) -> bool:
+        """
+        Enter drain mode and start moving clients away.
+
+        Args:
+            partner_of (PartnerOf): Looks up the partner to put in each
+              resume token.
+
+        Returns:
+            bool: False if the worker was already draining.
+        """
+        if self.draining:
+            return False
+        self.draining = True
+        self._task = asyncio.create_task(self._drain(partner_of))
+        return True
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _drain(self, partner_of: PartnerOf) -> None:
+        for record in self.router.registry:
+            client_id = record.client_id
+            self.router.send_json(client_id, self.reconnect_message(
+                random.uniform(0, self.window),
+                client_id,
+                partner_of(client_id)
+            ))
+            self.notified += 1
+        await asyncio.sleep(self.window + self.grace)
+        for record in self.router.registry:
+            self.closed += 1
+            # Closing quietly: the client may be leaving on its own
+            task = asyncio.create_task(
+                SignalingRouter._close(record.websocket, SERVICE_RESTART)
+            )
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
@@ -0,0 +1,162 @@
+"""
+ICE server configuration with short-lived TURN credentials
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import orjson
+
+
+DEFAULT_STUN_URLS = ("stun:stun.l.google.com:19302",)
+
+
+class IceServers:
+    """
+    Builds the `iceServers` list clients hand to `RTCPeerConnection`.
+
+    TURN credentials follow the coturn REST API (`use-auth-secret`): the
+    username is `<expiry unix time>:<label>` and the credential is
+    base64(HMAC-SHA1(secret, username)), so the TURN server checks them
+    with the shared secret alone and never has to be called.
+
+    Credentials are minted once per `refresh` window and expire `ttl`
+    seconds after the window ends, so any of them is good for at least
+    `ttl` seconds. Within a window every client of a region gets the same
+    configuration, which is serialized once and served from memory.
+
+    `turn_urls` maps a relay region to its TURN URLs. A client is given
+    the relays of the region it asks for, or of the first region if that
+    one has none. Regions are matched case-insensitively. Without a
+    secret or relays only STUN is offered.
+    """
+
+    def __init__(
+        self,
+        stun_urls: Tuple[str, ...] = DEFAULT_STUN_URLS,
+        turn_urls: Optional[Dict[str, List[str]]] = None,
+        secret: Optional[bytes] = None,
+        ttl: int = 3600,
+        refresh: int = 300,
+        label: str = "omegle",
+        clock: Callable[[], float] = time.time
+    ) -> None:
+        if refresh <= 0 or ttl <= 0:
+            raise ValueError("ttl and refresh must be positive")
+        self.stun_urls: Tuple[str, ...] = tuple(stun_urls)
+        # Keyed like `select_region` looks regions up
+        self.turn_urls: Dict[str, List[str]] = {
+            region.strip().lower(): urls
+            for region, urls in (turn_urls or {}).items()
+        }
+        self.secret: Optional[bytes] = secret
+        self.ttl: int = ttl
+        self.refresh: int = refresh
+        self.label: str = label
+        self.clock: Callable[[], float] = clock
+        # Serialized configuration by region, for `_window` only
+        self._window: int = -1
+        self._cache: Dict[Optional[str], bytes] = {}
+        self.minted: int = 0
+        self.hits: int = 0
+
+    def select_region(self, region: Optional[str] = None) -> Optional[str]:
+        """
+        Return the relay region to use for a client asking for `region`.
+        """
+        if not self.turn_urls:
+            return None
+        region = (region or "").strip().lower()
+        if region in self.turn_urls:
+            return region
+        return next(iter(self.turn_urls))
+
+    def credentials(self, expires: int) -> Tuple[str, str]:
+        """
+        Return the TURN (username, credential) valid until `expires`.
+        """
+        if self.secret is None:
+            raise RuntimeError("No TURN secret configured")
+        username = f"{expires}:{self.label}"
+        digest = hmac.new(
+            self.secret, username.encode(), hashlib.sha1
+        ).digest()
+        return username, base64.b64encode(digest).decode("ascii")
+
+    def config(
+        self,
+        region: Optional[str] = None,
+        now: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Build the configuration of the current window for a region.
+        """
+        window = int(self.clock() if now is None else now) // self.refresh
+        region = self.select_region(region)
+        servers: List[Dict[str, Any]] = []
+        if self.stun_urls:
+            servers.append({"urls": list(self.stun_urls)})
+        expires = (window + 1) * self.refresh + self.ttl
+        if region is not None and self.secret is not None:
+            username, credential = self.credentials(expires)
+            servers.append({
+                "urls": self.turn_urls[region],
+                "username": username,
+                "credential": credential,
+            })
+        return {
+            "iceServers": servers,
+            "region": region,
+            "expires_at": expires,
+        }
+
+    def render(self, region: Optional[str] = None) -> Tuple[bytes, int]:
+        """
+        Return the serialized configuration for a region and how many
+        seconds it may be cached for, minting it if the window changed.
+        """
+        now = int(self.clock())
+        window = now // self.refresh
+        if window != self._window:
+            self._window = window
+            self._cache.clear()
+        region = self.select_region(region)
+        content = self._cache.get(region)
+        if content is None:
+            content = orjson.dumps(self.config(region, now))
+            self._cache[region] = content
+            self.minted += 1
+        else:
+            self.hits += 1
+        return content, (window + 1) * self.refresh - now
+
+    def stats(self) -> Dict[str, int]:
+        return {"minted": self.minted, "hits": self.hits}
+
+
+def ice_servers_from_env() -> IceServers:
+    """
+    Build the `IceServers` configured by the environment.
+
+    `STUN_URLS` is a comma-separated list. `TURN_URLS` is a JSON object
+    mapping each relay region to its URLs, e.g.
+    `{"eu": ["turn:eu.example.com:3478", "turns:eu.example.com:5349"]}`,
+    and `TURN_SECRET` the `static-auth-secret` shared with coturn.
+    `TURN_TTL` and `TURN_REFRESH` are in seconds.
+    """
+    stun = os.environ.get("STUN_URLS")
+    secret = os.environ.get("TURN_SECRET")
+    return IceServers(
+        stun_urls=(
+            tuple(url.strip() for url in stun.split(",") if url.strip())
+            if stun is not None else DEFAULT_STUN_URLS
+        ),
+        turn_urls=json.loads(os.environ.get("TURN_URLS", "{}")),
+        secret=secret.encode() if secret else None,
+        ttl=int(os.environ.get("TURN_TTL", 3600)),
+        refresh=int(os.environ.get("TURN_REFRESH", 300))
+    )
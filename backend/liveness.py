@@ -0,0 +1,143 @@
+"""
+Heartbeats and idle-timeout reaping for websocket connections
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from registry import ConnectionRecord
+from signaling import SignalingRouter
+
+
+PING = {"type": "ping"}
+PONG = {"type": "pong"}
+
+# Called with the id of a dead connection; must be safe to call for a
+# connection that is already gone
+OnDead = Callable[[str], Awaitable[None]]
+
+
+class LivenessMonitor:
+    """
+    Pings idle connections and reaps the ones that stop answering.
+
+    Every watched connection has exactly one entry in a heap ordered by
+    the time it next needs attention, and a single task pops the due
+    entries. Traffic only refreshes `ConnectionRecord.last_seen`, so
+    `touch` is O(1) and the heap entry is pushed back lazily when it comes
+    due. A connection silent for `ping_interval` is sent a ping; one silent
+    for `idle_timeout` is handed to `on_dead` and its websocket closed.
+    Entries of connections that left on their own are dropped when popped.
+    """
+
+    def __init__(
+        self,
+        router: SignalingRouter,
+        on_dead: OnDead,
+        ping_interval: float = 15.0,
+        idle_timeout: float = 45.0,
+        close_timeout: float = 5.0
+    ) -> None:
+        if idle_timeout <= ping_interval:
+            raise ValueError("idle_timeout must be longer than ping_interval")
+        self.router: SignalingRouter = router
+        self.on_dead: OnDead = on_dead
+        self.ping_interval: float = ping_interval
+        self.idle_timeout: float = idle_timeout
+        self.close_timeout: float = close_timeout
+        # (due at, tie breaker, record)
+        self._heap: List[Tuple[float, int, ConnectionRecord]] = []
+        self._counter = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._reaping: Set[asyncio.Task] = set()
+        self.pings: int = 0
+        self.reaped: int = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "watched": len(self._heap),
+            "pings": self.pings,
+            "reaped": self.reaped,
+        }
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._reaping):
+            task.cancel()
+        self._heap.clear()
+
+    def watch(self, record: ConnectionRecord) -> None:
+        """
+        Start tracking a newly attached connection.
+        """
+        record.last_seen = time.monotonic()
+        self._push(record.last_seen + self.ping_interval, record)
+
+    @staticmethod
+    def touch(record: ConnectionRecord) -> None:
+        """
+        Record that a frame was received from the connection.
+        """
+        record.last_seen = time.monotonic()
+
+    def _push(self, due_at: float, record: ConnectionRecord) -> None:
+        heapq.heappush(self._heap, (due_at, next(self._counter), record))
+
+    def check_due(self, now: Optional[float] = None) -> None:
+        """
+        Ping or reap every connection whose heap entry is due.
+        """
+        now = time.monotonic() if now is None else now
+        while self._heap and self._heap[0][0] <= now:
+            _, _, record = heapq.heappop(self._heap)
+            if self.router.registry.get(record.client_id) is not record:
+                # Detached since it was pushed
+                continue
+            idle = now - record.last_seen
+            if idle >= self.idle_timeout:
+                self.reaped += 1
+                task = asyncio.create_task(self._reap(record))
+                self._reaping.add(task)
+                task.add_done_callback(self._reaping.discard)
+            elif idle >= self.ping_interval:
+                self.pings += 1
+                self.router.send_json(record.client_id, PING)
+                self._push(
+                    min(
+                        now + self.ping_interval,
+                        record.last_seen + self.idle_timeout
+                    ),
+                    record
+                )
+            else:
+                self._push(record.last_seen + self.ping_interval, record)
+
+    async def _run(self) -> None:
+        while True:
+            self.check_due()
+            delay = self.ping_interval
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - time.monotonic())
+            # New entries are never due sooner than `ping_interval`
+            await asyncio.sleep(max(delay, 0.01))
+
+    async def _reap(self, record: ConnectionRecord) -> None:
+        await self.on_dead(record.client_id)
+        try:
+            # A half-open socket may never complete the closing handshake
+            await asyncio.wait_for(
+                record.websocket.close(code=1001), self.close_timeout
+            )
+        except Exception:
+            pass
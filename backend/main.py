@@ -1,44 +1,264 @@
+import asyncio
+import functools
+import hmac
 import os
+import time
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+
 from fastapi import (
     FastAPI,
     Request,
     Response,
     status,
     Body,
+    Header,
+    Query,
     HTTPException,
     WebSocket,
     WebSocketDisconnect
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 from models import (
+    connection_indexes,
+    session_indexes,
+    get_current_date,
     ConnectionModel,
     UpdateConnectionModel,
-    ConnectionCollection
+    ConnectionCollection,
+    BulkConnectionRequest,
+    BulkConnectionResult,
+    BulkConnectionResponse,
+    ConcurrencySeries,
+    SessionSummary,
+    WaitTimeStats
 )
 
-from db_connection import Database
+from db_connection import AsyncDatabase, pool_options_from_env
+from cache import ReadThroughCache, RedisCache, TTLCache
+from backplane import Backplane, create_backplane
+from drain import TRY_AGAIN_LATER, Drainer, resume_tokens_from_env
+from ice import IceServers, ice_servers_from_env
+from liveness import PONG, LivenessMonitor
+import metrics
+from matchmaking import Preferences, parse_preferences
+from presence import PresenceHub
+from protocol import TYPE_NAMES, message_to_compact, negotiate
+from ratelimit import RateLimiter
+from registry import (
+    PRESENCE_IN_CALL,
+    PRESENCE_STATES,
+    PRESENCE_WAITING,
+    ConnectionRegistry,
+    document_id
+)
+from sessions import (
+    END_LEFT,
+    END_NOT_RESUMED,
+    END_SKIP,
+    END_TIMEOUT,
+    SessionLog,
+    concurrency_pipeline,
+    session_summary_pipeline,
+    wait_time_pipeline
+)
+from signaling import (
+    BATCH_WINDOW,
+    OUTBOX_SIZE,
+    OVERFLOW_DROP,
+    SignalingRouter
+)
+from write_behind import WriteBehindBuffer
+from serialization import (
+    dump_collection,
+    dump_connection,
+    frame_dumps,
+    frame_loads
+)
 
 from bson.objectid import ObjectId
-import string
-import random
-import json
+from pymongo.errors import BulkWriteError
+from pymongo.operations import InsertOne, UpdateOne
 
 
 load_dotenv()  # take environment variables from .env.
 
 
 URI = os.environ.get('MONGODB_URI')
-db: Database = Database(URI)
-db.connect(database=os.environ.get('DATABASE_NAME'), collection='connections')
+db: AsyncDatabase = AsyncDatabase(URI)
+
+CACHE_URL = os.environ.get('CACHE_URL')
+connection_cache: ReadThroughCache = ReadThroughCache(
+    db,
+    TTLCache(
+        maxsize=int(os.environ.get('CONNECTION_CACHE_SIZE', 10_000)),
+        ttl=float(os.environ.get('CONNECTION_CACHE_TTL', 2.0))
+    ),
+    shared=RedisCache(CACHE_URL) if CACHE_URL else None
+)
 
+# Connection state is persisted off the signaling path
+write_behind: WriteBehindBuffer = WriteBehindBuffer(
+    db, cache=connection_cache
+)
 
-app: FastAPI = FastAPI()
+# Pair history, bound to the sessions collection once connected
+sessions: SessionLog = SessionLog(db)
+
+backplane: Backplane = create_backplane()
+registry: ConnectionRegistry = ConnectionRegistry()
+router: SignalingRouter = SignalingRouter(
+    registry,
+    backplane,
+    outbox_size=int(os.environ.get('OUTBOX_SIZE', OUTBOX_SIZE)),
+    overflow=os.environ.get('OUTBOX_OVERFLOW', OVERFLOW_DROP),
+    batch_window=float(
+        os.environ.get('CANDIDATE_BATCH_WINDOW', BATCH_WINDOW)
+    )
+)
+rate_limiter: RateLimiter = RateLimiter()
+ice_servers: IceServers = ice_servers_from_env()
+presence: PresenceHub = PresenceHub(
+    registry,
+    backplane,
+    interval=float(os.environ.get('PRESENCE_INTERVAL', 1.0))
+)
+drainer: Drainer = Drainer(
+    router,
+    resume_tokens_from_env(),
+    window=float(os.environ.get('DRAIN_WINDOW', 30)),
+    grace=float(os.environ.get('DRAIN_GRACE', 10))
+)
+# Resumed clients waiting for their partner to come back, by client id
+held: Dict[str, asyncio.Task] = {}
+RESUME_WAIT = float(os.environ.get('RESUME_WAIT', 10))
+# Offline statuses waiting for room in a full write-behind buffer
+offline_writes: Set[asyncio.Task] = set()
+
+# A new worker id, after the backplane lost the lease of the previous one
+backplane.on_worker_id = lambda worker_id: setattr(
+    registry.ids, "worker_id", worker_id
+)
+
+
+def paired_elsewhere(client_id: str, paired: bool) -> None:
+    """
+    Follow a pair made or broken on another node.
+    """
+    registry.set_presence(
+        client_id, PRESENCE_IN_CALL if paired else PRESENCE_WAITING
+    )
+    task = held.pop(client_id, None)
+    if task is not None:
+        # Its partner resumed there, or it was given someone new
+        task.cancel()
+
+
+def partner_suspended(client_id: str, partner_id: str) -> None:
+    """
+    Hold a client whose partner is moving to another worker, for up to
+    `RESUME_WAIT` seconds.
+    """
+    if client_id not in registry:
+        # Leaving too
+        return
+    task = held.pop(client_id, None)
+    if task is not None:
+        task.cancel()
+    held[client_id] = asyncio.create_task(hold(client_id))
+    router.send_json(client_id, {
+        "type": "partner_reconnecting", "peer_id": partner_id
+    })
+
+
+backplane.on_pairing = paired_elsewhere
+backplane.on_suspended = partner_suspended
+
+metrics.CONNECTED_SOCKETS.set_function(lambda: len(registry))
+metrics.register_stats(
+    "omegle_connection_cache", connection_cache.stats, gauges=("size",)
+)
+metrics.register_stats(
+    "omegle_write_behind", write_behind.stats, gauges=("pending",)
+)
+metrics.register_stats(
+    "omegle_presence",
+    registry.presence,
+    gauges=("online",) + PRESENCE_STATES
+)
+metrics.register_stats(
+    "omegle_presence_hub", presence.stats, gauges=("subscribers",)
+)
+metrics.register_stats("omegle_ice", ice_servers.stats)
+metrics.register_stats("omegle_backplane", backplane.stats)
+metrics.register_stats(
+    "omegle_sessions", sessions.stats, gauges=("pending",)
+)
+metrics.register_stats(
+    "omegle_signaling",
+    lambda: {**router.stats(), "throttled": rate_limiter.stats()},
+    gauges=("attached",)
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Connect, warm up and create indexes before serving, and flush and
+    close everything on shutdown.
+    """
+    pool_options = pool_options_from_env()
+    db.connect(
+        database=os.environ.get('DATABASE_NAME'),
+        collection='connections',
+        **pool_options
+    )
+    await db.warm_up(pool_options["minPoolSize"] or 1)
+    await db.ensure_indexes(connection_indexes(
+        int(os.environ.get('CONNECTION_TTL_SECONDS', 3600))
+    ))
+    sessions.db = db.bind('sessions')
+    await sessions.db.ensure_indexes(session_indexes(
+        int(os.environ.get('SESSION_TTL_SECONDS', 30 * 86400))
+    ))
+    await backplane.start(router.deliver_local)
+    registry.ids.worker_id = await backplane.allocate_worker_id()
+    write_behind.start()
+    sessions.start()
+    presence.start()
+    liveness.start()
+    widening = asyncio.create_task(widen_matches())
+    try:
+        yield
+    finally:
+        widening.cancel()
+        await drainer.close()
+        for task in held.values():
+            task.cancel()
+        await liveness.close()
+        await presence.close()
+        await write_behind.close()
+        if offline_writes:
+            await asyncio.gather(*offline_writes)
+            await write_behind.flush()
+        await sessions.close()
+        if connection_cache.shared is not None:
+            await connection_cache.shared.close()
+        await backplane.close()
+        db.disconnect()
+
+
+app: FastAPI = FastAPI(
+    lifespan=lifespan, default_response_class=ORJSONResponse
+)
 
 # Set static files directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -57,14 +277,106 @@ app.add_middleware(
 )
 
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# API field name -> document field name
+CONNECTION_FIELDS = {
+    "id": "_id",
+    "status": "status",
+    "created_at": "created_at",
+    "updated_at": "updated_at",
+    "region": "region",
+    "tags": "tags",
+}
+
+
+def parse_projection(fields: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Turn a comma-separated list of field names into a projection.
+
+    `_id` is always returned, it is what the paging cursor is built from.
+    """
+    if not fields:
+        return None
+    projection = {"_id": 1}
+    for field in fields.split(","):
+        field = field.strip()
+        if field not in CONNECTION_FIELDS:
+            raise HTTPException(
+                status_code=400, detail=f"Unknown field {field}"
+            )
+        projection[CONNECTION_FIELDS[field]] = 1
+    return projection
+
+
+def json_response(content: bytes, status_code: int = 200) -> Response:
+    """
+    Wrap JSON that is already serialized.
+
+    Returning a `Response` skips FastAPI's response model validation and
+    `jsonable_encoder` pass; the bytes come from the cached TypeAdapters.
+    """
+    return Response(
+        content, status_code=status_code, media_type="application/json"
+    )
+
+
+async def stream_connections(cursor) -> AsyncIterator[bytes]:
+    """
+    Yield documents as newline-delimited JSON as the cursor produces them.
+    """
+    async for document in cursor:
+        yield dump_connection(document) + b"\n"
+
+
 @app.get("/connections/",
          response_description="List all Connections",
          response_model=ConnectionCollection,
          response_model_by_alias=False,
+         response_model_exclude_unset=True,
          )
-def list_connections(status: bool = None):
-    query = {"status": status} if status is not None else {}
-    return ConnectionCollection(connections=db.find(query))
+async def list_connections(
+    status: bool = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    stream: bool = False
+):
+    """
+    List connection records in creation order, one page at a time.
+
+    Pass the `next_cursor` of a page as `cursor` to get the next page.
+    `fields` is a comma-separated list of the fields to return.
+    With `stream=true` every record after `cursor` (up to `limit`, if given)
+    is streamed as newline-delimited JSON instead.
+    """
+    query: Dict[str, Any] = {"status": status} if status is not None else {}
+    if cursor is not None:
+        if not ObjectId.is_valid(cursor):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["_id"] = {"$gt": ObjectId(cursor)}
+    projection = parse_projection(fields)
+    sort = [("_id", 1)]
+
+    if stream:
+        return StreamingResponse(
+            stream_connections(
+                db.find(query, projection, sort=sort, limit=limit or 0)
+            ),
+            media_type="application/x-ndjson"
+        )
+
+    limit = limit or DEFAULT_PAGE_SIZE
+    # One extra document tells whether there is a next page
+    connections = await db.find(
+        query, projection, sort=sort, limit=limit + 1
+    ).to_list(length=None)
+    next_cursor = None
+    if len(connections) > limit:
+        connections = connections[:limit]
+        next_cursor = str(connections[-1]["_id"])
+    return json_response(dump_collection(connections, next_cursor))
 
 
 @app.post(
@@ -74,18 +386,20 @@ def list_connections(status: bool = None):
     status_code=status.HTTP_201_CREATED,
     response_model_by_alias=False
 )
-def create_connection(connection: ConnectionModel = Body(...)):
+async def create_connection(connection: ConnectionModel = Body(...)):
     """
     Insert a new connection record.
 
     A unique id will be created and returned in the response.
     """
 
-    new_connection = db.insert_one(
+    created_connection = await db.insert_one_and_return(
         connection.model_dump(by_alias=True, exclude=["id"])
     )
-    created_connection = db.find_one({"_id": new_connection.inserted_id})
-    return created_connection
+    return json_response(
+        dump_connection(created_connection),
+        status_code=status.HTTP_201_CREATED
+    )
 
 
 @app.get(
@@ -94,14 +408,14 @@ def create_connection(connection: ConnectionModel = Body(...)):
     response_model=ConnectionModel,
     response_model_by_alias=False
 )
-def show_connection(id: str):
+async def show_connection(id: str):
     """
     Get the record for a specific connection, looked up by `id`.
     """
     if (
-        connection := db.find_one({"_id": ObjectId(id)})
+        connection := await connection_cache.find_one(ObjectId(id))
     ) is not None:
-        return connection
+        return json_response(dump_connection(connection))
     raise HTTPException(status_code=404, detail=f"Connection {id} not found")
 
 
@@ -110,7 +424,7 @@ def show_connection(id: str):
          response_model=ConnectionModel,
          response_model_by_alias=False
          )
-def update_connection(id: str, connection: UpdateConnectionModel):
+async def update_connection(id: str, connection: UpdateConnectionModel):
     """
     Update individual fields of an existing connection record.
 
@@ -125,26 +439,91 @@ def update_connection(id: str, connection: UpdateConnectionModel):
 
     if len(connection) == 0:
         raise HTTPException(status_code=400, detail="No fields provided")
-    x = db.update_one({"_id": ObjectId(id)}, connection)
-    print(x)
-    updated_connection = db.find_one({"_id": ObjectId(id)})
+    updated_connection = await connection_cache.find_one_and_update(
+        ObjectId(id), connection
+    )
     if updated_connection is None:
         raise HTTPException(
             status_code=404,
             detail=f"Connection {id} not found"
         )
-    return updated_connection
+    return json_response(dump_connection(updated_connection))
+
+
+@app.post("/connections/bulk",
+          response_description="Insert or update many Connections",
+          response_model=BulkConnectionResponse,
+          )
+async def bulk_write_connections(request: BulkConnectionRequest):
+    """
+    Apply many connection changes with a single unordered bulk write.
+
+    Operations with an `id` update that record, the others insert a new
+    one. A failing operation does not stop the rest; its result carries
+    the error.
+    """
+    results = []
+    requests = []
+    # Position in `requests` -> position in `results`
+    positions = []
+    updated_ids = []
+    for index, operation in enumerate(request.operations):
+        changes = {
+            key: value
+            for key, value in operation.model_dump(exclude={"id"}).items()
+            if value is not None
+        }
+        if operation.id is None:
+            document = ConnectionModel(**changes).model_dump(
+                by_alias=True, exclude=["id"]
+            )
+            document["_id"] = ObjectId()
+            requests.append(InsertOne(document))
+            results.append(
+                BulkConnectionResult(index=index, id=str(document["_id"]))
+            )
+        elif ObjectId.is_valid(operation.id):
+            updated_ids.append(ObjectId(operation.id))
+            requests.append(
+                UpdateOne({"_id": updated_ids[-1]}, {"$set": changes})
+            )
+            results.append(BulkConnectionResult(index=index, id=operation.id))
+        else:
+            results.append(BulkConnectionResult(
+                index=index, id=operation.id, ok=False, error="Invalid id"
+            ))
+            continue
+        positions.append(index)
+
+    counts = {}
+    if requests:
+        try:
+            counts = (await db.bulk_write(requests)).bulk_api_result
+        except BulkWriteError as error:
+            counts = error.details
+            for write_error in counts.get("writeErrors", []):
+                result = results[positions[write_error["index"]]]
+                result.ok = False
+                result.error = write_error.get("errmsg")
+        await connection_cache.invalidate(*updated_ids)
+
+    return BulkConnectionResponse(
+        results=results,
+        inserted_count=counts.get("nInserted", 0),
+        matched_count=counts.get("nMatched", 0),
+        modified_count=counts.get("nModified", 0),
+    )
 
 
 @app.delete("/connections/{id}",
             response_description="Delete a Connection",
             # status_code=status.HTTP_204_NO_CONTENT
             )
-def delete_connection(id: str):
+async def delete_connection(id: str):
     """
     Delete a connection record.
     """
-    x = db.delete_one({"_id": ObjectId(id)})
+    x = await connection_cache.delete_one(ObjectId(id))
 
     if x.deleted_count == 0:
         raise HTTPException(
@@ -154,48 +533,536 @@ def delete_connection(id: str):
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
+@app.get("/cache/stats", response_description="Connection cache counters")
+async def cache_stats():
+    return connection_cache.stats()
+
+
+@app.get("/signaling/stats", response_description="Signaling counters")
+async def signaling_stats():
+    return {
+        "frames": router.stats(),
+        "throttled": rate_limiter.stats(),
+        "drain": drainer.stats(),
+    }
+
+
+@app.post("/drain", response_description="Drain progress")
+async def start_drain(x_drain_token: Optional[str] = Header(None)):
+    """
+    Stop taking new websockets and move the attached clients to other
+    workers, e.g. from a pre-stop hook before a restart.
+
+    Requires the `X-Drain-Token` header to match `DRAIN_TOKEN`; without
+    `DRAIN_TOKEN` the endpoint is disabled.
+    """
+    expected = os.environ.get('DRAIN_TOKEN')
+    if not expected or not hmac.compare_digest(
+        (x_drain_token or '').encode(), expected.encode()
+    ):
+        raise HTTPException(status_code=403, detail="Draining not allowed")
+    drainer.start(backplane.partner_of)
+    return drainer.stats()
+
+
+@app.get("/ready", response_description="Whether to route clients here")
+async def readiness():
+    """
+    Readiness probe: 503 once the worker is draining.
+    """
+    if drainer.draining:
+        raise HTTPException(status_code=503, detail="Draining")
+    return {"ready": True}
+
+
+@app.get("/presence", response_description="Online, waiting and in-call")
+async def presence_counts(
+    scope: str = Query("local", pattern="^(local|cluster)$")
+):
+    """
+    Count the clients online, idle, waiting for a partner and in a call.
+
+    The `local` counts are those of this worker, read from the registry.
+    The `cluster` counts are summed over all workers sharing the backplane
+    and lag by up to `PRESENCE_INTERVAL` seconds.
+    """
+    if scope == "cluster":
+        return presence.totals
+    return presence.local()
+
+
+@app.websocket("/presence/ws")
+async def presence_updates(websocket: WebSocket):
+    """
+    Push the cluster presence counts now and every time they change.
+    """
+    await websocket.accept()
+    updates = presence.subscribe()
+
+    async def push() -> None:
+        while True:
+            await websocket.send_json(await updates.get())
+
+    pusher = asyncio.create_task(push())
+    try:
+        while True:
+            # Nothing is expected from the client, this notices it leaving
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        pusher.cancel()
+        presence.unsubscribe(updates)
+
+
+# Longest window the analytics endpoints aggregate over
+MAX_ANALYTICS_WINDOW = timedelta(days=1)
+
+
+def analytics_window(
+    since: Optional[datetime],
+    until: Optional[datetime]
+) -> Tuple[datetime, datetime]:
+    """
+    Resolve an analytics window, the last hour by default.
+
+    Bounds without a UTC offset are taken as UTC.
+    """
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if until is not None and until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    until = until or get_current_date()
+    since = since or until - timedelta(hours=1)
+    if since >= until:
+        raise HTTPException(
+            status_code=400, detail="since must be before until"
+        )
+    if until - since > MAX_ANALYTICS_WINDOW:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Window longer than {MAX_ANALYTICS_WINDOW}"
+        )
+    return since, until
+
+
+@app.get(
+    "/analytics/wait-times",
+    response_description="Match wait percentiles, in seconds",
+    response_model=WaitTimeStats
+)
+async def wait_times(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """
+    How long clients waited for a match, over sessions started in the
+    window. Computed by the server in one aggregation.
+    """
+    since, until = analytics_window(since, until)
+    results = await sessions.db.aggregate(wait_time_pipeline(since, until))
+    return WaitTimeStats(
+        since=since, until=until, **(results[0] if results else {})
+    )
+
+
+@app.get(
+    "/analytics/sessions",
+    response_description="Session counts and call durations",
+    response_model=SessionSummary
+)
+async def session_summary(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """
+    Sessions started in the window by how they ended, with call durations.
+    """
+    since, until = analytics_window(since, until)
+    results = await sessions.db.aggregate(
+        session_summary_pipeline(since, until)
+    )
+    return SessionSummary(since=since, until=until, sessions=results)
+
+
+@app.get(
+    "/analytics/concurrency",
+    response_description="Users in a call per minute",
+    response_model=ConcurrencySeries
+)
+async def concurrency(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """
+    Users in a call and calls in progress for every minute of the window
+    that had any.
+    """
+    since, until = analytics_window(since, until)
+    results = await sessions.db.aggregate(
+        concurrency_pipeline(since, until), allowDiskUse=True
+    )
+    return ConcurrencySeries(since=since, until=until, minutes=results)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """
+    Prometheus exposition of this worker's metrics.
+    """
+    exposition = metrics.render()
+    if exposition is None:
+        raise HTTPException(
+            status_code=503, detail="prometheus_client is not installed"
+        )
+    metrics.WAITING_CLIENTS.set(await backplane.queue_depth())
+    content, media_type = exposition
+    return Response(content, media_type=media_type)
+
+
+@app.get("/ice-servers", response_description="ICE servers for WebRTC")
+async def ice_server_config(region: Optional[str] = None):
+    """
+    The `iceServers` to give `RTCPeerConnection`, with TURN credentials
+    for the relay region closest to `region`, and when they expire.
+
+    Everybody asking for the same region within a `TURN_REFRESH` window
+    gets the same credentials, so the response may be cached that long.
+    """
+    content, max_age = ice_servers.render(region)
+    return Response(
+        content,
+        media_type="application/json",
+        headers={"Cache-Control": f"private, max-age={max_age}"}
+    )
+
+
 @app.get("/")
 async def home(request: Request):
-    return templates.TemplateResponse("home.html", {"request": request})
+    # Absolute ws:// or wss:// URL, matching how the page was requested
+    websocket_url = str(request.url_for("websocket_endpoint"))
+    return templates.TemplateResponse(
+        "home.html", {"request": request, "websocket_url": websocket_url}
+    )
+
+
+def persist_status(
+    client_id: str,
+    status: bool,
+    preferences: Optional[Preferences] = None
+) -> None:
+    """
+    Queue a status change of the client's connection record.
+
+    Under load, changes are shed when the write-behind buffer is full,
+    except going offline: a lost one would leave the record online until
+    its TTL expires, so it waits for room instead.
+    """
+    now = get_current_date()
+    fields: Dict[str, Any] = {"status": status, "updated_at": now}
+    if preferences is not None:
+        fields["region"] = preferences.region
+        fields["tags"] = sorted(preferences.tags)
+    if status or not write_behind.full:
+        write_behind.submit(
+            document_id(client_id),
+            fields,
+            on_insert={"created_at": now}
+        )
+        return
+    task = asyncio.create_task(write_behind.put(
+        document_id(client_id),
+        fields,
+        on_insert={"created_at": now}
+    ))
+    offline_writes.add(task)
+    task.add_done_callback(offline_writes.discard)
+
+
+def observe_wait(client_id: str, now: float) -> Optional[float]:
+    """
+    Record how long a client attached here waited for its match.
+
+    Returns:
+        Optional[float]: The wait in seconds, None if it is not known here.
+    """
+    record = registry.get(client_id)
+    if record is None or record.waiting_since is None:
+        return None
+    wait = now - record.waiting_since
+    metrics.MATCH_LATENCY.observe(wait)
+    record.waiting_since = None
+    return wait
 
 
-clients = {}
+def notify_match(
+    client_id: str,
+    partner_id: str,
+    waits: Tuple[Optional[float], Optional[float]] = (None, None)
+) -> None:
+    """
+    Tell both sides of a new pair who their partner is, and log the
+    session.
+    """
+    sessions.started((client_id, partner_id), waits)
+    registry.set_presence(client_id, PRESENCE_IN_CALL)
+    registry.set_presence(partner_id, PRESENCE_IN_CALL)
+    persist_status(client_id, True)
+    persist_status(partner_id, True)
+    router.send_json(client_id, {"type": "matched", "peer_id": partner_id})
+    router.send_json(partner_id, {"type": "matched", "peer_id": client_id})
 
 
-def generate_unique_id(length=3):
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
+async def find_partner(client_id: str) -> None:
+    """
+    Match the client with a waiting stranger or put it in the queue.
+    """
+    record = registry.get(client_id)
+    start_time = time.perf_counter()
+    partner_id = await backplane.join(client_id)
+    if partner_id is not None:
+        now = time.perf_counter()
+        metrics.MATCH_LATENCY.observe(now - start_time)
+        # The partner's wait is only known if it is attached here
+        waits = (now - start_time, observe_wait(partner_id, now))
+        notify_match(client_id, partner_id, waits)
+    else:
+        if record is not None:
+            record.waiting_since = start_time
+            registry.set_presence(client_id, PRESENCE_WAITING)
+        router.send_json(client_id, {"type": "waiting"})
+
+
+async def skip_partner(client_id: str) -> None:
+    """
+    Give both sides of the client's pair a new stranger, keeping the
+    websockets open.
+    """
+    start_time = time.perf_counter()
+    partner_id = await backplane.skip(client_id)
+    if partner_id is None:
+        # Not paired, nothing to skip
+        return
+    sessions.ended(client_id, END_SKIP)
+    persist_status(client_id, False)
+    persist_status(partner_id, False)
+    router.send_json(partner_id, {
+        "type": "partner_left", "peer_id": client_id, "reason": "skip"
+    })
+    # The client asking for someone new gets the first pick
+    await find_partner(client_id)
+    await find_partner(partner_id)
+    metrics.SKIP_LATENCY.observe(time.perf_counter() - start_time)
+
+
+async def resume_pair(client_id: str, partner_id: str) -> None:
+    """
+    Put a resumed client back with its former partner.
+
+    If the partner has not reconnected yet, the client is held out of the
+    queue for `RESUME_WAIT` seconds before it looks for someone new.
+    """
+    if await backplane.resume(client_id, partner_id):
+        for side, other in ((client_id, partner_id), (partner_id, client_id)):
+            task = held.pop(side, None)
+            if task is not None:
+                task.cancel()
+            registry.set_presence(side, PRESENCE_IN_CALL)
+            router.send_json(side, {"type": "resumed", "peer_id": other})
+        return
+    held[client_id] = asyncio.create_task(hold(client_id))
+    router.send_json(client_id, {"type": "waiting"})
+
+
+async def hold(client_id: str) -> None:
+    """
+    Wait for the partner of a client to resume, then give up on it: break
+    what is left of the pair, close its session and look for someone new.
+    """
+    await asyncio.sleep(RESUME_WAIT)
+    held.pop(client_id, None)
+    partner_id = await backplane.leave(client_id)
+    sessions.ended(client_id, END_NOT_RESUMED)
+    persist_status(client_id, False)
+    if partner_id is not None:
+        router.send_json(
+            client_id, {"type": "partner_left", "peer_id": partner_id}
+        )
+    await find_partner(client_id)
+
+
+async def reject(websocket: WebSocket, compact: bool) -> None:
+    """
+    Turn away a websocket while draining, telling it when to retry.
+    """
+    message = drainer.retry_message()
+    if compact:
+        await websocket.send_bytes(message_to_compact(message))
+    else:
+        await websocket.send_text(frame_dumps(message))
+    await websocket.close(code=TRY_AGAIN_LATER)
+
+
+async def widen_matches() -> None:
+    """
+    Periodically pair waiting clients whose searches have widened.
+    """
+    interval = float(os.environ.get('MATCH_WIDEN_INTERVAL', 0.5))
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            pairs = await backplane.widen()
+        except Exception as ex:
+            # Retried on the next tick, e.g. after a Redis hiccup
+            print(f"Widening matches failed: {ex}")
+            continue
+        now = time.perf_counter()
+        for client_id, partner_id in pairs:
+            waits = (
+                observe_wait(client_id, now), observe_wait(partner_id, now)
+            )
+            notify_match(client_id, partner_id, waits)
+
+
+async def release_client(client_id: str, reason: str = END_LEFT) -> None:
+    """
+    Detach a client, break its pair and requeue the former partner.
+
+    Called when the socket disconnects and, with `END_TIMEOUT`, when the
+    liveness monitor reaps it; only the first call does anything.
+    """
+    if router.detach(client_id) is None:
+        return
+    task = held.pop(client_id, None)
+    if task is not None:
+        task.cancel()
+    if drainer.draining and reason == END_LEFT:
+        # Moving to another worker: keep the pair for it to resume
+        # Its partner is held through `partner_suspended`
+        await backplane.suspend(client_id)
+        await backplane.unregister(client_id)
+        return
+    partner_id = await backplane.leave(client_id)
+    await backplane.unregister(client_id)
+    persist_status(client_id, False)
+    if partner_id is not None:
+        sessions.ended(client_id, reason)
+        persist_status(partner_id, False)
+        router.send_json(
+            partner_id, {"type": "partner_left", "peer_id": client_id}
+        )
+        await find_partner(partner_id)
+
+
+liveness: LivenessMonitor = LivenessMonitor(
+    router,
+    functools.partial(release_client, reason=END_TIMEOUT),
+    ping_interval=float(os.environ.get('HEARTBEAT_INTERVAL', 15)),
+    idle_timeout=float(os.environ.get('IDLE_TIMEOUT', 45))
+)
+metrics.register_stats("omegle_liveness", liveness.stats, gauges=("watched",))
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """
     A websocket endpoint for sending and receiving messages.
+
+    Each client is paired with a single stranger and its signaling
+    messages are relayed to that partner only.
+
+    Clients that offer the `omegle.compact.v1` subprotocol exchange
+    compact binary frames (see `protocol.py`), JSON text is used otherwise.
+
+    `region` and `tags` (comma-separated) query parameters ask for a
+    stranger from the same region sharing an interest; the search widens
+    to anyone if nobody turns up. A `skip` message swaps the partner for
+    the next stranger without reconnecting.
+
+    A `resume` query parameter carries the token of a `reconnect` message:
+    the client gets its id back and, if its former partner is back too,
+    its pair. A draining worker turns every websocket away.
+
+    With `batch=1` the client also takes `candidates` messages, carrying
+    the ICE candidates its partner sent within a few milliseconds as a
+    `candidates` list; other clients get each one in its own message.
     """
-    await websocket.accept()
-    # client_id = str(websocket)  # Use the WebSocket object as the client ID
-    client_id = generate_unique_id()
-    # Add the new client to the clients dictionary
-    clients[client_id] = websocket
+    subprotocol = negotiate(websocket.scope.get("subprotocols"))
+    await websocket.accept(subprotocol=subprotocol)
+    compact = subprotocol is not None
+    if drainer.draining:
+        await reject(websocket, compact)
+        return
+    client_id, partner_id = None, None
+    token = websocket.query_params.get("resume")
+    claim = drainer.tokens.verify(token) if token else None
+    if claim is not None and claim[0] not in registry:
+        client_id, partner_id = claim
+    record = router.attach(
+        websocket,
+        client_id=client_id,
+        compact=compact,
+        batch=websocket.query_params.get("batch") == "1"
+    )
+    client_id = record.client_id
+    liveness.watch(record)
+    preferences = parse_preferences(
+        websocket.query_params.get("region"),
+        websocket.query_params.get("tags")
+    )
+    await backplane.register(client_id, preferences)
+    persist_status(client_id, False, preferences)
 
     try:
+        if partner_id is not None:
+            await resume_pair(client_id, partner_id)
+        else:
+            await find_partner(client_id)
         while True:
-            data = await websocket.receive_text()
-            data_json = json.loads(data)
-            data_json["peer_id"] = client_id
-
-            # Broadcast the message to all other clients
-            for other_client_id, other_client_websocket in clients.items():
-                if other_client_id != client_id:
-                    await other_client_websocket.send_text(
-                        json.dumps(data_json)
-                    )
+            if compact:
+                data = await websocket.receive_bytes()
+            else:
+                data = await websocket.receive_text()
+            liveness.touch(record)
+            if compact:
+                message = None
+                kind = TYPE_NAMES.get(data[0]) if data else None
+            else:
+                try:
+                    message = frame_loads(data)
+                except (ValueError, RecursionError):
+                    message = None
+                if not isinstance(message, dict) or not isinstance(
+                    message.get("type", ""), str
+                ):
+                    # Not a JSON object, or not a string type: drop it,
+                    # keep the connection
+                    metrics.count_frame_in(None)
+                    continue
+                kind = message.get("type")
+            metrics.count_frame_in(kind)
+            if not rate_limiter.allow(record, kind):
+                continue
+            if kind == "ping":
+                router.send_json(client_id, PONG)
+                continue
+            if kind == "skip":
+                await skip_partner(client_id)
+                continue
+            partner_id = backplane.partner_of(client_id)
+            if partner_id is None:
+                # Nobody to talk to yet, drop the message
+                continue
+            if compact:
+                router.relay_compact(client_id, partner_id, data)
+            else:
+                router.relay(client_id, partner_id, message)
 
     except WebSocketDisconnect:
-        # Remove the disconnected client from the clients dictionary
-        clients.pop(client_id)
         print(f"WebSocket {client_id} disconnected")
-        await websocket.close()
+
+    finally:
+        await release_client(client_id)
 
 
 if __name__ == "__main__":
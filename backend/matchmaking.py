@@ -0,0 +1,399 @@
+"""
+Matchmaking queue for pairing strangers
+"""
+import time
+from collections import OrderedDict
+from typing import (
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple
+)
+
+
+# Constants for user status
+STATUS_AVAILABLE = "available"
+STATUS_CONNECTED = "connected"
+
+MAX_TAGS = 5
+MAX_TAG_LENGTH = 32
+
+# Seconds a client waits for a stranger sharing one of its tags before
+# anyone from its region will do, twice that before anyone at all will
+WIDEN_AFTER = 5.0
+
+# Bucket key of a tagless client, distinct from the region-wide bucket
+UNTAGGED = ""
+
+# Seconds two clients are kept apart after one of them skipped the other,
+# and how many skipped strangers a client remembers
+REMATCH_AFTER = 60.0
+AVOID_SIZE = 8
+
+
+class Preferences(NamedTuple):
+    """
+    Who a client would like to be matched with.
+    """
+    region: Optional[str] = None
+    tags: frozenset = frozenset()
+
+
+ANYONE = Preferences()
+
+
+def parse_preferences(
+    region: Optional[str] = None,
+    tags: Optional[str] = None
+) -> Preferences:
+    """
+    Normalize a region and a comma-separated list of interest tags.
+
+    Tags are lowercased, and only the first `MAX_TAGS` are kept so the
+    number of queues a client sits in stays small.
+    """
+    region = region.strip().lower()[:MAX_TAG_LENGTH] if region else None
+    parsed = []
+    for tag in (tags or "").split(","):
+        tag = tag.strip().lower()[:MAX_TAG_LENGTH]
+        if tag and tag not in parsed:
+            parsed.append(tag)
+    return Preferences(region or None, frozenset(parsed[:MAX_TAGS]))
+
+
+def bucket_keys(
+    preferences: Preferences
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Return the keys of every bucket a client with these preferences waits
+    in: one per tag (or the untagged one) and the region-wide one last.
+    """
+    region = preferences.region
+    keys: List[Tuple[Optional[str], Optional[str]]] = [
+        (region, tag) for tag in preferences.tags or (UNTAGGED,)
+    ]
+    keys.append((region, None))
+    return keys
+
+
+class Ticket:
+    """
+    A client waiting for a partner.
+    """
+    __slots__ = ("client_id", "preferences", "enqueued_at")
+
+    def __init__(
+        self,
+        client_id: str,
+        preferences: Preferences,
+        enqueued_at: float
+    ) -> None:
+        self.client_id: str = client_id
+        self.preferences: Preferences = preferences
+        self.enqueued_at: float = enqueued_at
+
+    def bucket_keys(self) -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        Return the keys of every bucket the ticket is queued in.
+        """
+        return bucket_keys(self.preferences)
+
+
+class Matchmaker:
+    """
+    Pairs waiting clients by region and interest tags, in arrival order.
+
+    Waiting clients sit in a global arrival-ordered queue and in one
+    bucket per (region, tag) pair they declared plus one per region. All
+    of them are insertion-ordered dicts, so enqueueing and removing a
+    client cost O(number of tags) and finding a partner looks only at the
+    heads of a handful of buckets, however many clients are waiting.
+
+    A joining client is matched with the longest waiting client of its
+    region sharing one of its tags. Searches widen with waiting time: after
+    `widen_after` seconds a waiting client accepts anyone from its region,
+    after twice that anyone at all. Joining clients take such a client if
+    nobody shares their tags, and `widen` pairs waiting clients with each
+    other once their waits allow it. Active pairs are kept in a symmetric
+    registry (`a -> b` and `b -> a`).
+
+    `skip` breaks a pair and keeps the two apart for `rematch_after`
+    seconds. Each client remembers at most `avoid_size` strangers, so
+    stepping over them at the head of a bucket stays constant time.
+    """
+
+    def __init__(
+        self,
+        widen_after: float = WIDEN_AFTER,
+        clock: Callable[[], float] = time.monotonic,
+        rematch_after: float = REMATCH_AFTER,
+        avoid_size: int = AVOID_SIZE
+    ) -> None:
+        self.widen_after: float = widen_after
+        self.clock: Callable[[], float] = clock
+        self.rematch_after: float = rematch_after
+        self.avoid_size: int = avoid_size
+        self._waiting: "OrderedDict[str, Ticket]" = OrderedDict()
+        self._buckets: Dict[
+            Tuple[Optional[str], Optional[str]], "OrderedDict[str, None]"
+        ] = {}
+        self._pairs: Dict[str, str] = {}
+        # client id -> (skipped or skipping client id -> kept apart until)
+        self._avoid: Dict[str, "OrderedDict[str, float]"] = {}
+
+    def join(
+        self,
+        client_id: str,
+        preferences: Preferences = ANYONE
+    ) -> Optional[str]:
+        """
+        Match the client with the best waiting stranger, or queue it.
+
+        Args:
+            client_id (str): The client looking for a partner.
+            preferences (Preferences): Its region and interest tags.
+
+        Returns:
+            Optional[str]: The partner id if a match was made,
+              None if the client is now waiting.
+        """
+        if client_id in self._pairs:
+            return self._pairs[client_id]
+        if client_id in self._waiting:
+            return None
+        ticket = Ticket(client_id, preferences, self.clock())
+        partner_id = self._find(ticket)
+        if partner_id is not None:
+            self._remove(partner_id)
+            self._pair(client_id, partner_id)
+            return partner_id
+        self._waiting[client_id] = ticket
+        for key in ticket.bucket_keys():
+            self._buckets.setdefault(key, OrderedDict())[client_id] = None
+        return None
+
+    def _oldest_other(
+        self,
+        bucket: Optional["OrderedDict[str, None]"],
+        client_id: str,
+        now: float
+    ) -> Optional[str]:
+        """
+        Return the longest waiting client of a bucket the client may be
+        matched with.
+
+        Buckets are in arrival order, so this steps over the client itself
+        and the strangers it must avoid: `avoid_size + 1` entries at most.
+        """
+        if not bucket:
+            return None
+        avoid = self._avoid.get(client_id)
+        for other_id in bucket:
+            if other_id == client_id:
+                continue
+            if avoid is not None and avoid.get(other_id, 0.0) > now:
+                continue
+            return other_id
+        return None
+
+    def _find(self, ticket: Ticket) -> Optional[str]:
+        keys = ticket.bucket_keys()
+        client_id = ticket.client_id
+        now = ticket.enqueued_at
+        best: Optional[Ticket] = None
+        # Someone sharing a tag (or also untagged), in the same region
+        for key in keys[:-1]:
+            other_id = self._oldest_other(
+                self._buckets.get(key), client_id, now
+            )
+            if other_id is None:
+                continue
+            other = self._waiting[other_id]
+            if best is None or other.enqueued_at < best.enqueued_at:
+                best = other
+        if best is not None:
+            return best.client_id
+        # Someone who has waited long enough to take anyone from the region
+        other_id = self._oldest_other(
+            self._buckets.get(keys[-1]), client_id, now
+        )
+        if (
+            other_id is not None
+            and now - self._waiting[other_id].enqueued_at >= self.widen_after
+        ):
+            return other_id
+        # Someone who has waited long enough to take anyone at all
+        other_id = self._oldest_other(self._waiting, client_id, now)
+        if (
+            other_id is not None
+            and now - self._waiting[other_id].enqueued_at
+            >= 2 * self.widen_after
+        ):
+            return other_id
+        return None
+
+    def widen(self) -> List[Tuple[str, str]]:
+        """
+        Pair waiting clients whose waits now allow a wider search.
+
+        Only clients that have waited at least `widen_after` are looked at,
+        oldest first; they are the head of the global queue.
+
+        Returns:
+            List[Tuple[str, str]]: The new pairs, longest waiting first.
+        """
+        now = self.clock()
+        stale: List[Ticket] = []
+        for ticket in self._waiting.values():
+            if now - ticket.enqueued_at < self.widen_after:
+                break
+            stale.append(ticket)
+        pairs: List[Tuple[str, str]] = []
+        for ticket in stale:
+            client_id = ticket.client_id
+            if client_id not in self._waiting:
+                # Taken as a partner earlier in this pass
+                continue
+            partner_id = self._oldest_other(
+                self._buckets.get((ticket.preferences.region, None)),
+                client_id,
+                now
+            )
+            if (
+                partner_id is None
+                and now - ticket.enqueued_at >= 2 * self.widen_after
+            ):
+                partner_id = self._oldest_other(self._waiting, client_id, now)
+            if partner_id is None:
+                continue
+            self._remove(client_id)
+            self._remove(partner_id)
+            self._pair(client_id, partner_id)
+            pairs.append((client_id, partner_id))
+        return pairs
+
+    def _pair(self, client_id: str, partner_id: str) -> None:
+        self._pairs[client_id] = partner_id
+        self._pairs[partner_id] = client_id
+
+    def _remove(self, client_id: str) -> Optional[Ticket]:
+        ticket = self._waiting.pop(client_id, None)
+        if ticket is None:
+            return None
+        for key in ticket.bucket_keys():
+            bucket = self._buckets[key]
+            del bucket[client_id]
+            if not bucket:
+                # Keep memory proportional to the clients waiting
+                del self._buckets[key]
+        return ticket
+
+    def leave(self, client_id: str) -> Optional[str]:
+        """
+        Remove the client from the queue and break its pair, if any.
+
+        The former partner is left unpaired; it is up to the caller to
+        requeue it with `join`.
+
+        Args:
+            client_id (str): The client that is leaving.
+
+        Returns:
+            Optional[str]: The former partner id, if the client was paired.
+        """
+        self._remove(client_id)
+        self._avoid.pop(client_id, None)
+        partner_id = self._pairs.pop(client_id, None)
+        if partner_id is not None:
+            self._pairs.pop(partner_id, None)
+        return partner_id
+
+    def skip(self, client_id: str) -> Optional[str]:
+        """
+        Break the client's pair and keep the two apart for a while.
+
+        Both are left unpaired, ready to be requeued with `join`.
+
+        Args:
+            client_id (str): The client that wants another stranger.
+
+        Returns:
+            Optional[str]: The skipped partner id, None if the client was
+              not paired.
+        """
+        partner_id = self._pairs.pop(client_id, None)
+        if partner_id is None:
+            return None
+        self._pairs.pop(partner_id, None)
+        until = self.clock() + self.rematch_after
+        self._remember(client_id, partner_id, until)
+        self._remember(partner_id, client_id, until)
+        return partner_id
+
+    def withdraw(self, client_id: str) -> Optional[str]:
+        """
+        Take the client out of the queue but keep its pair, for a client
+        that is about to reconnect and resume.
+
+        Returns:
+            Optional[str]: The partner id, if the client is paired.
+        """
+        self._remove(client_id)
+        return self._pairs.get(client_id)
+
+    def restore(self, client_id: str, partner_id: str) -> bool:
+        """
+        Put a pair back together after both sides reconnected.
+
+        Returns:
+            bool: True if the two are paired, already or now; False if
+              either is waiting or paired with someone else.
+        """
+        if self._pairs.get(client_id) == partner_id:
+            return True
+        if client_id == partner_id:
+            return False
+        for side in (client_id, partner_id):
+            if side in self._pairs or side in self._waiting:
+                return False
+        self._pair(client_id, partner_id)
+        return True
+
+    def _remember(self, client_id: str, other_id: str, until: float) -> None:
+        avoid = self._avoid.get(client_id)
+        if avoid is None:
+            avoid = self._avoid[client_id] = OrderedDict()
+        avoid[other_id] = until
+        avoid.move_to_end(other_id)
+        if len(avoid) > self.avoid_size:
+            avoid.popitem(last=False)
+
+    def partner_of(self, client_id: str) -> Optional[str]:
+        """
+        Return the current partner of the client, if any.
+        """
+        return self._pairs.get(client_id)
+
+    def status_of(self, client_id: str) -> Optional[str]:
+        """
+        Return `STATUS_CONNECTED`, `STATUS_AVAILABLE` or None if unknown.
+        """
+        if client_id in self._pairs:
+            return STATUS_CONNECTED
+        if client_id in self._waiting:
+            return STATUS_AVAILABLE
+        return None
+
+    @property
+    def waiting_count(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def bucket_count(self) -> int:
+        return len(self._buckets)
+
+    @property
+    def pair_count(self) -> int:
+        return len(self._pairs) // 2
@@ -0,0 +1,182 @@
+"""
+Prometheus metrics
+"""
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+try:
+    import prometheus_client
+    from prometheus_client.core import (
+        REGISTRY,
+        CounterMetricFamily,
+        GaugeMetricFamily
+    )
+except ImportError:  # pragma: no cover - prometheus_client is optional
+    prometheus_client = None
+    REGISTRY = None
+
+
+# Frame types get their own label value, anything a client makes up is
+# counted as "other" so labels stay bounded
+FRAME_TYPES = frozenset({
+    "offer", "answer", "candidate", "candidates", "chat", "ping", "pong",
+    "skip", "matched", "waiting", "partner_left", "reconnect", "resumed",
+    "partner_reconnecting",
+})
+
+# Seconds; signaling sends and MongoDB calls are in the sub-millisecond to
+# second range, match waits in the second to minute range
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class _NullMetric:
+    """
+    Accepts every metric call and records nothing.
+    """
+
+    def labels(self, *args: Any, **kwargs: Any) -> "_NullMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        return None
+
+    def set(self, value: float) -> None:
+        return None
+
+    def set_function(self, func: Callable[[], float]) -> None:
+        return None
+
+    def observe(self, amount: float) -> None:
+        return None
+
+
+def _metric(kind: str, name: str, documentation: str, **kwargs: Any) -> Any:
+    if prometheus_client is None:
+        return _NullMetric()
+    return getattr(prometheus_client, kind)(name, documentation, **kwargs)
+
+
+CONNECTED_SOCKETS = _metric(
+    "Gauge", "omegle_connected_sockets",
+    "Websockets attached to this process"
+)
+WAITING_CLIENTS = _metric(
+    "Gauge", "omegle_waiting_clients",
+    "Clients in the matchmaking queue"
+)
+MATCH_LATENCY = _metric(
+    "Histogram", "omegle_match_latency_seconds",
+    "Time from looking for a partner to being matched",
+    buckets=WAIT_BUCKETS
+)
+SKIP_LATENCY = _metric(
+    "Histogram", "omegle_skip_latency_seconds",
+    "Time from a skip to both sides being matched or queued again",
+    buckets=LATENCY_BUCKETS
+)
+FRAMES_IN = _metric(
+    "Counter", "omegle_frames_received",
+    "Signaling frames received, by type",
+    labelnames=("type",)
+)
+FRAMES_OUT = _metric(
+    "Counter", "omegle_frames_sent",
+    "Signaling frames queued for a peer, by type",
+    labelnames=("type",)
+)
+SEND_LATENCY = _metric(
+    "Histogram", "omegle_send_latency_seconds",
+    "Time to write one frame to a websocket",
+    buckets=LATENCY_BUCKETS
+)
+MONGODB_LATENCY = _metric(
+    "Histogram", "omegle_mongodb_latency_seconds",
+    "Duration of MongoDB calls, by Database method",
+    labelnames=("method",),
+    buckets=LATENCY_BUCKETS
+)
+FUNCTION_LATENCY = _metric(
+    "Histogram", "omegle_function_latency_seconds",
+    "Duration of functions timed with calculate_running_time",
+    labelnames=("function",),
+    buckets=LATENCY_BUCKETS
+)
+
+
+def frame_type(kind: Optional[str]) -> str:
+    return kind if kind in FRAME_TYPES else "other"
+
+
+def count_frame_in(kind: Optional[str]) -> None:
+    FRAMES_IN.labels(frame_type(kind)).inc()
+
+
+def count_frame_out(kind: Optional[str]) -> None:
+    FRAMES_OUT.labels(frame_type(kind)).inc()
+
+
+class StatsCollector:
+    """
+    Exports the counters of a `stats()` method at scrape time.
+
+    Components keep plain integer counters on their hot paths; they are
+    only read when Prometheus scrapes. Keys listed in `gauges` are exported
+    as gauges, the others as counters. A dict value becomes one counter
+    with a `type` label per key.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        stats: Callable[[], Dict[str, Any]],
+        gauges: Iterable[str] = ()
+    ) -> None:
+        self.prefix: str = prefix
+        self.stats: Callable[[], Dict[str, Any]] = stats
+        self.gauges: Tuple[str, ...] = tuple(gauges)
+
+    def collect(self) -> Iterable[Any]:
+        for key, value in self.stats().items():
+            name = f"{self.prefix}_{key}"
+            documentation = f"{key} of {self.prefix}"
+            if isinstance(value, dict):
+                family = CounterMetricFamily(
+                    name, documentation, labels=("type",)
+                )
+                for label, count in value.items():
+                    family.add_metric((str(label),), count)
+                yield family
+            elif not isinstance(value, (int, float)):
+                continue
+            elif key in self.gauges:
+                yield GaugeMetricFamily(name, documentation, value=value)
+            else:
+                yield CounterMetricFamily(name, documentation, value=value)
+
+
+def register_stats(
+    prefix: str,
+    stats: Callable[[], Dict[str, Any]],
+    gauges: Iterable[str] = ()
+) -> None:
+    """
+    Export a component's `stats()` counters under `prefix`.
+    """
+    if REGISTRY is not None:
+        REGISTRY.register(StatsCollector(prefix, stats, gauges))
+
+
+def render() -> Optional[Tuple[bytes, str]]:
+    """
+    Return the exposition body and its content type, or None if
+    prometheus_client is not installed.
+    """
+    if prometheus_client is None:
+        return None
+    return (
+        prometheus_client.generate_latest(REGISTRY),
+        prometheus_client.CONTENT_TYPE_LATEST
+    )
@@ -6,6 +6,7 @@ import pytz
 from bson.objectid import ObjectId
 
 from pydantic import BaseModel, Field
+from pymongo import ASCENDING, DESCENDING, IndexModel
 from pydantic.functional_validators import BeforeValidator
 
 # from db_connection import Database
@@ -14,11 +15,49 @@ from typing import Optional, List
 from typing_extensions import Annotated
 
 
+# Built once, `pytz.timezone` is too slow for every default factory call
+TIMEZONE = pytz.timezone('Asia/Calcutta')
+
+
 def get_current_date() -> datetime:
-    current_time: datetime = datetime.now(pytz.timezone('Asia/Calcutta'))
+    current_time: datetime = datetime.now(TIMEZONE)
     return current_time
 
 
+def connection_indexes(expire_after_seconds: int = 3600) -> List[IndexModel]:
+    """
+    Indexes of the connections collection: filtering by status while paging
+    by `_id`, and a TTL on `created_at` that also serves time range queries.
+    """
+    return [
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel(
+            [("created_at", ASCENDING)],
+            expireAfterSeconds=expire_after_seconds
+        ),
+    ]
+
+
+def session_indexes(
+    expire_after_seconds: int = 30 * 86400
+) -> List[IndexModel]:
+    """
+    Indexes of the sessions collection: a TTL on `started_at` that also
+    serves the time windows of the analytics pipelines, the open session
+    of a client (to close it), a client's history, and sessions by how
+    they ended.
+    """
+    return [
+        IndexModel(
+            [("started_at", ASCENDING)],
+            expireAfterSeconds=expire_after_seconds
+        ),
+        IndexModel([("clients", ASCENDING), ("ended_at", ASCENDING)]),
+        IndexModel([("clients", ASCENDING), ("started_at", DESCENDING)]),
+        IndexModel([("end_reason", ASCENDING), ("started_at", ASCENDING)]),
+    ]
+
+
 # Represents an ObjectId field in the database.
 # It will be represented as a `str` on the model
 # so that it can be serialized to JSON.
@@ -37,6 +76,9 @@ class ConnectionModel(BaseModel):
     status: bool = Field(default=False)
     created_at: datetime = Field(default_factory=get_current_date)
     updated_at: datetime = Field(default_factory=get_current_date)
+    # Matchmaking preferences the client connected with
+    region: Optional[str] = Field(default=None)
+    tags: Optional[List[str]] = Field(default=None)
 
     class Config:
         """
@@ -79,6 +121,109 @@ class ConnectionCollection(BaseModel):
     """
 
     connections: List[ConnectionModel]
+    # Pass as `cursor` to fetch the next page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+class BulkConnectionOperation(UpdateConnectionModel):
+    """
+    One change in a bulk request.
+
+    With an `id` the existing record is updated, without one a new record
+    is inserted.
+    """
+    id: Optional[PyObjectId] = Field(default=None)
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "id": "65f1c0ffee0ddba11ba5e000",
+                "status": True,
+            }
+        }
+
+
+class BulkConnectionRequest(BaseModel):
+    """
+    A batch of connection changes applied with a single `bulk_write`.
+    """
+    operations: List[BulkConnectionOperation] = Field(min_length=1)
+
+
+class BulkConnectionResult(BaseModel):
+    """
+    The outcome of one operation of a bulk request, in request order.
+    """
+    index: int
+    id: Optional[str] = None
+    ok: bool = True
+    error: Optional[str] = None
+
+
+class BulkConnectionResponse(BaseModel):
+    """
+    Per-operation results and the totals reported by MongoDB.
+
+    MongoDB does not say which updates matched a document, so a missing
+    record only shows up in `matched_count`.
+    """
+    results: List[BulkConnectionResult]
+    inserted_count: int = 0
+    matched_count: int = 0
+    modified_count: int = 0
+
+
+class WaitTimeStats(BaseModel):
+    """
+    How long clients waited for a match, over sessions started in a window.
+    """
+    since: datetime
+    until: datetime
+    count: int = 0
+    mean: Optional[float] = None
+    p50: Optional[float] = None
+    p95: Optional[float] = None
+    max: Optional[float] = None
+
+
+class SessionStats(BaseModel):
+    """
+    Session counts and call durations, in seconds, by how sessions ended.
+
+    Open sessions are reported under the `null` end reason without
+    durations.
+    """
+    end_reason: Optional[str] = None
+    count: int = 0
+    mean_duration: Optional[float] = None
+    max_duration: Optional[float] = None
+
+
+class SessionSummary(BaseModel):
+    """
+    `SessionStats` of the sessions started in a window.
+    """
+    since: datetime
+    until: datetime
+    sessions: List[SessionStats]
+
+
+class ConcurrencySample(BaseModel):
+    """
+    Users in a call and calls in progress during one minute.
+    """
+    minute: datetime
+    users: int
+    sessions: int
+
+
+class ConcurrencySeries(BaseModel):
+    """
+    One `ConcurrencySample` per minute of a window with a call in progress.
+    """
+    since: datetime
+    until: datetime
+    minutes: List[ConcurrencySample]
 
 # conn_obj = Connection(status=1)
 
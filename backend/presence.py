@@ -0,0 +1,101 @@
+"""
+Live presence counters: who is online, waiting or in a call
+"""
+import asyncio
+from typing import Dict, Optional, Set
+
+from backplane import Backplane
+from registry import ConnectionRegistry
+
+
+class PresenceHub:
+    """
+    Publishes presence counts and pushes them to subscribers.
+
+    The counts of this process come straight from the registry, which
+    keeps them up to date as clients attach, wait, pair and leave, so
+    reading them never touches MongoDB. Every `interval` seconds a single
+    task shares them through the backplane, reads back the cluster totals
+    and, if anything changed, hands the totals to every subscriber.
+
+    A subscriber is a queue holding only the latest counts: a slow one
+    skips intermediate values instead of growing a backlog.
+    """
+
+    def __init__(
+        self,
+        registry: ConnectionRegistry,
+        backplane: Backplane,
+        interval: float = 1.0
+    ) -> None:
+        self.registry: ConnectionRegistry = registry
+        self.backplane: Backplane = backplane
+        self.interval: float = interval
+        # Cluster totals as of the last tick, the local counts until then
+        self.totals: Dict[str, int] = registry.presence()
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.pushes: int = 0
+        self.failed: int = 0
+
+    def local(self) -> Dict[str, int]:
+        """
+        Return the counts of the clients attached to this process.
+        """
+        return self.registry.presence()
+
+    def subscribe(self) -> asyncio.Queue:
+        """
+        Return a queue receiving the totals now and whenever they change.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        queue.put_nowait(self.totals)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "subscribers": len(self._subscribers),
+            "pushes": self.pushes,
+            "failed": self.failed,
+        }
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._subscribers.clear()
+
+    async def refresh(self) -> None:
+        """
+        Publish the local counts, read the totals and push them if changed.
+        """
+        local = self.local()
+        try:
+            await self.backplane.publish_presence(local)
+            totals = await self.backplane.cluster_presence()
+        except Exception as ex:
+            self.failed += 1
+            print(f"Presence refresh failed: {ex}")
+            totals = None
+        totals = local if totals is None else totals
+        if totals == self.totals:
+            return
+        self.totals = totals
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(totals)
+            self.pushes += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.refresh()
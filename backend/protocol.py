@@ -0,0 +1,238 @@
+"""
+Compact binary signaling protocol
+"""
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from serialization import frame_dumps, frame_loads
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+
+# A frame queued for a websocket: text for JSON clients, bytes for compact
+Frame = Union[str, bytes]
+
+# Websocket subprotocol a client offers to switch to compact frames
+COMPACT_PROTOCOL = "omegle.compact.v1"
+
+# Message type <-> the first byte of a compact frame
+TYPE_CODES: Dict[str, int] = {
+    "offer": 1,
+    "answer": 2,
+    "candidate": 3,
+    "candidates": 4,
+    "matched": 16,
+    "waiting": 17,
+    "partner_left": 18,
+    "skip": 19,
+    "reconnect": 20,
+    "resumed": 21,
+    "partner_reconnecting": 22,
+    "ping": 32,
+    "pong": 33,
+}
+TYPE_NAMES: Dict[int, str] = {code: name for name, code in TYPE_CODES.items()}
+
+HEADER_SIZE = 2
+MAX_PEER_ID_LENGTH = 255
+
+# MessagePack of a one-entry map keyed "candidate" / "candidates", up to
+# the value: the body of a `candidate` frame and of a `candidates` batch
+CANDIDATE_PREFIX = b"\x81\xa9candidate"
+CANDIDATES_PREFIX = b"\x81\xaacandidates"
+
+# Raised by msgpack and the JSON encoders for values they cannot hold,
+# e.g. integers of 2**64 and more or binary data in JSON
+ENCODE_ERRORS = (ValueError, OverflowError, TypeError)
+
+
+class FrameError(ValueError):
+    """
+    Raised for a compact frame with a truncated or malformed header.
+    """
+
+
+def encode_frame(type_code: int, peer_id: str, payload: bytes = b"") -> bytes:
+    """
+    Build a compact frame.
+
+    A frame is a one byte type code, a one byte peer id length, the ascii
+    peer id and the payload. The payload is the MessagePack encoded body of
+    the message (everything but `type` and `peer_id`) and is never decoded
+    by the server when both peers speak the compact protocol.
+    """
+    peer = peer_id.encode("ascii")
+    return bytes((type_code, len(peer))) + peer + payload
+
+
+def read_header(frame: bytes) -> Tuple[int, str, int]:
+    """
+    Return the type code, peer id and payload offset of a compact frame.
+    """
+    if len(frame) < HEADER_SIZE:
+        raise FrameError("Truncated frame header")
+    offset = HEADER_SIZE + frame[1]
+    if len(frame) < offset:
+        raise FrameError("Truncated peer id")
+    try:
+        peer_id = frame[HEADER_SIZE:offset].decode("ascii")
+    except UnicodeDecodeError:
+        raise FrameError("Peer id is not ascii") from None
+    return frame[0], peer_id, offset
+
+
+def readdress(frame: bytes, peer_id: str) -> bytes:
+    """
+    Replace the peer id of a compact frame, copying the payload as is.
+    """
+    _, _, offset = read_header(frame)
+    return encode_frame(frame[0], peer_id, frame[offset:])
+
+
+def message_to_compact(message: Dict[str, Any]) -> Optional[bytes]:
+    """
+    Encode a decoded JSON message as a compact frame.
+
+    Returns:
+        Optional[bytes]: The frame, or None if the message type has no
+          type code or a body has to be encoded and msgpack is missing.
+    """
+    type_code = TYPE_CODES.get(message.get("type"))
+    if type_code is None:
+        return None
+    body = {
+        key: value
+        for key, value in message.items()
+        if key not in ("type", "peer_id")
+    }
+    payload = b""
+    if body:
+        if msgpack is None:
+            return None
+        payload = msgpack.packb(body)
+    return encode_frame(type_code, message.get("peer_id", ""), payload)
+
+
+def compact_to_message(frame: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Decode a compact frame into the equivalent JSON message.
+
+    Returns:
+        Optional[Dict[str, Any]]: The message, or None if the frame is
+          malformed or has a body and msgpack is missing.
+    """
+    try:
+        type_code, peer_id, offset = read_header(frame)
+    except FrameError:
+        return None
+    if type_code not in TYPE_NAMES:
+        return None
+    message: Dict[str, Any] = {}
+    if len(frame) > offset:
+        if msgpack is None:
+            return None
+        try:
+            body = msgpack.unpackb(frame[offset:])
+        except ValueError:
+            return None
+        if not isinstance(body, dict):
+            return None
+        message.update(body)
+    message["type"] = TYPE_NAMES[type_code]
+    if peer_id:
+        message["peer_id"] = peer_id
+    return message
+
+
+def transcode(frame: Frame, compact: bool) -> Optional[Frame]:
+    """
+    Convert a frame to the protocol of the receiving connection.
+
+    Only needed when the two sides of a pair speak different protocols.
+
+    Args:
+        frame (Frame): A JSON text frame or a compact frame.
+        compact (bool): Whether the receiver speaks the compact protocol.
+    Returns:
+        Optional[Frame]: The converted frame, or None if it cannot be
+          converted.
+    """
+    if isinstance(frame, bytes) == compact:
+        return frame
+    try:
+        if compact:
+            message = frame_loads(frame)
+            if not isinstance(message, dict):
+                return None
+            return message_to_compact(message)
+        message = compact_to_message(frame)
+        return frame_dumps(message) if message is not None else None
+    except ENCODE_ERRORS:
+        # Valid on one side only, e.g. an integer msgpack cannot hold or
+        # binary data JSON cannot
+        return None
+
+
+def split_candidate(frame: bytes) -> Optional[bytes]:
+    """
+    Return the MessagePack encoded candidate of a compact `candidate`
+    frame, without decoding it.
+
+    Returns:
+        Optional[bytes]: The candidate, or None if the body is anything
+          but `{"candidate": ...}`.
+    """
+    _, _, offset = read_header(frame)
+    if not frame.startswith(CANDIDATE_PREFIX, offset):
+        return None
+    return frame[offset + len(CANDIDATE_PREFIX):]
+
+
+def pack_candidate(candidate: Any) -> Optional[bytes]:
+    """
+    Encode a decoded candidate like `split_candidate` returns it, or
+    return None if msgpack is missing or cannot encode it.
+    """
+    if msgpack is None:
+        return None
+    try:
+        return msgpack.packb(candidate)
+    except ENCODE_ERRORS:
+        return None
+
+
+def unpack_candidate(candidate: bytes) -> Any:
+    """
+    Decode a candidate returned by `split_candidate`.
+    """
+    return msgpack.unpackb(candidate)
+
+
+def candidates_payload(candidates: List[bytes]) -> bytes:
+    """
+    Build the body of a compact `candidates` frame from MessagePack
+    encoded candidates, by writing the array header in front of them.
+
+    The result is `{"candidates": [...]}` in MessagePack, like any other
+    body, so batches are transcoded to JSON the usual way.
+    """
+    count = len(candidates)
+    if count < 16:
+        header = bytes((0x90 | count,))
+    else:
+        header = b"\xdc" + count.to_bytes(2, "big")
+    return CANDIDATES_PREFIX + header + b"".join(candidates)
+
+
+def negotiate(offered: Any) -> Optional[str]:
+    """
+    Pick the subprotocol to accept from the ones the client offered.
+
+    Returns:
+        Optional[str]: `COMPACT_PROTOCOL`, or None to keep JSON.
+    """
+    if offered and COMPACT_PROTOCOL in offered:
+        return COMPACT_PROTOCOL
+    return None
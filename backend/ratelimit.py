@@ -0,0 +1,88 @@
+"""
+Token-bucket rate limiting of incoming signaling frames
+"""
+import time
+from typing import Dict, List, Optional, Tuple
+
+from registry import ConnectionRecord
+
+
+# Message type -> (tokens per second, burst). `None` is the limit of the
+# whole connection, checked for every frame; types without a limit of
+# their own share the "default" bucket.
+DEFAULT_LIMITS: Dict[Optional[str], Tuple[float, float]] = {
+    None: (100.0, 200.0),
+    "offer": (2.0, 5.0),
+    "answer": (2.0, 5.0),
+    "candidate": (50.0, 100.0),
+    "chat": (5.0, 10.0),
+    "skip": (1.0, 3.0),
+    "default": (10.0, 20.0),
+}
+
+
+class RateLimiter:
+    """
+    Token buckets per connection and per message type.
+
+    A bucket is a two item list (tokens, last refill) stored on the
+    `ConnectionRecord` and created on first use, so an idle connection
+    costs nothing and a busy one a handful of floats. Buckets are refilled
+    lazily when a frame arrives; there is no timer.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[Optional[str], Tuple[float, float]]] = None
+    ) -> None:
+        self.limits: Dict[Optional[str], Tuple[float, float]] = (
+            limits if limits is not None else DEFAULT_LIMITS
+        )
+        # Limited message type (or "default") -> frames dropped
+        self.throttled: Dict[str, int] = {}
+
+    def allow(self, record: ConnectionRecord, kind: Optional[str]) -> bool:
+        """
+        Take a token for a frame of the given type.
+
+        Args:
+            record (ConnectionRecord): The sending connection.
+            kind (Optional[str]): The message type, None if unknown.
+        Returns:
+            bool: False if the frame should be dropped.
+        """
+        now = time.monotonic()
+        if record.buckets is None:
+            record.buckets = {}
+        key = kind if kind is not None and kind in self.limits else "default"
+        if not (
+            self._take(record.buckets, key, now)
+            and self._take(record.buckets, None, now)
+        ):
+            self.throttled[key] = self.throttled.get(key, 0) + 1
+            return False
+        return True
+
+    def _take(
+        self,
+        buckets: Dict[Optional[str], List[float]],
+        key: Optional[str],
+        now: float
+    ) -> bool:
+        limit = self.limits.get(key)
+        if limit is None:
+            return True
+        rate, burst = limit
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1.0:
+            return False
+        bucket[0] -= 1.0
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.throttled)
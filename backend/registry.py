@@ -0,0 +1,246 @@
+"""
+Connection registry and client id generation
+"""
+import asyncio
+import string
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from bson.objectid import ObjectId
+from fastapi import WebSocket
+
+
+ALPHABET = string.digits + string.ascii_letters
+
+# 2024-01-01T00:00:00Z, in milliseconds
+EPOCH_MS = 1704067200000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Presence of an attached client: connected but not looking yet (or
+# between partners), waiting for a partner, or paired
+PRESENCE_IDLE = "idle"
+PRESENCE_WAITING = "waiting"
+PRESENCE_IN_CALL = "in_call"
+PRESENCE_STATES = (PRESENCE_IDLE, PRESENCE_WAITING, PRESENCE_IN_CALL)
+
+
+def encode_base62(number: int) -> str:
+    """
+    Encode a non-negative integer with digits and ascii letters.
+    """
+    if number == 0:
+        return ALPHABET[0]
+    chars: List[str] = []
+    while number:
+        number, remainder = divmod(number, 62)
+        chars.append(ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+def decode_base62(text: str) -> int:
+    """
+    Decode a string produced by `encode_base62`.
+    """
+    number = 0
+    for char in text:
+        number = number * 62 + ALPHABET.index(char)
+    return number
+
+
+def document_id(client_id: str) -> ObjectId:
+    """
+    Return the `_id` of the connection document of a client.
+
+    The id is derived from the client id alone, so any worker can address
+    the document of any client. Like a regular ObjectId it starts with the
+    creation time in seconds, followed by the 64-bit client id.
+    """
+    number = decode_base62(client_id)
+    seconds = ((number >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS) // 1000
+    return ObjectId(seconds.to_bytes(4, "big") + number.to_bytes(8, "big"))
+
+
+class IdGenerator:
+    """
+    Snowflake-style id generator.
+
+    An id packs the milliseconds since `EPOCH_MS`, the worker id and a
+    per-millisecond sequence into 64 bits and is rendered in base62
+    (at most 11 characters). Ids are unique as long as every worker sharing
+    the id space has a distinct worker id, and increase monotonically
+    within a worker even if the wall clock steps back.
+    """
+
+    def __init__(self, worker_id: int = 0) -> None:
+        self.worker_id = worker_id
+        self._last_ms: int = 0
+        self._sequence: int = 0
+        self._lock = threading.Lock()
+
+    @property
+    def worker_id(self) -> int:
+        return self._worker_id
+
+    @worker_id.setter
+    def worker_id(self, worker_id: int) -> None:
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(
+                f"worker_id must be between 0 and {MAX_WORKER_ID}"
+            )
+        self._worker_id = worker_id
+
+    def next_int(self) -> int:
+        with self._lock:
+            now_ms = int(time.time() * 1000) - EPOCH_MS
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            elif self._sequence < MAX_SEQUENCE:
+                self._sequence += 1
+            else:
+                # Sequence exhausted (or the clock went back): borrow the
+                # next millisecond instead of spinning
+                self._last_ms += 1
+                self._sequence = 0
+            return (
+                (self._last_ms << (WORKER_BITS + SEQUENCE_BITS))
+                | (self._worker_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+    def next_id(self) -> str:
+        return encode_base62(self.next_int())
+
+
+class ConnectionRecord:
+    """
+    Per-connection state kept for every open websocket.
+    """
+    __slots__ = (
+        "client_id", "websocket", "outbox", "writer", "connected_at",
+        "compact", "last_seen", "buckets", "waiting_since", "presence",
+        "batch", "pending"
+    )
+
+    def __init__(self, client_id: str, websocket: WebSocket) -> None:
+        self.client_id: str = client_id
+        self.websocket: WebSocket = websocket
+        # Whether the client negotiated the compact binary protocol
+        self.compact: bool = False
+        self.outbox: Optional[asyncio.Queue] = None
+        self.writer: Optional[asyncio.Task] = None
+        self.connected_at: float = time.monotonic()
+        # When a frame was last received, see `LivenessMonitor`
+        self.last_seen: float = self.connected_at
+        # Token buckets of the `RateLimiter`, created on first use
+        self.buckets: Optional[dict] = None
+        # perf_counter() when the client started waiting for a partner
+        self.waiting_since: Optional[float] = None
+        # One of `PRESENCE_STATES`, counted by the registry
+        self.presence: str = PRESENCE_IDLE
+        # Whether the client takes batched `candidates` frames, and the
+        # batch being collected for it, see `SignalingRouter`
+        self.batch: bool = False
+        self.pending: Optional[Any] = None
+
+
+class ConnectionRegistry:
+    """
+    Maps client ids to their `ConnectionRecord`.
+
+    Records are spread over a fixed number of dict shards so no single dict
+    has to be resized (and copied) in one go while tens of thousands of
+    sockets are attached.
+
+    The registry also counts its records by presence state as they change,
+    so `presence` is a constant-time snapshot.
+    """
+
+    def __init__(
+        self,
+        ids: Optional[IdGenerator] = None,
+        shard_count: int = 16
+    ) -> None:
+        if shard_count < 1 or shard_count & (shard_count - 1):
+            raise ValueError("shard_count must be a power of two")
+        self.ids: IdGenerator = ids or IdGenerator()
+        self._mask: int = shard_count - 1
+        self._shards: List[dict] = [{} for _ in range(shard_count)]
+        self._count: int = 0
+        self._presence: Dict[str, int] = dict.fromkeys(PRESENCE_STATES, 0)
+
+    def _shard(self, client_id: str) -> dict:
+        return self._shards[hash(client_id) & self._mask]
+
+    def register(
+        self,
+        websocket: WebSocket,
+        client_id: Optional[str] = None
+    ) -> ConnectionRecord:
+        """
+        Add a connection under a fresh id, or under `client_id` if given.
+
+        Args:
+            websocket (WebSocket): The accepted websocket.
+            client_id (Optional[str]): An id to reuse.
+        Returns:
+            ConnectionRecord: The new record.
+        """
+        if client_id is None:
+            client_id = self.ids.next_id()
+        shard = self._shard(client_id)
+        if client_id in shard:
+            raise KeyError(f"Client {client_id} is already registered")
+        record = ConnectionRecord(client_id, websocket)
+        shard[client_id] = record
+        self._count += 1
+        self._presence[record.presence] += 1
+        return record
+
+    def get(self, client_id: str) -> Optional[ConnectionRecord]:
+        return self._shard(client_id).get(client_id)
+
+    def unregister(self, client_id: str) -> Optional[ConnectionRecord]:
+        """
+        Remove a connection and return its record, if it was registered.
+        """
+        record = self._shard(client_id).pop(client_id, None)
+        if record is not None:
+            self._count -= 1
+            self._presence[record.presence] -= 1
+        return record
+
+    def set_presence(self, client_id: str, state: str) -> bool:
+        """
+        Move an attached client to another presence state.
+
+        Returns:
+            bool: False if the client is not attached here.
+        """
+        record = self._shard(client_id).get(client_id)
+        if record is None:
+            return False
+        self._presence[record.presence] -= 1
+        self._presence[state] += 1
+        record.presence = state
+        return True
+
+    def presence(self) -> Dict[str, int]:
+        """
+        Count the attached clients, in total and by presence state.
+        """
+        return {"online": self._count, **self._presence}
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self._shard(client_id)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[ConnectionRecord]:
+        for shard in self._shards:
+            yield from list(shard.values())
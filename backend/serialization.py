@@ -0,0 +1,63 @@
+"""
+JSON serialization helpers for responses and signaling frames
+"""
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import orjson
+from pydantic import TypeAdapter
+
+from models import ConnectionCollection, ConnectionModel
+
+
+# Validators/serializers are built once, not per request
+CONNECTION_ADAPTER: TypeAdapter = TypeAdapter(ConnectionModel)
+COLLECTION_ADAPTER: TypeAdapter = TypeAdapter(ConnectionCollection)
+
+
+def dump_connection(document: Dict[str, Any]) -> bytes:
+    """
+    Serialize a raw connection document straight to JSON bytes.
+
+    Fields missing from the document (e.g. because of a projection) are
+    left out rather than filled with defaults.
+    """
+    return CONNECTION_ADAPTER.dump_json(
+        CONNECTION_ADAPTER.validate_python(document), exclude_unset=True
+    )
+
+
+def dump_collection(
+    documents: Iterable[Dict[str, Any]],
+    next_cursor: Optional[str] = None
+) -> bytes:
+    """
+    Serialize a page of raw connection documents straight to JSON bytes.
+    """
+    collection = COLLECTION_ADAPTER.validate_python(
+        {"connections": documents, "next_cursor": next_cursor}
+    )
+    return COLLECTION_ADAPTER.dump_json(collection, exclude_unset=True)
+
+
+def _orjson_dumps(message: Any) -> str:
+    return orjson.dumps(message).decode()
+
+
+def frame_codec(
+    name: Optional[str] = None
+) -> Tuple[Callable[[Any], Any], Callable[[Any], str]]:
+    """
+    Return the (loads, dumps) pair used for websocket frames.
+
+    `SIGNALING_JSON_CODEC=orjson` opts in to orjson, the standard library
+    is used otherwise.
+    """
+    name = name or os.environ.get("SIGNALING_JSON_CODEC", "json")
+    if name == "orjson":
+        return orjson.loads, _orjson_dumps
+    return json.loads, json.dumps
+
+
+frame_loads, frame_dumps = frame_codec()
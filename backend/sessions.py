@@ -0,0 +1,259 @@
+"""
+Session history: one document per pair, and the analytics run on it
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from bson.objectid import ObjectId
+from pymongo.operations import InsertOne, UpdateMany
+
+from db_connection import AsyncDatabase
+from models import get_current_date
+from write_behind import BatchWriter
+
+
+# How a session ended
+END_SKIP = "skip"
+END_LEFT = "left"
+END_TIMEOUT = "timeout"
+# A side moved to another worker and did not come back in time
+END_NOT_RESUMED = "not_resumed"
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MINUTE_MS = 60_000
+
+# Longest a session is taken to last: sessions left open, e.g. by a worker
+# that crashed, stop counting as in progress after that long
+MAX_SESSION = timedelta(hours=6)
+
+
+class SessionLog(BatchWriter):
+    """
+    Records when pairs start and end, in batches off the signaling path.
+
+    A session document holds the two client ids, `started_at`, the match
+    wait of each side known to this worker (`wait_seconds`), and once over
+    `ended_at`, `end_reason` and `ended_by`.
+
+    The end of a session is addressed by the client that ended it rather
+    than by `_id`, since with a shared backplane the pair may have been
+    made on another worker. Operations are therefore kept in order instead
+    of being merged by `_id`, and written with an ordered `bulk_write`.
+    """
+
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        max_batch: int = 500,
+        flush_interval: float = 1.0,
+        max_pending: int = 50_000
+    ) -> None:
+        super().__init__(
+            db,
+            max_batch=max_batch,
+            flush_interval=flush_interval,
+            max_pending=max_pending
+        )
+        self._pending: List[Union[InsertOne, UpdateMany]] = []
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _append(self, request: Union[InsertOne, UpdateMany]) -> bool:
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            self._wake.set()
+            return False
+        self._pending.append(request)
+        if len(self._pending) >= self.max_batch:
+            self._wake.set()
+        return True
+
+    def started(
+        self,
+        client_ids: Sequence[str],
+        waits: Sequence[Optional[float]] = ()
+    ) -> ObjectId:
+        """
+        Queue the start of a session between `client_ids`.
+
+        Args:
+            client_ids (Sequence[str]): Both sides of the pair.
+            waits (Sequence[Optional[float]]): Seconds each side waited for
+              the match, None where it is not known here.
+
+        Returns:
+            ObjectId: The `_id` of the session document.
+        """
+        session_id = ObjectId()
+        self._append(InsertOne({
+            "_id": session_id,
+            "clients": list(client_ids),
+            "started_at": get_current_date(),
+            "ended_at": None,
+            "end_reason": None,
+            "ended_by": None,
+            "wait_seconds": [wait for wait in waits if wait is not None],
+        }))
+        return session_id
+
+    def ended(self, client_id: str, reason: str) -> None:
+        """
+        Queue the end of the client's open session.
+        """
+        self._append(UpdateMany(
+            {"clients": client_id, "ended_at": None},
+            {"$set": {
+                "ended_at": get_current_date(),
+                "end_reason": reason,
+                "ended_by": client_id,
+            }}
+        ))
+
+    async def flush(self) -> None:
+        """
+        Write all pending operations now, in order.
+        """
+        async with self._flush_lock:
+            pending, self._pending = self._pending, []
+            for start in range(0, len(pending), self.max_batch):
+                batch = pending[start:start + self.max_batch]
+                try:
+                    await self.db.bulk_write(batch, ordered=True)
+                except Exception as ex:
+                    self.failed += len(batch)
+                    print(f"Session log flush failed: {ex}")
+                else:
+                    self.flushed += len(batch)
+
+
+def _window(since: datetime, until: datetime) -> Dict[str, Any]:
+    return {"$match": {"started_at": {"$gte": since, "$lt": until}}}
+
+
+def _nearest_rank(values: str, fraction: float) -> Dict[str, Any]:
+    return {"$arrayElemAt": [values, {"$toInt": {"$floor": {
+        "$multiply": [fraction, {"$size": values}]
+    }}}]}
+
+
+def wait_time_pipeline(
+    since: datetime,
+    until: datetime
+) -> List[Dict[str, Any]]:
+    """
+    Count, mean, p50, p95 and max of match waits of sessions started in
+    [since, until), in seconds.
+
+    Percentiles are nearest-rank over the sorted waits, which are gathered
+    into one document: fine up to about a million waits per window. The
+    `$percentile` accumulator would avoid that but needs MongoDB 7.0.
+    """
+    return [
+        _window(since, until),
+        {"$unwind": "$wait_seconds"},
+        {"$sort": {"wait_seconds": 1}},
+        {"$group": {
+            "_id": None,
+            "waits": {"$push": "$wait_seconds"},
+            "mean": {"$avg": "$wait_seconds"},
+            "max": {"$max": "$wait_seconds"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "count": {"$size": "$waits"},
+            "mean": 1,
+            "max": 1,
+            "p50": _nearest_rank("$waits", 0.50),
+            "p95": _nearest_rank("$waits", 0.95),
+        }},
+    ]
+
+
+def session_summary_pipeline(
+    since: datetime,
+    until: datetime
+) -> List[Dict[str, Any]]:
+    """
+    Sessions started in [since, until) by end reason, with the mean and
+    max call duration in seconds.
+    """
+    duration = {"$cond": [
+        {"$eq": ["$ended_at", None]},
+        None,
+        {"$divide": [{"$subtract": ["$ended_at", "$started_at"]}, 1000]},
+    ]}
+    return [
+        _window(since, until),
+        {"$group": {
+            "_id": "$end_reason",
+            "count": {"$sum": 1},
+            "mean_duration": {"$avg": duration},
+            "max_duration": {"$max": duration},
+        }},
+        {"$project": {
+            "_id": 0,
+            "end_reason": "$_id",
+            "count": 1,
+            "mean_duration": 1,
+            "max_duration": 1,
+        }},
+        {"$sort": {"count": -1}},
+    ]
+
+
+def concurrency_pipeline(
+    since: datetime,
+    until: datetime,
+    max_session: timedelta = MAX_SESSION
+) -> List[Dict[str, Any]]:
+    """
+    Users in a call and calls in progress per minute of [since, until).
+
+    Every session overlapping the window is expanded into the minutes it
+    spans, clamped to the window and to `max_session` after its start
+    (open sessions run to either), and the minutes are summed up. Since no
+    session lasts longer, only those started `max_session` before the
+    window are read, through the `started_at` index.
+    """
+    last = until - timedelta(milliseconds=1)
+    longest = {"$add": [
+        "$started_at", int(max_session.total_seconds() * 1000)
+    ]}
+
+    def minute(date: Any) -> Dict[str, Any]:
+        return {"$toInt": {"$floor": {"$divide": [
+            {"$subtract": [date, EPOCH]}, MINUTE_MS
+        ]}}}
+
+    return [
+        {"$match": {
+            "started_at": {"$gte": since - max_session, "$lt": until},
+            "$or": [{"ended_at": None}, {"ended_at": {"$gte": since}}],
+        }},
+        {"$project": {
+            "users": {"$size": "$clients"},
+            "minute": {"$range": [
+                minute({"$max": ["$started_at", since]}),
+                {"$add": [
+                    minute({"$min": [
+                        {"$ifNull": ["$ended_at", last]}, longest, last
+                    ]}),
+                    1,
+                ]},
+            ]},
+        }},
+        {"$unwind": "$minute"},
+        {"$group": {
+            "_id": "$minute",
+            "users": {"$sum": "$users"},
+            "sessions": {"$sum": 1},
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {
+            "_id": 0,
+            "minute": {"$add": [EPOCH, {"$multiply": ["$_id", MINUTE_MS]}]},
+            "users": 1,
+            "sessions": 1,
+        }},
+    ]
@@ -0,0 +1,422 @@
+"""
+Peer-to-peer signaling router
+"""
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+from backplane import Backplane
+from metrics import SEND_LATENCY, count_frame_out
+from protocol import (
+    TYPE_CODES,
+    TYPE_NAMES,
+    Frame,
+    CANDIDATE_PREFIX,
+    ENCODE_ERRORS,
+    FrameError,
+    candidates_payload,
+    compact_to_message,
+    encode_frame,
+    pack_candidate,
+    readdress,
+    split_candidate,
+    transcode,
+    unpack_candidate
+)
+from registry import ConnectionRecord, ConnectionRegistry
+from serialization import frame_dumps
+
+
+# Message types relayed between the two sides of a pair
+ROUTED_TYPES = frozenset({"offer", "answer", "candidate"})
+ROUTED_CODES = frozenset(TYPE_CODES[name] for name in ROUTED_TYPES)
+
+OUTBOX_SIZE = 256
+
+# What to do when a connection's outbox is full
+OVERFLOW_DROP = "drop"
+OVERFLOW_CLOSE = "close"
+
+# Close code for connections that cannot keep up ("Try Again Later")
+SLOW_CONSUMER_CODE = 1013
+
+# Seconds candidates for a peer are held to be sent together, and the most
+# sent in one `candidates` frame
+BATCH_WINDOW = 0.005
+MAX_BATCH = 32
+
+CANDIDATE_CODE = TYPE_CODES["candidate"]
+CANDIDATES_CODE = TYPE_CODES["candidates"]
+
+
+class _Batch:
+    """
+    Candidates from one sender waiting to be sent to a peer together.
+    """
+    __slots__ = ("sender_id", "items", "timer")
+
+    def __init__(self, sender_id: str, timer: asyncio.TimerHandle) -> None:
+        self.sender_id: str = sender_id
+        # Decoded candidates for JSON peers, MessagePack for compact ones
+        self.items: List[Any] = []
+        self.timer: asyncio.TimerHandle = timer
+
+
+class SignalingRouter:
+    """
+    Delivers signaling frames to individual peers.
+
+    Every attached connection owns a bounded outbound queue drained by its
+    own writer task, so a slow receiver only fills its own queue and never
+    blocks the sender. Frames are serialized once, before being queued.
+    Frames for connections attached to other processes are handed to the
+    backplane.
+
+    Compact frames are routed by their header alone. A frame is only
+    transcoded when it is queued for a connection that speaks the other
+    protocol.
+
+    When an outbox is full the frame is dropped (`OVERFLOW_DROP`) or, with
+    `OVERFLOW_CLOSE`, the slow connection is closed so its client can
+    reconnect instead of missing frames.
+
+    Clients attached with `batch` take `candidates` frames: the candidates
+    relayed to them within `batch_window` seconds of the first one are
+    sent as a single frame, so trickle ICE costs one send instead of one
+    per candidate. A batch is sent early when it is full, when a candidate
+    of another sender comes in and before any other frame for the client,
+    which keeps frames in order. A batch of one goes out as a plain
+    `candidate` frame. Other clients get every candidate on its own, as
+    do clients attached to other processes.
+    """
+
+    def __init__(
+        self,
+        registry: ConnectionRegistry,
+        backplane: Optional[Backplane] = None,
+        outbox_size: int = OUTBOX_SIZE,
+        overflow: str = OVERFLOW_DROP,
+        batch_window: float = BATCH_WINDOW
+    ) -> None:
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_CLOSE):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        self.registry: ConnectionRegistry = registry
+        self.backplane: Optional[Backplane] = backplane
+        self.outbox_size: int = outbox_size
+        self.overflow: str = overflow
+        self.batch_window: float = batch_window
+        self._closing: Set[asyncio.Task] = set()
+        self.sent: int = 0
+        self.dropped: int = 0
+        self.closed: int = 0
+        self.batches: int = 0
+        self.batched: int = 0
+
+    def attach(
+        self,
+        websocket: WebSocket,
+        client_id: Optional[str] = None,
+        compact: bool = False,
+        batch: bool = False
+    ) -> ConnectionRecord:
+        """
+        Register a connection and start its writer task.
+
+        Args:
+            websocket (WebSocket): The accepted websocket.
+            client_id (Optional[str]): An id to reuse instead of a new one.
+            compact (bool): Whether the client speaks the compact protocol.
+            batch (bool): Whether the client takes `candidates` frames.
+        Returns:
+            ConnectionRecord: The registry record of the connection.
+        """
+        record = self.registry.register(websocket, client_id)
+        record.compact = compact
+        record.batch = batch and self.batch_window > 0
+        record.outbox = asyncio.Queue(maxsize=self.outbox_size)
+        record.writer = asyncio.create_task(
+            self._drain(websocket, record.outbox)
+        )
+        return record
+
+    def detach(self, client_id: str) -> Optional[ConnectionRecord]:
+        """
+        Forget a connection and stop its writer task.
+
+        Returns:
+            Optional[ConnectionRecord]: The record, or None if the
+              connection was already detached.
+        """
+        record = self.registry.unregister(client_id)
+        if record is None:
+            return None
+        if record.pending is not None:
+            record.pending.timer.cancel()
+            record.pending = None
+        if record.writer is not None:
+            record.writer.cancel()
+        return record
+
+    def is_attached(self, client_id: str) -> bool:
+        return client_id in self.registry
+
+    def send(self, client_id: str, frame: Frame) -> bool:
+        """
+        Queue an already serialized frame for a connection on any node.
+
+        Args:
+            client_id (str): The receiving connection.
+            frame (Frame): The serialized frame, in either protocol.
+
+        Returns:
+            bool: False if the receiver is unknown or its outbox is full
+              and the frame was dropped.
+        """
+        record = self.registry.get(client_id)
+        if record is None:
+            if self.backplane is not None:
+                return self.backplane.forward(client_id, frame)
+            return False
+        return self._enqueue(record, frame)
+
+    def deliver_local(self, client_id: str, frame: Frame) -> bool:
+        """
+        Queue a frame for a connection attached to this process.
+        """
+        record = self.registry.get(client_id)
+        if record is None:
+            return False
+        return self._enqueue(record, frame)
+
+    def _enqueue(self, record: ConnectionRecord, frame: Frame) -> bool:
+        if record.pending is not None:
+            self._flush_batch(record)
+        if isinstance(frame, bytes) != record.compact:
+            frame = transcode(frame, record.compact)
+            if frame is None:
+                self.dropped += 1
+                return False
+        try:
+            record.outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.overflow == OVERFLOW_CLOSE:
+                self._close_slow(record)
+            return False
+        self.sent += 1
+        return True
+
+    def _close_slow(self, record: ConnectionRecord) -> None:
+        if record.writer is None or record.writer.done():
+            # Already being closed
+            return
+        record.writer.cancel()
+        self.closed += 1
+        task = asyncio.create_task(
+            self._close(record.websocket, SLOW_CONSUMER_CODE)
+        )
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int) -> None:
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "attached": len(self.registry),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "closed": self.closed,
+            "batches": self.batches,
+            "batched": self.batched,
+        }
+
+    def send_json(self, client_id: str, message: Dict[str, Any]) -> bool:
+        """
+        Serialize a message and queue it for a connection.
+        """
+        if not self.send(client_id, frame_dumps(message)):
+            return False
+        count_frame_out(message.get("type"))
+        return True
+
+    def relay(
+        self,
+        sender_id: str,
+        partner_id: Optional[str],
+        message: Dict[str, Any]
+    ) -> bool:
+        """
+        Forward a signaling message from a peer to its partner.
+
+        Only `ROUTED_TYPES` are relayed; anything else is ignored.
+
+        Args:
+            sender_id (str): The peer that sent the message.
+            partner_id (Optional[str]): The current partner of the sender.
+            message (Dict[str, Any]): The decoded message.
+
+        Returns:
+            bool: True if the message was queued for the partner.
+        """
+        if partner_id is None or message.get("type") not in ROUTED_TYPES:
+            return False
+        message["peer_id"] = sender_id
+        if message["type"] == "candidate" and len(message) == 3:
+            record = self.registry.get(partner_id)
+            if record is not None and record.batch:
+                candidate = message.get("candidate")
+                if record.compact:
+                    candidate = pack_candidate(candidate)
+                if candidate is not None:
+                    self._batch(record, sender_id, candidate)
+                    return True
+        if not self.send(partner_id, frame_dumps(message)):
+            return False
+        count_frame_out(message["type"])
+        return True
+
+    def relay_compact(
+        self,
+        sender_id: str,
+        partner_id: Optional[str],
+        frame: bytes
+    ) -> bool:
+        """
+        Forward a compact frame from a peer to its partner.
+
+        Only the header is read: the peer id is replaced by the sender's
+        and the payload is passed through untouched.
+
+        Returns:
+            bool: True if the frame was queued for the partner.
+        """
+        if partner_id is None or not frame or frame[0] not in ROUTED_CODES:
+            return False
+        if frame[0] == CANDIDATE_CODE:
+            record = self.registry.get(partner_id)
+            if record is not None and record.batch and self._batch_compact(
+                record, sender_id, frame
+            ):
+                return True
+        try:
+            readdressed = readdress(frame, sender_id)
+        except FrameError:
+            return False
+        if not self.send(partner_id, readdressed):
+            return False
+        count_frame_out(TYPE_NAMES[frame[0]])
+        return True
+
+    def _batch_compact(
+        self,
+        record: ConnectionRecord,
+        sender_id: str,
+        frame: bytes
+    ) -> bool:
+        try:
+            candidate = split_candidate(frame)
+            if candidate is not None and not record.compact:
+                candidate = unpack_candidate(candidate)
+        except Exception:
+            candidate = None
+        if candidate is None:
+            # Not encoded the usual way: decode it to have a look
+            message = compact_to_message(frame)
+            if message is None or len(message) != 3 or (
+                "candidate" not in message
+            ):
+                return False
+            candidate = message["candidate"]
+            if record.compact:
+                candidate = pack_candidate(candidate)
+        self._batch(record, sender_id, candidate)
+        return True
+
+    def _batch(
+        self,
+        record: ConnectionRecord,
+        sender_id: str,
+        candidate: Any
+    ) -> None:
+        pending = record.pending
+        if pending is not None and pending.sender_id != sender_id:
+            self._flush_batch(record)
+            pending = None
+        if pending is None:
+            timer = asyncio.get_running_loop().call_later(
+                self.batch_window, self._flush_batch, record
+            )
+            pending = record.pending = _Batch(sender_id, timer)
+        pending.items.append(candidate)
+        if len(pending.items) >= MAX_BATCH:
+            self._flush_batch(record)
+
+    def _flush_batch(self, record: ConnectionRecord) -> None:
+        pending = record.pending
+        if pending is None:
+            return
+        record.pending = None
+        pending.timer.cancel()
+        if self.registry.get(record.client_id) is not record:
+            # Detached in the meantime
+            return
+        items = pending.items
+        try:
+            if len(items) == 1:
+                name = "candidate"
+                if record.compact:
+                    frame: Frame = encode_frame(
+                        CANDIDATE_CODE,
+                        pending.sender_id,
+                        CANDIDATE_PREFIX + items[0]
+                    )
+                else:
+                    frame = frame_dumps({
+                        "type": name,
+                        "candidate": items[0],
+                        "peer_id": pending.sender_id,
+                    })
+            else:
+                name = "candidates"
+                if record.compact:
+                    frame = encode_frame(
+                        CANDIDATES_CODE,
+                        pending.sender_id,
+                        candidates_payload(items)
+                    )
+                else:
+                    frame = frame_dumps({
+                        "type": name,
+                        "candidates": items,
+                        "peer_id": pending.sender_id,
+                    })
+                self.batches += 1
+                self.batched += len(items)
+        except ENCODE_ERRORS:
+            # Candidates of a compact sender that JSON cannot hold
+            self.dropped += 1
+            return
+        if self._enqueue(record, frame):
+            count_frame_out(name)
+
+    @staticmethod
+    async def _drain(websocket: WebSocket, outbox: asyncio.Queue) -> None:
+        while True:
+            frame = await outbox.get()
+            start_time = time.perf_counter()
+            try:
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(frame)
+            except Exception:
+                # The receive loop of this connection handles the disconnect
+                return
+            SEND_LATENCY.observe(time.perf_counter() - start_time)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The backend modules are imported by name, as `main` does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__
+))))
@@ -0,0 +1,33 @@
+"""
+Worker id allocation of the in-process backplane
+"""
+import asyncio
+
+import pytest
+
+from backplane import InMemoryBackplane
+
+
+def test_processes_lease_distinct_worker_ids(
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path
+) -> None:
+    monkeypatch.delenv("WORKER_ID", raising=False)
+    monkeypatch.setenv("WORKER_LOCK_DIR", str(tmp_path))
+
+    async def main() -> None:
+        first, second = InMemoryBackplane(), InMemoryBackplane()
+        assert await first.allocate_worker_id() == 0
+        assert await second.allocate_worker_id() == 1
+        await first.close()
+        third = InMemoryBackplane()
+        assert await third.allocate_worker_id() == 0
+        await second.close()
+        await third.close()
+
+    asyncio.run(main())
+
+
+def test_worker_id_can_be_set(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("WORKER_ID", "42")
+    assert asyncio.run(InMemoryBackplane().allocate_worker_id()) == 42
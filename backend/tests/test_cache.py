@@ -0,0 +1,47 @@
+"""
+ReadThroughCache request coalescing
+"""
+import asyncio
+from typing import Any, Dict, Optional
+
+from bson import ObjectId
+
+from cache import ReadThroughCache
+
+
+class SlowDatabase:
+    """
+    Answers `find_one` after `release` is set, counting the calls.
+    """
+
+    def __init__(self) -> None:
+        self.calls: int = 0
+        self.release: asyncio.Event = asyncio.Event()
+
+    async def find_one(
+        self,
+        query: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        self.calls += 1
+        await self.release.wait()
+        return {"_id": query["_id"]}
+
+
+def test_cancelled_leader_does_not_hang_followers() -> None:
+    async def main() -> None:
+        db = SlowDatabase()
+        cache = ReadThroughCache(db)  # type: ignore[arg-type]
+        document_id = ObjectId()
+        leader = asyncio.create_task(cache.find_one(document_id))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(cache.find_one(document_id))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        db.release.set()
+        document = await asyncio.wait_for(follower, 1)
+        assert document == {"_id": document_id}
+        assert leader.cancelled()
+        assert db.calls == 2
+
+    asyncio.run(main())
@@ -0,0 +1,19 @@
+"""
+Resume tokens handed out while draining
+"""
+from drain import ResumeTokens
+
+
+def test_resume_tokens() -> None:
+    tokens = ResumeTokens(b"secret", ttl=60)
+    token = tokens.issue("alice", "bob", now=1000)
+    assert tokens.verify(token, now=1030) == ("alice", "bob")
+    assert tokens.verify(tokens.issue("alice", now=1000), now=1030) == (
+        "alice", None
+    )
+    # Expired, forged, malformed
+    assert tokens.verify(token, now=1061) is None
+    assert tokens.verify(token.replace("bob", "eve"), now=1030) is None
+    assert ResumeTokens(b"other").verify(token, now=1030) is None
+    assert tokens.verify("alice.bob", now=1030) is None
+    assert tokens.verify("a.b.1.é", now=0) is None
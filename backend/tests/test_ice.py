@@ -0,0 +1,61 @@
+"""
+IceServers: coturn REST credentials, without a TURN server
+"""
+import json
+from typing import List
+
+import pytest
+
+from ice import IceServers
+
+
+def test_turn_credentials() -> None:
+    now: List[float] = [2000.0]
+    ice = IceServers(
+        stun_urls=("stun:stun.example.com",),
+        turn_urls={" EU ": ["turn:eu.example.com"], "us": ["turn:us"]},
+        secret=b"north",
+        ttl=3600,
+        refresh=300,
+        clock=lambda: now[0]
+    )
+    content, max_age = ice.render("eu")
+    config = json.loads(content)
+    # Valid for `ttl` seconds after the end of the window
+    assert config == {
+        "iceServers": [
+            {"urls": ["stun:stun.example.com"]},
+            {
+                "urls": ["turn:eu.example.com"],
+                "username": "5700:omegle",
+                # base64(HMAC-SHA1(secret, username)), as coturn checks it
+                "credential": "6laVWe/S4FN4NUAS2kch9h3jrrc=",
+            },
+        ],
+        "region": "eu",
+        "expires_at": 5700,
+    }
+    assert max_age == 100
+    # Served from memory until the window ends
+    now[0] = 2050.0
+    assert ice.render("EU") == (content, 50)
+    now[0] = 2100.0
+    config = json.loads(ice.render("eu")[0])
+    assert config["iceServers"][1]["username"] == "6000:omegle"
+    assert config["iceServers"][1]["credential"] == (
+        "639Bq8yX43ujtEBMadp2L7FBESI="
+    )
+    assert ice.stats() == {"minted": 2, "hits": 1}
+    # Unknown regions get the first one
+    assert ice.select_region("mars") == "eu"
+
+
+def test_stun_only() -> None:
+    ice = IceServers(turn_urls={"eu": ["turn:eu"]}, clock=lambda: 0)
+    assert ice.config()["iceServers"] == [
+        {"urls": ["stun:stun.l.google.com:19302"]}
+    ]
+    with pytest.raises(RuntimeError):
+        ice.credentials(60)
+    with pytest.raises(ValueError):
+        IceServers(refresh=0)
@@ -0,0 +1,131 @@
+"""
+Matchmaker: matching by region and tags, widening and skips
+"""
+from typing import List
+
+from matchmaking import (
+    STATUS_AVAILABLE,
+    STATUS_CONNECTED,
+    Matchmaker,
+    parse_preferences
+)
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now: float = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_parse_preferences() -> None:
+    preferences = parse_preferences(" EU ", "Chess, music,,chess")
+    assert preferences.region == "eu"
+    assert preferences.tags == {"chess", "music"}
+    assert parse_preferences("", None) == parse_preferences()
+
+
+def test_join_prefers_a_shared_tag() -> None:
+    clock = Clock()
+    matchmaker = Matchmaker(widen_after=5, clock=clock)
+    assert matchmaker.join("alice", parse_preferences("eu", "chess")) is None
+    clock.now += 1
+    assert matchmaker.join("bob", parse_preferences("eu", "music")) is None
+    clock.now += 1
+    assert matchmaker.join("carol", parse_preferences("us", "music")) is None
+    # Oldest client sharing a tag in the same region
+    assert matchmaker.join("dave", parse_preferences("eu", "go,music")) == (
+        "bob"
+    )
+    assert matchmaker.partner_of("bob") == "dave"
+    assert matchmaker.status_of("bob") == STATUS_CONNECTED
+    assert matchmaker.status_of("alice") == STATUS_AVAILABLE
+    # Nobody shares a tag and nobody has waited long enough
+    assert matchmaker.join("erin", parse_preferences("eu", "go")) is None
+    assert matchmaker.waiting_count == 3
+    # Joining again does not queue twice or break the pair
+    assert matchmaker.join("erin") is None
+    assert matchmaker.join("dave") == "bob"
+
+
+def test_searches_widen_with_waiting_time() -> None:
+    clock = Clock()
+    matchmaker = Matchmaker(widen_after=5, clock=clock)
+    matchmaker.join("alice", parse_preferences("eu", "chess"))
+    matchmaker.join("bob", parse_preferences("us", "music"))
+    clock.now += 5
+    # Alice now takes anyone from the region
+    assert matchmaker.join("carol", parse_preferences("eu", "go")) == "alice"
+    assert matchmaker.widen() == []
+    clock.now += 5
+    # Bob takes anyone at all
+    assert matchmaker.join("dave", parse_preferences("eu", "go")) == "bob"
+    assert matchmaker.waiting_count == 0
+    assert matchmaker.bucket_count == 0
+
+
+def test_widen_pairs_waiting_clients() -> None:
+    clock = Clock()
+    matchmaker = Matchmaker(widen_after=5, clock=clock)
+    for client_id, region, tag in (
+        ("alice", "eu", "chess"),
+        ("bob", "us", "go"),
+        ("carol", "eu", "music"),
+        ("dave", "ap", "art"),
+    ):
+        matchmaker.join(client_id, parse_preferences(region, tag))
+    clock.now += 5
+    assert matchmaker.widen() == [("alice", "carol")]
+    clock.now += 5
+    assert matchmaker.widen() == [("bob", "dave")]
+    assert matchmaker.pair_count == 2
+
+
+def test_skip_keeps_the_pair_apart() -> None:
+    clock = Clock()
+    matchmaker = Matchmaker(widen_after=5, clock=clock, rematch_after=30)
+    matchmaker.join("alice")
+    assert matchmaker.join("bob") == "alice"
+    assert matchmaker.skip("bob") == "alice"
+    assert matchmaker.partner_of("alice") is None
+    assert matchmaker.skip("bob") is None
+    assert matchmaker.join("bob") is None
+    assert matchmaker.join("alice") is None
+    clock.now += 10
+    assert matchmaker.widen() == []
+    # Anyone else still gets the longest waiting of them
+    assert matchmaker.join("carol") == "bob"
+    matchmaker.leave("carol")
+    clock.now += 20
+    assert matchmaker.join("bob") == "alice"
+
+
+def test_avoided_clients_are_bounded() -> None:
+    clock = Clock()
+    matchmaker = Matchmaker(clock=clock, rematch_after=30, avoid_size=2)
+    skipped: List[str] = []
+    for stranger in ("s1", "s2", "s3"):
+        matchmaker.join(stranger)
+        assert matchmaker.join("alice") == stranger
+        assert matchmaker.skip("alice") == stranger
+        skipped.append(stranger)
+    # s1 was forgotten to make room for s3
+    for stranger in reversed(skipped):
+        matchmaker.join(stranger)
+    assert matchmaker.join("alice") == "s1"
+
+
+def test_leave_and_restore() -> None:
+    matchmaker = Matchmaker()
+    matchmaker.join("alice")
+    matchmaker.join("bob")
+    assert matchmaker.withdraw("alice") == "bob"
+    assert matchmaker.leave("alice") == "bob"
+    assert matchmaker.partner_of("bob") is None
+    assert matchmaker.restore("alice", "bob")
+    assert matchmaker.restore("alice", "bob")
+    assert not matchmaker.restore("carol", "alice")
+    assert not matchmaker.restore("carol", "carol")
+    matchmaker.join("carol")
+    assert not matchmaker.restore("dave", "carol")
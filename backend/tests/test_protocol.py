@@ -0,0 +1,103 @@
+"""
+Compact frames, transcoding and candidate batches
+"""
+import json
+
+import pytest
+
+from protocol import (
+    CANDIDATE_PREFIX,
+    TYPE_CODES,
+    FrameError,
+    candidates_payload,
+    compact_to_message,
+    encode_frame,
+    message_to_compact,
+    pack_candidate,
+    read_header,
+    readdress,
+    split_candidate,
+    transcode,
+    unpack_candidate
+)
+
+msgpack = pytest.importorskip("msgpack")
+
+OFFER = {"type": "offer", "offer": {"sdp": "v=0"}, "peer_id": "bob"}
+
+
+def test_messages_round_trip() -> None:
+    frame = message_to_compact(OFFER)
+    assert frame is not None
+    assert read_header(frame) == (TYPE_CODES["offer"], "bob", 5)
+    assert compact_to_message(frame) == OFFER
+    assert compact_to_message(readdress(frame, "carol")) == {
+        **OFFER, "peer_id": "carol"
+    }
+    # No body, no peer id
+    assert compact_to_message(message_to_compact({"type": "ping"})) == {
+        "type": "ping"
+    }
+    assert message_to_compact({"type": "unknown"}) is None
+
+
+def test_malformed_frames() -> None:
+    with pytest.raises(FrameError):
+        read_header(b"\x01")
+    with pytest.raises(FrameError):
+        read_header(b"\x01\x05bob")
+    with pytest.raises(FrameError):
+        read_header(b"\x01\x03\xff\xfe\xfd")
+    assert compact_to_message(b"\x01\x03\xff\xfe\xfd") is None
+    # Unknown type code, truncated body, body that is not a map
+    assert compact_to_message(b"\x7f\x00") is None
+    assert compact_to_message(b"\x01\x00\x81") is None
+    assert compact_to_message(b"\x01\x00\x93\x01\x02\x03") is None
+
+
+def test_transcode() -> None:
+    text = json.dumps(OFFER)
+    frame = transcode(text, compact=True)
+    assert frame == message_to_compact(OFFER)
+    assert json.loads(transcode(frame, compact=False)) == OFFER
+    # Already in the receiver's protocol
+    assert transcode(text, compact=False) is text
+    assert transcode(frame, compact=True) is frame
+
+
+def test_transcode_drops_what_the_other_side_cannot_hold() -> None:
+    # Too large for msgpack, not a JSON object, unhashable type
+    too_large = json.dumps({"type": "offer", "offer": 10 ** 30})
+    assert transcode(too_large, compact=True) is None
+    assert transcode("[1, 2]", compact=True) is None
+    assert transcode('{"type": ["offer"]}', compact=True) is None
+    # Binary data has no JSON equivalent
+    frame = encode_frame(
+        TYPE_CODES["offer"], "bob", msgpack.packb({"offer": b"\x00"})
+    )
+    assert transcode(frame, compact=False) is None
+
+
+def test_candidates() -> None:
+    candidate = {"candidate": "candidate:1 1 udp 1 10.0.0.1 5000 typ host"}
+    frame = message_to_compact({"type": "candidate", "candidate": candidate})
+    packed = split_candidate(frame)
+    assert packed == pack_candidate(candidate)
+    assert unpack_candidate(packed) == candidate
+    assert frame.endswith(CANDIDATE_PREFIX + packed)
+    # Anything else than a lone candidate is not split
+    assert split_candidate(message_to_compact({
+        "type": "candidate", "candidate": candidate, "extra": 1
+    })) is None
+    assert pack_candidate(10 ** 30) is None
+    # A batch decodes like any other body, short and long arrays alike
+    for count in (1, 15, 16, 300):
+        batch = encode_frame(
+            TYPE_CODES["candidates"], "bob",
+            candidates_payload([packed] * count)
+        )
+        assert compact_to_message(batch) == {
+            "type": "candidates",
+            "candidates": [candidate] * count,
+            "peer_id": "bob",
+        }
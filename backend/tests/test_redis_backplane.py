@@ -0,0 +1,344 @@
+"""
+RedisBackplane against fakeredis: the Lua scripts and the envelopes
+exchanged between nodes
+"""
+import asyncio
+from typing import Any, Callable, Dict, List, Tuple
+
+import pytest
+
+import backplane
+from backplane import RedisBackplane
+from matchmaking import parse_preferences
+from protocol import Frame
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+
+class Node:
+    """
+    A backplane and what it was told, as one worker would see them.
+    """
+
+    def __init__(self, node_id: str) -> None:
+        self.backplane: RedisBackplane = RedisBackplane(
+            "redis://fake", node_id=node_id
+        )
+        self.frames: List[Tuple[str, Frame]] = []
+        self.pairing: List[Tuple[str, bool]] = []
+        self.suspended: List[Tuple[str, str]] = []
+        self.backplane.on_pairing = (
+            lambda client_id, paired: self.pairing.append((client_id, paired))
+        )
+        self.backplane.on_suspended = (
+            lambda client_id, peer: self.suspended.append((client_id, peer))
+        )
+
+    def deliver(self, client_id: str, frame: Frame) -> bool:
+        self.frames.append((client_id, frame))
+        return True
+
+    async def start(self) -> "Node":
+        await self.backplane.start(self.deliver)
+        return self
+
+
+async def until(condition: Callable[[], Any], timeout: float = 2.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("Condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+def cluster(test: Callable[..., Any]) -> Callable[..., None]:
+    """
+    Run an async test with two nodes sharing one fake Redis server.
+    """
+    def run(monkeypatch: pytest.MonkeyPatch) -> None:
+        server = fakeredis.FakeServer()
+
+        def from_url(url: str, **options: Any) -> Any:
+            return fakeredis.FakeAsyncRedis(server=server, **options)
+
+        monkeypatch.setattr(backplane.aioredis, "from_url", from_url)
+        monkeypatch.delenv("WORKER_ID", raising=False)
+
+        async def main() -> None:
+            nodes = [await Node("a").start(), await Node("b").start()]
+            try:
+                await test(*nodes)
+            finally:
+                for node in nodes:
+                    await node.backplane.close()
+
+        asyncio.run(main())
+
+    # Not `functools.wraps`: pytest would ask for fixtures named a and b
+    run.__name__ = test.__name__
+    run.__doc__ = test.__doc__
+    return run
+
+
+@cluster
+async def test_join_pairs_across_nodes(a: Node, b: Node) -> None:
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    assert await a.backplane.join("alice") is None
+    assert await a.backplane.queue_depth() == 1
+    assert await b.backplane.join("bob") == "alice"
+    assert b.backplane.partner_of("bob") == "alice"
+    await until(lambda: a.backplane.partner_of("alice") == "bob")
+    assert a.pairing == [("alice", True)]
+    assert await a.backplane.queue_depth() == 0
+    # Joining again while paired keeps the pair
+    assert await a.backplane.join("alice") == "bob"
+
+
+@cluster
+async def test_join_drops_unregistered_waiters(a: Node, b: Node) -> None:
+    await a.backplane.register("ghost")
+    await a.backplane.join("ghost")
+    await a.backplane.unregister("ghost")
+    await b.backplane.register("bob")
+    assert await b.backplane.join("bob") is None
+    assert await b.backplane.queue_depth() == 1
+    # Unregistered clients cannot join
+    assert await a.backplane.join("ghost") is None
+
+
+@cluster
+async def test_frames_reach_the_partner_node(a: Node, b: Node) -> None:
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    await a.backplane.join("alice")
+    await b.backplane.join("bob")
+    await until(lambda: a.backplane.partner_of("alice") == "bob")
+    assert a.backplane.forward("bob", '{"type":"offer"}')
+    assert b.backplane.forward("alice", b"\x01\x03bob\x80")
+    await until(lambda: a.frames and b.frames)
+    assert b.frames == [("bob", '{"type":"offer"}')]
+    assert a.frames == [("alice", b"\x01\x03bob\x80")]
+    # Clients that are not partners are looked up in the registry
+    await b.backplane.register("carol")
+    assert a.backplane.forward("carol", "hi")
+    await until(lambda: ("carol", "hi") in b.frames)
+
+
+@cluster
+async def test_leave_unpairs_the_other_node(a: Node, b: Node) -> None:
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    await a.backplane.join("alice")
+    await b.backplane.join("bob")
+    await until(lambda: a.backplane.partner_of("alice") == "bob")
+    assert await b.backplane.leave("bob") == "alice"
+    await until(lambda: ("alice", False) in a.pairing)
+    assert a.backplane.partner_of("alice") is None
+    assert await b.backplane.leave("bob") is None
+
+
+@cluster
+async def test_suspend_and_resume_keep_the_pair(a: Node, b: Node) -> None:
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    await a.backplane.join("alice")
+    await b.backplane.join("bob")
+    await until(lambda: a.backplane.partner_of("alice") == "bob")
+    # Bob moves from node b to node a
+    assert await b.backplane.suspend("bob") == "alice"
+    await until(lambda: a.suspended == [("alice", "bob")])
+    await b.backplane.unregister("bob")
+    await a.backplane.register("bob")
+    assert await a.backplane.resume("bob", "alice")
+    assert a.backplane.partner_of("bob") == "alice"
+    assert a.backplane.partner_of("alice") == "bob"
+    # Either side paired elsewhere prevents a resume
+    await b.backplane.register("carol")
+    assert not await b.backplane.resume("carol", "alice")
+
+
+@cluster
+async def test_resume_waits_for_a_suspended_partner(a: Node, b: Node) -> None:
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    await a.backplane.join("alice")
+    await b.backplane.join("bob")
+    await until(lambda: a.backplane.partner_of("alice") == "bob")
+    for node, client_id in ((a, "alice"), (b, "bob")):
+        await node.backplane.suspend(client_id)
+        await node.backplane.unregister(client_id)
+    await a.backplane.register("alice")
+    assert not await a.backplane.resume("alice", "bob")
+    assert a.backplane.partner_of("alice") is None
+    # Bob comes back before alice gave up on him
+    await b.backplane.register("bob")
+    assert await b.backplane.resume("bob", "alice")
+    await until(lambda: a.backplane.partner_of("alice") == "bob")
+
+
+@cluster
+async def test_resume_remakes_a_broken_pair(a: Node, b: Node) -> None:
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    assert not await a.backplane.resume("alice", "nobody")
+    assert await a.backplane.resume("alice", "bob")
+    await until(lambda: b.backplane.partner_of("bob") == "alice")
+    assert ("bob", True) in b.pairing
+
+
+@cluster
+async def test_listener_survives_failures(a: Node, b: Node) -> None:
+    a.backplane._receive("not json")
+    a.backplane._receive('{"op": "frame"}')
+    deliver = a.backplane._deliver
+
+    def broken(client_id: str, frame: Frame) -> bool:
+        a.backplane._deliver = deliver
+        raise ConnectionError("Subscription lost")
+
+    a.backplane._deliver = broken
+    await a.backplane.register("alice")
+    b.backplane.forward("alice", "lost")
+    await until(lambda: a.backplane.failed == 1)
+    # Subscribed again after a short delay
+    for attempt in range(100):
+        b.backplane.forward("alice", f"frame {attempt}")
+        await asyncio.sleep(0.02)
+        if a.frames:
+            break
+    assert a.frames and a.frames[0][1].startswith("frame")
+
+
+@cluster
+async def test_publisher_survives_failures(a: Node, b: Node) -> None:
+    publish = a.backplane._redis.publish
+    calls: Dict[str, int] = {"count": 0}
+
+    async def flaky(channel: str, message: str) -> int:
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise ConnectionError("Redis went away")
+        return await publish(channel, message)
+
+    a.backplane._redis.publish = flaky
+    await b.backplane.register("bob")
+    a.backplane.forward("bob", "lost")
+    a.backplane.forward("bob", "delivered")
+    await until(lambda: b.frames)
+    assert b.frames == [("bob", "delivered")]
+    assert a.backplane.failed == 1
+
+
+@cluster
+async def test_skip_keeps_the_pair_apart(a: Node, b: Node) -> None:
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    await a.backplane.join("alice")
+    await b.backplane.join("bob")
+    await until(lambda: a.backplane.partner_of("alice") == "bob")
+    assert await b.backplane.skip("bob") == "alice"
+    assert b.backplane.partner_of("bob") is None
+    await until(lambda: ("alice", False) in a.pairing)
+    # Requeued back to back, as `main.skip_partner` does
+    assert await b.backplane.join("bob") is None
+    assert await a.backplane.join("alice") is None
+    assert await a.backplane.queue_depth() == 2
+    # Anyone else still gets the oldest of them
+    await a.backplane.register("carol")
+    assert await a.backplane.join("carol") == "bob"
+    await a.backplane.register("dave")
+    assert await a.backplane.join("dave") == "alice"
+    assert await a.backplane.skip("nobody") is None
+
+
+@cluster
+async def test_skip_is_forgotten_after_a_while(a: Node, b: Node) -> None:
+    a.backplane.rematch_after = 0.05
+    await a.backplane.register("alice")
+    await b.backplane.register("bob")
+    await a.backplane.join("alice")
+    await b.backplane.join("bob")
+    assert await a.backplane.skip("alice") == "bob"
+    assert await a.backplane.join("alice") is None
+    await asyncio.sleep(0.1)
+    assert await b.backplane.join("bob") == "alice"
+
+
+@cluster
+async def test_join_prefers_a_shared_tag(a: Node, b: Node) -> None:
+    await a.backplane.register("alice", parse_preferences("eu", "chess"))
+    await a.backplane.register("bob", parse_preferences("eu", "music"))
+    await b.backplane.register("carol", parse_preferences("us", "chess"))
+    for client_id in ("alice", "bob", "carol"):
+        assert await a.backplane.join(client_id) is None
+    await b.backplane.register("dave", parse_preferences("eu", "music,go"))
+    assert await b.backplane.join("dave") == "bob"
+    # Same tag in another region, and nobody has waited long enough
+    await b.backplane.register("erin", parse_preferences("eu", "go"))
+    assert await b.backplane.join("erin") is None
+    assert await a.backplane.queue_depth() == 3
+    # Tagless clients are matched with each other
+    await a.backplane.register("frank")
+    await b.backplane.register("grace")
+    assert await a.backplane.join("frank") is None
+    assert await b.backplane.join("grace") == "frank"
+
+
+@cluster
+async def test_searches_widen_with_waiting_time(a: Node, b: Node) -> None:
+    for node in (a, b):
+        node.backplane.widen_after = 0.05
+    await a.backplane.register("alice", parse_preferences("eu", "chess"))
+    await b.backplane.register("bob", parse_preferences("eu", "music"))
+    await b.backplane.register("carol", parse_preferences("us", "music"))
+    assert await a.backplane.join("alice") is None
+    assert await b.backplane.join("bob") is None
+    assert await b.backplane.join("carol") is None
+    assert await a.backplane.widen() == []
+    await asyncio.sleep(0.06)
+    # Anyone from the region
+    assert await a.backplane.widen() == [("alice", "bob")]
+    assert a.backplane.partner_of("alice") == "bob"
+    await until(lambda: b.backplane.partner_of("bob") == "alice")
+    await asyncio.sleep(0.06)
+    # Anyone at all
+    await a.backplane.register("dave", parse_preferences("eu", "go"))
+    assert await a.backplane.join("dave") == "carol"
+    assert await a.backplane.queue_depth() == 0
+
+
+@cluster
+async def test_leaving_clients_leave_their_buckets(a: Node, b: Node) -> None:
+    await a.backplane.register("alice", parse_preferences("eu", "chess"))
+    await a.backplane.join("alice")
+    await a.backplane.leave("alice")
+    await a.backplane.unregister("alice")
+    await b.backplane.register("bob", parse_preferences("eu", "chess"))
+    assert await b.backplane.join("bob") is None
+    # Suspended clients are out of the queue too
+    assert await b.backplane.suspend("bob") is None
+    await a.backplane.register("carol", parse_preferences("eu", "chess"))
+    assert await a.backplane.join("carol") is None
+    redis = a.backplane._redis
+    keys = [key async for key in redis.scan_iter("omegle:bucket:*")]
+    for key in keys:
+        assert await redis.zrange(key, 0, -1) in ([], ["carol"])
+
+
+@cluster
+async def test_worker_ids_are_leased(a: Node, b: Node) -> None:
+    assert await a.backplane.allocate_worker_id() == 0
+    assert await b.backplane.allocate_worker_id() == 1
+    # Released on close, kept by live nodes
+    await a.backplane.close()
+    c = await Node("c").start()
+    try:
+        assert await c.backplane.allocate_worker_id() == 0
+        redis = b.backplane._redis
+        assert await redis.get("omegle:worker:1") == "b"
+        assert 0 < await redis.ttl("omegle:worker:1") <= 30
+    finally:
+        await c.backplane.close()
@@ -1,23 +1,62 @@
+import asyncio
+import functools
 import time
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 
+from metrics import FUNCTION_LATENCY
 
-def calculate_running_time(func: Callable[..., Any]) -> Callable[..., Any]:
+
+def calculate_running_time(
+    func: Optional[Callable[..., Any]] = None,
+    *,
+    histogram: Any = None,
+    label: Optional[str] = None
+) -> Callable[..., Any]:
     """
-    Decorator that calculates the running time of the given function.
+    Decorator that records the running time of the given function.
+
+    Works on plain functions and coroutine functions, bare
+    (`@calculate_running_time`) or with arguments. Durations are observed
+    in seconds in `histogram`, labelled with `label` (the function name by
+    default) if the histogram has a label. Without a histogram they go to
+    `omegle_function_latency_seconds`, labelled with the qualified name.
 
     Args:
         func (Callable[..., Any]): The function to be timed.
+        histogram (Any): The Prometheus histogram to record into.
+        label (Optional[str]): The label value, if the histogram has one.
 
     Returns:
         Callable[..., Any]: The wrapped function.
     """
+    if func is None:
+        return functools.partial(
+            calculate_running_time, histogram=histogram, label=label
+        )
+
+    if histogram is None:
+        histogram = FUNCTION_LATENCY
+        label = label or func.__qualname__
+    if label is not None or getattr(histogram, "_labelnames", ()):
+        histogram = histogram.labels(label or func.__name__)
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs) -> Any:
+            start_time: float = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start_time)
+
+        return async_wrapper
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs) -> Any:
         start_time: float = time.perf_counter()
-        result: Any = func(*args, **kwargs)
-        end_time: float = time.perf_counter()
-        print(end_time - start_time)
-        return result
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
 
     return wrapper
@@ -0,0 +1,232 @@
+"""
+Write-behind buffer for connection state
+"""
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo.operations import UpdateOne
+
+from cache import ReadThroughCache
+from db_connection import AsyncDatabase
+
+
+class BatchWriter(ABC):
+    """
+    Background flush loop of buffers that write to MongoDB in batches.
+
+    Subclasses keep their pending operations, count them in `__len__`,
+    write them in `flush` and set `_wake` once `max_batch` are pending.
+    The loop flushes then or every `flush_interval` seconds, whichever
+    comes first, and `close` writes whatever is left.
+    """
+
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        max_batch: int = 500,
+        flush_interval: float = 0.5,
+        max_pending: int = 50_000
+    ) -> None:
+        self.db: AsyncDatabase = db
+        self.max_batch: int = max_batch
+        self.flush_interval: float = flush_interval
+        self.max_pending: int = max_pending
+        self._wake: asyncio.Event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing: bool = False
+        self._flush_lock: asyncio.Lock = asyncio.Lock()
+        self.flushed: int = 0
+        self.dropped: int = 0
+        self.failed: int = 0
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """
+        Return how many operations are pending.
+        """
+
+    @abstractmethod
+    async def flush(self) -> None:
+        """
+        Write all pending operations now.
+        """
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def start(self) -> None:
+        """
+        Start the background flush task.
+        """
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Stop the flush task and write everything that is still pending.
+        """
+        self._closing = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(
+                    self._wake.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if len(self):
+                await self.flush()
+
+
+class WriteBehindBuffer(BatchWriter):
+    """
+    Collects connection state changes and persists them in batches.
+
+    Changes to the same `_id` are merged while they wait, so a connection
+    that connects, pairs and leaves between two flushes costs one upsert.
+    A background task flushes when `max_batch` documents are pending or
+    every `flush_interval` seconds, whichever comes first. `submit` never
+    does I/O, which keeps database latency off the signaling path. Once
+    `max_pending` documents wait, `submit` sheds changes to any other
+    document and counts them as `dropped`, while `put` waits for the next
+    flush. Flushed documents are invalidated in `cache`, if given.
+    """
+
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        max_batch: int = 500,
+        flush_interval: float = 0.5,
+        max_pending: int = 50_000,
+        cache: Optional[ReadThroughCache] = None
+    ) -> None:
+        super().__init__(
+            db,
+            max_batch=max_batch,
+            flush_interval=flush_interval,
+            max_pending=max_pending
+        )
+        self.cache: Optional[ReadThroughCache] = cache
+        # _id -> ($set fields, $setOnInsert fields)
+        self._pending: Dict[ObjectId, Tuple[Dict[str, Any], Dict[str, Any]]]
+        self._pending = {}
+        self._room: asyncio.Event = asyncio.Event()
+        self._room.set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def full(self) -> bool:
+        """
+        Whether `submit` drops changes to documents not pending yet.
+        """
+        return len(self._pending) >= self.max_pending
+
+    def submit(
+        self,
+        document_id: ObjectId,
+        fields: Dict[str, Any],
+        on_insert: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """
+        Queue fields to set on a document, merging with pending changes.
+
+        Args:
+            document_id (ObjectId): The `_id` of the document.
+            fields (Dict[str, Any]): Fields to `$set`.
+            on_insert (Optional[Dict[str, Any]]): Fields only written if the
+              document does not exist yet.
+
+        Returns:
+            bool: False if the buffer is full and the change was dropped.
+        """
+        if self._add(document_id, fields, on_insert):
+            return True
+        self.dropped += 1
+        return False
+
+    async def put(
+        self,
+        document_id: ObjectId,
+        fields: Dict[str, Any],
+        on_insert: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """
+        Like `submit`, but wait for room instead of dropping the change.
+        """
+        while not self._add(document_id, fields, on_insert):
+            await self._room.wait()
+
+    def _add(
+        self,
+        document_id: ObjectId,
+        fields: Dict[str, Any],
+        on_insert: Optional[Dict[str, Any]]
+    ) -> bool:
+        pending = self._pending.get(document_id)
+        if pending is None:
+            if self.full:
+                self._room.clear()
+                self._wake.set()
+                return False
+            pending = self._pending[document_id] = ({}, {})
+        changes, inserts = pending
+        changes.update(fields)
+        if on_insert:
+            for key, value in on_insert.items():
+                inserts.setdefault(key, value)
+        if len(self._pending) >= self.max_batch:
+            self._wake.set()
+        return True
+
+    async def flush(self) -> None:
+        """
+        Write all pending changes now.
+        """
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            self._room.set()
+            requests: List[UpdateOne] = []
+            for document_id, (changes, inserts) in pending.items():
+                update: Dict[str, Any] = {}
+                if changes:
+                    update["$set"] = changes
+                inserts = {
+                    key: value
+                    for key, value in inserts.items()
+                    if key not in changes
+                }
+                if inserts:
+                    update["$setOnInsert"] = inserts
+                if not update:
+                    continue
+                requests.append(
+                    UpdateOne({"_id": document_id}, update, upsert=True)
+                )
+            for start in range(0, len(requests), self.max_batch):
+                batch = requests[start:start + self.max_batch]
+                try:
+                    await self.db.bulk_write(batch)
+                except Exception as ex:
+                    self.failed += len(batch)
+                    print(f"Write-behind flush failed: {ex}")
+                else:
+                    self.flushed += len(batch)
+            if self.cache is not None and pending:
+                await self.cache.invalidate(*pending)